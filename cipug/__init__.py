@@ -5,17 +5,48 @@ Welcome to cipug, the container images pinning and updating gadget.
 """
 
 import sys
+from typing import Callable
 
 from .log import log
 from .config import Config
 from .resolver import Image_Version_Resolver
-from .snapper import Snapper
+from .snapper import make_snapshotter
 from .updater import Updater
 from .utils import check_dependencies, prune_images
 from .snapshots import Snapshot_Checker
 from . import exit_code
 
+
+def _update(apply: Callable[[Updater], list[exit_code.Exit_Code]]):
+    """Set up what updating services needs, let apply() do the updating and
+    report how it went. Used by --update and --apply-plan alike."""
+    config = Config()
+    capabilities = check_dependencies()
+    prune_images()
+    resolver = Image_Version_Resolver()
+    snapper = None
+    if config["SERVICE_SNAPSHOT"]:
+        try:
+            snapper = make_snapshotter()
+        except ValueError as e:
+            log.error(str(e), exit_code=exit_code.VALUE_ERROR)
+    updater = Updater(resolver=resolver, snapper=snapper, capabilities=capabilities)
+    try:
+        errors = apply(updater)
+    finally:
+        resolver.flush()
+    log(f"Image resolutions: {resolver.summary()}")
+    log.timings_summary()
+    if errors:
+        log.error("Encountered errors during updating!", exit_code=errors)
+    else:
+        log("Updated services successfully")
+
+
 def main():
+    if any(arg in sys.argv for arg in ["--plan", "--check-snapshots-json"]):
+        # stdout is for the json output, even loading the config logs already
+        log.stream = sys.stderr
     config = Config()
 
     if "--print-config" in sys.argv:
@@ -34,8 +65,6 @@ def main():
         json.dump(config, sys.stdout, indent=4, cls=PosixPathEncoder)
         return
 
-    check_dependencies()
-
     if "--check-snapshots" in sys.argv:
         checker = Snapshot_Checker()
         if checker.check():
@@ -43,14 +72,54 @@ def main():
         else:
             log.error("Snapshots are missing or too old!", exit_code=exit_code.SNAPSHOTS_NOK)
 
+    if "--check-snapshots-json" in sys.argv:
+        import json
+        checker = Snapshot_Checker()
+        snapshots_ok, result = checker.check_json()
+        json.dump(result, sys.stdout, indent=4)
+        print()
+        if not snapshots_ok:
+            sys.exit(exit_code.SNAPSHOTS_NOK.code)
+        return
+
+    if "--serve-metrics" in sys.argv:
+        from .metrics import serve_metrics
+        serve_metrics()
+        return
+
+    if "--daemon" in sys.argv:
+        from .daemon import Daemon
+        try:
+            daemon = Daemon()
+        except ValueError as e:
+            log.error(str(e), exit_code=exit_code.VALUE_ERROR)
+        daemon.run()
+        return
+
+    if "--plan" in sys.argv:
+        import json
+        from .plan import make_plan
+        resolver = Image_Version_Resolver()
+        updater = Updater(resolver=resolver, snapper=None)
+        try:
+            plan = make_plan(updater)
+        finally:
+            resolver.flush()
+        log(f"Image resolutions: {resolver.summary()}")
+        log.timings_summary()
+        json.dump(plan, sys.stdout, indent=4)
+        print()
+        return
+
+    if "--apply-plan" in sys.argv:
+        from pathlib import Path
+        from .plan import apply_plan
+        idx = sys.argv.index("--apply-plan") + 1
+        if idx >= len(sys.argv):
+            log.error("--apply-plan needs the path of a plan file", exit_code=exit_code.VALUE_ERROR)
+        _update(lambda updater: apply_plan(updater, Path(sys.argv[idx])))
+        return
+
     if (len(sys.argv) == 1) or ("--update" in sys.argv):
         # No arguments, default update behavior
-        prune_images()
-        resolver = Image_Version_Resolver()
-        snapper = Snapper()
-        updater = Updater(resolver=resolver, snapper=snapper)
-        errors = updater.update_all_services()
-        if errors:
-            log.error("Encountered errors during updating!", exit_code=errors)
-        else:
-            log("Updated services successfully")
+        _update(lambda updater: updater.update_all_services())
@@ -0,0 +1,61 @@
+import subprocess
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from .config import Config
+from .log import log
+from .snapper import Snapshotter
+
+class Btrfs_Snapshotter(Snapshotter):
+    """Creates read-only btrfs snapshots of the service subvolumes directly,
+    without going through snapper. The snapshots are put where btrbk would put
+    them, i.e. into SNAPSHOTS_DIR_BTRBK relative to the service, and named like
+    btrbk does it: <service>.YYYYMMDDTHHMM, with a _N suffix if there already is
+    a snapshot from the same minute. That way the Snapshot_Checker finds them.
+    """
+    tool_name = "btrfs"
+
+    def __init__(self):
+        self.config = Config()
+        self.btrfs_tool = self.config["BTRFS_TOOL"].split(" ")
+        self.snapshots_dir: str = self.config["SNAPSHOTS_DIR_BTRBK"]
+        self._lock = threading.Lock()
+        self._reserved: set[Path] = set()  # snapshot names picked by this run
+        if not self.snapshots_dir:
+            raise ValueError(
+                "The btrfs snapshot backend needs CIPUG_SNAPSHOTS_DIR_BTRBK "
+                "to know where to put the snapshots"
+            )
+
+    def _snapshot_path(self, path: Path) -> Path:
+        target_dir = path / self.snapshots_dir
+        target_dir.mkdir(parents=True, exist_ok=True)
+        base_name = f"{path.resolve().name}.{datetime.now().strftime('%Y%m%dT%H%M')}"
+        target = target_dir / base_name
+        suffix = 0
+        with self._lock:
+            while target.exists() or target in self._reserved:
+                suffix += 1
+                target = target_dir / f"{base_name}_{suffix}"
+            self._reserved.add(target)
+        return target
+
+    def snapshot_folder(self, path: Path, message: str) -> Path:
+        """Create a read-only snapshot of the subvolume at path, returns the
+        path of the snapshot. btrfs has no place for the message, so it is
+        only logged."""
+        target = self._snapshot_path(path)
+        completed_process = subprocess.run(
+            self.btrfs_tool + ["subvolume", "snapshot", "-r", str(path), str(target)],
+            capture_output=True,
+            text=True
+        )
+        if completed_process.returncode != 0:
+            log.raw(completed_process.stdout + completed_process.stderr)
+            raise Exception(
+                f"Failed to snapshot {path} to {target}, "
+                f"returncode {completed_process.returncode}."
+            )
+        log.verbose(f"Created snapshot {target} ({message})")
+        return target
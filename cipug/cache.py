@@ -0,0 +1,276 @@
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from .config import Config
+from .log import log
+
+
+class Json_Cache_Store:
+    """Keeps the resolver cache in a json file. Changes are collected in memory
+    and written once with flush(), atomically (temp file + rename) and under a
+    file lock, such that concurrent cipug runs (e.g. cron and a manual run)
+    merge their results instead of overwriting each other's.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock_path = path.with_name(path.name + ".lock")
+        self._lock = threading.Lock()
+        self._dirty: set[str] = set()  # entries changed since the last flush
+        self._evicted: set[str] = set()  # entries removed since the last flush
+        self._dirty_services: set[str] = set()
+        self._evicted_services: set[str] = set()
+        with self._file_lock(exclusive=False):
+            self.images: dict[str, dict]
+            self.services: dict[str, dict]  # service folder -> fingerprint
+            self.images, self.services = self._read()
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self, quiet: bool = False) -> tuple[dict[str, dict], dict[str, dict]]:
+        """Returns the image entries and the service fingerprints"""
+        try:
+            content = self.path.read_text()
+        except FileNotFoundError:
+            return {}, {}
+        try:
+            data = json.loads(content)
+            if not isinstance(data, dict):
+                raise ValueError("not a dict")
+        except ValueError as e:
+            if not quiet:
+                log.error(f"Cache file {self.path} is corrupt ({e}), starting with an empty cache")
+            return {}, {}
+        if isinstance(data.get("images"), dict):
+            services = data.get("services")
+            return data["images"], services if isinstance(services, dict) else {}
+        # Older cipug versions stored the image entries at the top level
+        return {name: entry for name, entry in data.items() if isinstance(entry, dict)}, {}
+
+    def get(self, name: str) -> dict | None:
+        with self._lock:
+            entry = self.images.get(name)
+            return None if entry is None else entry.copy()
+
+    def put(self, name: str, entry: dict):
+        with self._lock:
+            self.images[name] = entry
+            self._dirty.add(name)
+            self._evicted.discard(name)
+
+    def get_service(self, folder: str) -> dict | None:
+        with self._lock:
+            entry = self.services.get(folder)
+            return None if entry is None else entry.copy()
+
+    def put_service(self, folder: str, entry: dict | None):
+        """Store the fingerprint of a service, or forget it with None"""
+        with self._lock:
+            if entry is None:
+                if self.services.pop(folder, None) is not None:
+                    self._dirty_services.discard(folder)
+                    self._evicted_services.add(folder)
+                return
+            self.services[folder] = entry
+            self._dirty_services.add(folder)
+            self._evicted_services.discard(folder)
+
+    def evict(self, keep: set[str]):
+        """Drop all entries for images that are not in keep"""
+        with self._lock:
+            for name in list(self.images.keys()):
+                if name not in keep:
+                    del self.images[name]
+                    self._dirty.discard(name)
+                    self._evicted.add(name)
+        if self._evicted:
+            log.verbose(f"Evicting {len(self._evicted)} cache entries of images no service uses anymore")
+
+    def flush(self):
+        """Write pending changes to disk, merged with what other runs wrote in the meantime"""
+        with self._lock:
+            if not (self._dirty or self._evicted or self._dirty_services or self._evicted_services):
+                return
+            with self._file_lock(exclusive=True):
+                on_disk, services_on_disk = self._read(quiet=True)
+                for entries, theirs_all, dirty, evicted in [
+                    (self.images, on_disk, self._dirty, self._evicted),
+                    (self.services, services_on_disk, self._dirty_services, self._evicted_services),
+                ]:
+                    for name in evicted:
+                        theirs_all.pop(name, None)
+                    for name in dirty:
+                        theirs = theirs_all.get(name, {})
+                        mine = entries[name]
+                        if float(theirs.get("time", 0)) <= float(mine.get("time", 0)):
+                            theirs_all[name] = mine
+
+                tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+                with open(tmp_path, "w") as f:
+                    json.dump({"images": on_disk, "services": services_on_disk}, f, sort_keys=True, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+
+            self.images = on_disk
+            self.services = services_on_disk
+            self._dirty = set()
+            self._evicted = set()
+            self._dirty_services = set()
+            self._evicted_services = set()
+        log.vverbose(f"Wrote resolver cache to {self.path}")
+
+    def record_applied(self, name: str, result: str, service: str):
+        """History is only kept by the sqlite store"""
+        pass
+
+    def close(self):
+        """Nothing is kept open between flushes"""
+        pass
+
+
+class Sqlite_Cache_Store:
+    """Keeps the resolver cache in a sqlite database. Lookups are indexed, so
+    the cache doesn't need to be loaded as a whole, and WAL mode lets several
+    cipug runs read while one writes. Additionally, every digest a tag ever
+    resolved to is kept in the history table, together with the services it
+    was applied to:
+
+        images(name, time, entry)            current cache entry per image name
+        services(folder, time, entry)        fingerprint per service folder
+        history(name, result, time, service) service is NULL for resolutions,
+                                             set when the result was applied
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS images (
+            name TEXT PRIMARY KEY,
+            time REAL NOT NULL,
+            entry TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS services (
+            folder TEXT PRIMARY KEY,
+            time REAL NOT NULL,
+            entry TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            result TEXT NOT NULL,
+            time REAL NOT NULL,
+            service TEXT
+        );
+        CREATE INDEX IF NOT EXISTS history_by_name ON history (name, time);
+        CREATE INDEX IF NOT EXISTS history_by_service ON history (service, time);
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode this still survives crashes of cipug, only a power loss
+        # may roll back the most recent transactions
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.executescript(self.schema)
+
+    def get(self, name: str) -> dict | None:
+        with self._lock:
+            row = self.db.execute("SELECT entry FROM images WHERE name = ?", (name,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, name: str, entry: dict):
+        with self._lock, self.db:
+            row = self.db.execute("SELECT entry FROM images WHERE name = ?", (name,)).fetchone()
+            previous_result = None if row is None else json.loads(row[0]).get("result")
+            cursor = self.db.execute(
+                "INSERT INTO images (name, time, entry) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET time = excluded.time, entry = excluded.entry "
+                "WHERE excluded.time >= images.time",
+                (name, float(entry["time"]), json.dumps(entry, sort_keys=True))
+            )
+            # No history for older entries that lost against a newer one
+            if cursor.rowcount > 0 and entry["result"] != previous_result:
+                self.db.execute(
+                    "INSERT INTO history (name, result, time) VALUES (?, ?, ?)",
+                    (name, entry["result"], float(entry["time"]))
+                )
+
+    def get_service(self, folder: str) -> dict | None:
+        with self._lock:
+            row = self.db.execute("SELECT entry FROM services WHERE folder = ?", (folder,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put_service(self, folder: str, entry: dict | None):
+        """Store the fingerprint of a service, or forget it with None"""
+        with self._lock, self.db:
+            if entry is None:
+                self.db.execute("DELETE FROM services WHERE folder = ?", (folder,))
+                return
+            self.db.execute(
+                "INSERT OR REPLACE INTO services (folder, time, entry) VALUES (?, ?, ?)",
+                (folder, float(entry["time"]), json.dumps(entry, sort_keys=True))
+            )
+
+    def evict(self, keep: set[str]):
+        """Drop all cache entries for images that are not in keep. Their history is kept."""
+        with self._lock, self.db:
+            names = [row[0] for row in self.db.execute("SELECT name FROM images")]
+            evicted = [(name,) for name in names if name not in keep]
+            self.db.executemany("DELETE FROM images WHERE name = ?", evicted)
+        if evicted:
+            log.verbose(f"Evicting {len(evicted)} cache entries of images no service uses anymore")
+
+    def flush(self):
+        """Every change is committed right away, nothing to do"""
+        pass
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def record_applied(self, name: str, result: str, service: str):
+        with self._lock, self.db:
+            self.db.execute(
+                "INSERT INTO history (name, result, time, service) VALUES (?, ?, ?, ?)",
+                (name, result, time.time(), service)
+            )
+
+    def history(self, name: str | None = None, service: str | None = None) -> list[tuple[str, str, float, str | None]]:
+        """Past resolutions (and applications to services) as (name, result,
+        time, service), oldest first. Optionally limited to one image name or
+        one service."""
+        query = "SELECT name, result, time, service FROM history"
+        conditions, params = [], []
+        if name is not None:
+            conditions.append("name = ?")
+            params.append(name)
+        if service is not None:
+            conditions.append("service = ?")
+            params.append(service)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with self._lock:
+            return self.db.execute(query + " ORDER BY time, id", params).fetchall()
+
+
+def open_cache_store() -> Json_Cache_Store | Sqlite_Cache_Store:
+    """The cache store selected by CACHE_BACKEND"""
+    config = Config()
+    if config["CACHE_BACKEND"] == "sqlite":
+        return Sqlite_Cache_Store(config["CACHE_DB_LOCATION"])
+    return Json_Cache_Store(config["CACHE_LOCATION"])
@@ -0,0 +1,115 @@
+import json
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .config import Config
+from .log import log
+
+
+class Tool_Probe:
+    """Result of probing an external tool"""
+    def __init__(self, name: str, path: str | None, version: str | None):
+        self.name = name
+        self.path = path  # None if the tool wasn't found
+        self.version = version  # None if the tool couldn't be run
+
+    @property
+    def ok(self) -> bool:
+        return self.version is not None
+
+
+class Capabilities:
+    """Finds out once per run which external tools are usable, such that the
+    rest of cipug can reuse the results instead of probing again. Versions are
+    additionally cached across runs, keyed on the tool's path and modification
+    time, so a tool is only run with --version again after it was updated.
+    """
+    def __init__(self):
+        config = Config()
+        self.compose_tool = config["COMPOSE_TOOL"].split(" ")
+        self.cache_file: Path = config["CACHE_LOCATION"].with_name("cipug_capabilities.json")
+        self.tools: dict[str, Tool_Probe] = {}
+        self._compose_usable_in: set[Path] = set()  # folders where that was checked
+        self._lock = threading.Lock()
+
+    def _read_cache(self) -> dict[str, str]:
+        try:
+            cache = json.loads(self.cache_file.read_text())
+        except (OSError, ValueError):
+            return {}
+        return cache if isinstance(cache, dict) else {}
+
+    def _write_cache(self, cache: dict[str, str]):
+        tmp_path = self.cache_file.with_name(f".{self.cache_file.name}.{os.getpid()}.tmp")
+        try:
+            tmp_path.write_text(json.dumps(cache, sort_keys=True, indent=4))
+            os.replace(tmp_path, self.cache_file)
+        except OSError as e:
+            log.verbose(f"Could not write {self.cache_file}: {e}")
+
+    def probe(self, names: list[str]) -> dict[str, Tool_Probe]:
+        """Find the tools and their versions, in parallel for the ones that
+        aren't known from an earlier run"""
+        cache = self._read_cache()
+        keys: dict[str, str] = {}  # tool name -> cache key
+
+        def probe_one(name: str) -> Tool_Probe:
+            path = shutil.which(name)
+            if path is None:
+                return Tool_Probe(name, None, None)
+            key = f"{path}:{os.stat(path).st_mtime_ns}"
+            keys[name] = key
+            if key in cache:
+                return Tool_Probe(name, path, cache[key])
+            try:
+                out = subprocess.check_output([path, "--version"], stderr=subprocess.STDOUT)
+            except (OSError, subprocess.CalledProcessError):
+                return Tool_Probe(name, path, None)
+            return Tool_Probe(name, path, out.decode("utf-8").strip())
+
+        names = [name for name in dict.fromkeys(names) if name not in self.tools]
+        with ThreadPoolExecutor(max_workers=max(1, len(names))) as pool:
+            for tool in pool.map(probe_one, names):
+                self.tools[tool.name] = tool
+                if tool.ok:
+                    log.vverbose(f"Found tool: {tool.version}")
+
+        fresh = {
+            keys[tool.name]: tool.version for tool in self.tools.values()
+            if tool.ok and tool.name in keys and keys[tool.name] not in cache
+        }
+        if fresh:
+            cache.update(fresh)
+            self._write_cache(cache)
+        return self.tools
+
+    def compose_usable(self, folder: Path) -> bool:
+        """Whether we have the permission to use the compose tool in folder.
+        Only successful checks are remembered, such that a service that
+        failed (e.g. because of its permissions) is checked again the next
+        time, and other services are checked on their own."""
+        with self._lock:
+            if folder in self._compose_usable_in:
+                return True
+        try:
+            cp = subprocess.run(
+                self.compose_tool + ["ps"],
+                cwd=folder,
+                capture_output=True
+            )
+        except OSError as e:
+            log.error(f"Cannot use \"{' '.join(self.compose_tool)}\": {e}")
+            return False
+        if cp.returncode != 0:
+            log.raw(cp.stdout.decode() + cp.stderr.decode())
+            log.error(
+                f"Cannot use \"{' '.join(self.compose_tool)}\" (returncode {cp.returncode})"
+            )
+            return False
+        with self._lock:
+            self._compose_usable_in.add(folder)
+        return True
@@ -43,6 +43,8 @@ class Config(dict):
     _instance = None
     settings_schema = {
         "VERBOSITY": (1, int),
+        "LOG_FORMAT": ("text", Literally(["text", "json"])),
+        "LOG_COLOR": ("auto", Literally(["auto", "always", "never"])),
         "SERVICES_ROOT": (unset, Path),
         "SERVICES_FILTER": ("", str),
         "SERVICES_FILTER_EXCLUDE": ("", str),
@@ -50,17 +52,42 @@ class Config(dict):
         "CONTAINER_TOOL": ("podman", str),
         "SERVICE_STOP_START": ("true", Str2Bool),
         "STOP_START_METHOD": ("compose", Literally(["compose", "systemd-system", "systemd-user"])),
+        "HEALTH_CHECK": (False, Str2Bool),
+        "HEALTH_CHECK_TIMEOUT": (120, float),
+        "HEALTH_CHECK_INTERVAL": (2, float),
+        "HEALTH_CHECK_SETTLE": (10, float),
         "SERVICE_SNAPSHOT": ("true", Str2Bool),
+        "SNAPSHOT_BACKEND": ("snapper", Literally(["snapper", "btrfs"])),
+        "BTRFS_TOOL": ("btrfs", str),
+        "SNAPSHOT_CONCURRENCY": (4, int),
         "SERVICE_PULL": ("true", Str2Bool),
+        "UPDATE_CONCURRENCY": (1, int),
+        "UPDATE_STAGED": (False, Str2Bool),
+        "PULL_CONCURRENCY": (4, int),
+        "ESTIMATE_PULL_SIZE": (False, Str2Bool),
         "PRUNE_IMAGES": ("true", Str2Bool),
         "COMPOSE_FILE_NAME": ("compose.yml", str),
         "ENV_FILE_NAME": (".env", str),
         "CACHE_DURATION": (60*60, int),
         "CACHE_LOCATION": (Path(gettempdir()) / "cipug_cache.json", Path),
+        "CACHE_BACKEND": ("json", Literally(["json", "sqlite"])),
+        "CACHE_DB_LOCATION": (Path(gettempdir()) / "cipug_cache.sqlite", Path),
+        "RESOLVE_CONCURRENCY": (4, int),
+        "RESOLVER_BACKEND": ("native", Literally(["native", "skopeo"])),
+        "INSECURE_REGISTRIES": ("", str),
+        "REGISTRY_MULTI_SCOPE_TOKENS": (False, Str2Bool),
+        "RATE_LIMIT_RESERVE": (10, int),
+        "PIN_PLATFORM_DIGEST": (False, Str2Bool),
+        "FULL_CHECK": (False, Str2Bool),
         "SNAPSHOTS_DIR_SNAPPER": ("", str),
         "SNAPSHOTS_MAX_AGE_SNAPPER": (1.5, float),
         "SNAPSHOTS_DIR_BTRBK": ("", str),
         "SNAPSHOTS_MAX_AGE_BTRBK": (36, float),
+        "SNAPSHOTS_CHECK_CONCURRENCY": (8, int),
+        "METRICS_ADDRESS": ("127.0.0.1", str),
+        "METRICS_PORT": (9470, int),
+        "METRICS_INTERVAL": (60, float),
+        "DAEMON_MIN_INTERVAL": (60, float),
         "CONFIG_FILE": ("", str)
     }
     
@@ -70,6 +97,13 @@ class Config(dict):
             super(Config, cls._instance).__init__(*args, **kwargs)
         return cls._instance
 
+    @classmethod
+    def reload(cls) -> "Config":
+        """Read the environment and the config file again. Objects that
+        remembered the previous config need to be recreated."""
+        cls._instance = None
+        return cls()
+
     def _load_config_file(self):
         if self["CONFIG_FILE"] != "":
             config_path = Path(self["CONFIG_FILE"])
@@ -144,8 +178,10 @@ class Config(dict):
             if name == "CONFIG_FILE":
                 self._load_config_file()
 
-        # Special handling for verbosity: configure the logging
+        # Special handling for verbosity and log output: configure the logging
         log.verbosity = self["VERBOSITY"]
+        log.format = self["LOG_FORMAT"]
+        log.color = self["LOG_COLOR"]
 
         # Check if we have missing settings
         for name in self.settings_schema.keys():
@@ -157,7 +193,7 @@ class Config(dict):
                     exit_code=exit_code.VALUE_ERROR
                 )
 
-        log.verbose(f"Loaded cipug config: \n{'-'*10}\n{self}\n{'-'*10}")
+        log.verbose(lambda: f"Loaded cipug config: \n{'-'*10}\n{self}\n{'-'*10}")
 
     def __str__(self):
         return "\n".join([
@@ -0,0 +1,155 @@
+import signal
+import threading
+import time
+from pathlib import Path
+
+from .config import Config
+from .env import Env
+from .log import log
+from .registry import Image_Reference
+from .resolver import Image_Version_Resolver, Lookup_Deferred
+from .snapper import Snapshotter, make_snapshotter
+from .services import Service_Registry
+from .updater import Updater, tagged_images
+from .utils import check_dependencies
+
+class Daemon:
+    """Keeps running and polls the tags of the images in use, each on its own
+    schedule: an image is looked up again once its cache entry expired (but
+    not more often than DAEMON_MIN_INTERVAL), and later if its registry is
+    rate limiting us. Only services whose images resolved to a new digest are
+    updated. New services and changed tags are noticed through the service
+    registry (inotify), SIGHUP reloads the config and rescans the services.
+    """
+    def __init__(self):
+        self._wake = threading.Event()
+        self._reload = False
+        self._stop = False
+        self.next_poll: dict[str, float] = {}  # image name -> when to look it up next
+        self.images_by_service: dict[Path, set[str]] = {}
+        self._setup()
+
+    def _setup(self):
+        self.config = Config()
+        Service_Registry.reset()
+        self.registry = Service_Registry.shared()
+        if self.registry.watch():
+            self.registry.listeners.append(self._wake.set)
+        self.capabilities = check_dependencies()
+        self.resolver = Image_Version_Resolver()
+        self.snapper: Snapshotter | None = make_snapshotter() if self.config["SERVICE_SNAPSHOT"] else None
+        self.updater = Updater(resolver=self.resolver, snapper=self.snapper, capabilities=self.capabilities)
+        self.registry.take_changes()
+        self.images_by_service = {}
+        self._rescan(set(self.registry.services))
+
+    def _rescan(self, folders: set[Path]):
+        """Find out again which images the given services use. Images that
+        are new to us, or new to a service, are looked up right away, the
+        others keep their schedule."""
+        services = set(self.registry.services)
+        now = time.time()
+        for folder in folders:
+            images: set[str] = set()
+            env_file = folder / self.config["ENV_FILE_NAME"]
+            if folder in services and env_file.is_file():
+                images = set(tagged_images(Env(env_file)).values())
+            for image in images - self.images_by_service.get(folder, set()):
+                self.next_poll[image] = now
+            if images:
+                self.images_by_service[folder] = images
+            else:
+                self.images_by_service.pop(folder, None)
+        in_use = set().union(*self.images_by_service.values())
+        self.next_poll = {image: when for image, when in self.next_poll.items() if image in in_use}
+        log(f"Watching {len(in_use)} tagged images of {len(services)} services")
+
+    def _outdated_services(self, results: dict[str, str | Exception]) -> list[Path]:
+        """Services that have an image pinned which now resolves differently"""
+        outdated: list[Path] = []
+        for folder in self.registry.services:
+            env_file = folder / self.config["ENV_FILE_NAME"]
+            if not env_file.is_file():
+                continue
+            env = Env(env_file)
+            for entry_name, image in tagged_images(env).items():
+                result = results.get(image)
+                if isinstance(result, str) and env.get(f"SERVICE_{entry_name}_IMAGE_HASHED") != result:
+                    outdated.append(folder)
+                    break
+        return outdated
+
+    def poll(self, images: list[str]):
+        """Look up the given images and update the services that changed"""
+        self.resolver.start_round()
+        log.reset_timings()
+        results = self.resolver.resolve_image_versions(images)
+        now = time.time()
+        interval = max(self.config["CACHE_DURATION"], self.config["DAEMON_MIN_INTERVAL"])
+        for image, result in results.items():
+            next_poll = now + interval
+            if isinstance(result, Lookup_Deferred):
+                log.verbose(f"Deferred looking up {image}: {result}")
+            elif isinstance(result, Exception):
+                log.error(f"Failed to resolve {image}: {result}")
+            if self.config["RESOLVER_BACKEND"] == "native":
+                next_poll = max(next_poll, now + self.resolver.registry.backoff(Image_Reference(image).registry))
+            self.next_poll[image] = next_poll
+        log.verbose(f"Image resolutions: {self.resolver.summary()}")
+
+        outdated = self._outdated_services(results)
+        if outdated:
+            log(f"New images for {', '.join(folder.stem for folder in outdated)}", highlight=True)
+            try:
+                errors = self.updater.update_all_services(outdated)
+            finally:
+                self.resolver.flush()
+            log.timings_summary()
+            if errors:
+                log.error("Encountered errors during updating!")
+            else:
+                log("Updated services successfully")
+        else:
+            self.resolver.flush()
+
+    def _on_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self._reload = True
+        else:
+            self._stop = True
+        self._wake.set()
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._on_signal)
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        while not self._stop:
+            if self._reload:
+                self._reload = False
+                log("Reloading config and rescanning services..", highlight=True)
+                self.resolver.flush()
+                self.resolver.close()
+                Config.reload()
+                self._setup()
+            changed = self.registry.take_changes()
+            if changed:
+                self._rescan(changed)
+            now = time.time()
+            due = sorted(image for image, when in self.next_poll.items() if when <= now)
+            if due:
+                log.verbose(f"Polling {len(due)} images..")
+                try:
+                    self.poll(due)
+                except Exception as e:
+                    log.error(f"Polling failed: {e}")
+                    for image in due:
+                        self.next_poll[image] = time.time() + self.config["DAEMON_MIN_INTERVAL"]
+            if self.next_poll:
+                wait = max(0, min(self.next_poll.values()) - time.time())
+            else:
+                wait = self.config["DAEMON_MIN_INTERVAL"]
+            self._wake.wait(wait)
+            self._wake.clear()
+        log("Stopping")
+        self.resolver.flush()
+        self.resolver.close()
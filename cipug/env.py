@@ -1,51 +1,185 @@
 from pathlib import Path
 import copy
+import io
+import os
+import re
 
 from cipug.log import log
 
+# ${VAR}, ${VAR:-default} (default if unset or empty), ${VAR-default} (default if unset).
+# This matches up to the operator, defaults may contain references themselves
+# and are scanned for their closing brace separately.
+_reference_start = re.compile(r"\$\{([A-Za-z0-9_]+)(?:\}|(:?-))")
+
+
+def _closing_brace(value: str, pos: int) -> int | None:
+    """Where the reference whose default starts at pos ends (the index after
+    its closing brace), taking nested references into account"""
+    depth = 1
+    while pos < len(value):
+        if value.startswith("${", pos):
+            depth += 1
+            pos += 2
+            continue
+        if value[pos] == "}":
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+        pos += 1
+    return None
+
+
+class Interpolator:
+    """Resolves ${VAR} references in the values of an .env the way compose
+    does, including references within referenced values. Every value is
+    resolved at most once. References to unknown variables, and references
+    that (indirectly) refer to themselves, are kept as they are.
+    """
+    def __init__(self, variables: dict[str, str]):
+        self.variables = variables
+        self._resolved: dict[str, str] = {}
+        self._resolving: list[str] = []  # the chain of variables currently being resolved
+
+    def resolve(self, key: str) -> str:
+        """The value of the variable key, with all references resolved"""
+        if key not in self._resolved:
+            self._resolving.append(key)
+            try:
+                self._resolved[key] = self.interpolate(self.variables[key])
+            finally:
+                self._resolving.pop()
+        return self._resolved[key]
+
+    def interpolate(self, value: str) -> str:
+        """Resolve the references within value"""
+        if "${" not in value:
+            return value
+        parts: list[str] = []
+        idx = 0
+        while (start := value.find("${", idx)) != -1:
+            match = _reference_start.match(value, start)
+            if match is None:
+                # Not a reference, e.g. no valid variable name
+                parts.append(value[idx:start+2])
+                idx = start + 2
+                continue
+            name, operator = match.group(1), match.group(2)
+            end: int | None = match.end()
+            default = ""
+            if operator is not None:
+                end = _closing_brace(value, match.end())
+                if end is None:
+                    break  # unterminated, kept as it is
+                default = value[match.end():end-1]
+            parts.append(value[idx:start])
+            parts.append(self._replace(value[start:end], name, operator, default))
+            idx = end
+        parts.append(value[idx:])
+        return "".join(parts)
+
+    def _replace(self, reference: str, name: str, operator: str | None, default: str) -> str:
+        if name in self._resolving:
+            cycle = self._resolving[self._resolving.index(name):] + [name]
+            log.error(f"Cannot interpolate {reference}, it refers to itself: {' → '.join(cycle)}")
+            return reference
+        if name in self.variables:
+            value = self.resolve(name)
+            if operator == ":-" and value == "":
+                return self.interpolate(default)
+            return value
+        if operator is not None:
+            return self.interpolate(default)
+        return reference
+
+
 class Env(dict):
     """Handle .env files for compose. This includes:
         - loading .env file as dictionary
         - changing entries
         - knowing if any entries where changed
-        - writing back to disk
+        - writing back to disk, touching only the lines of changed entries
     """
     def __init__(self, path: Path):
         self.path = path  # Remember for writing back to disk
-        with open(path, "r") as f:
-            # .env file entries can be multiple lines, by adding \ before line ends.
-            # If we find such a line, use the following variable to remember which
-            # entry to append the next line to.
-            key_to_append_next_line_to = None
-            key = None
-            for line_ctr, line in enumerate(f):
-                line = line.rstrip("\n")
-                if key_to_append_next_line_to is None:
-                    # There was no \ at the end of the previous line -> new entry
-                    if line.strip() == "":  # Ignore empty lines
-                        continue
-                    if line.strip().startswith("#"):  # Ignore comments
-                        continue
-                    key, val = line.split("=", 1)
-                    self[key] = val
-                    if line[-1]=="\\":
-                        key_to_append_next_line_to = key
-                elif key is not None:
-                    # There was a \ at the end of the previous line
-                    # -> line belongs to previous key
-                    self[key] += "\n" + line
-                    if line[-1]!="\\":
-                        key_to_append_next_line_to = None
-                else:
-                    # There was a \ at the end of the previous line, but we don't
-                    # have a previous key where this line belongs to
-                    log.error(f"Cannot append line {line_ctr} of .env to previous line.")
+        with open(path, "r", newline="") as f:
+            self._parse(f.readlines())
 
         # Remember the the state of the .env on disk. This way we later know
         # whether we need to write updates back to disk
         self.diskstate = {key:copy.copy(val) for key, val in self.items()}
 
-        log.vverbose(f"Loaded environment file {path}: \n{'-'*10}\n{self}\n{'-'*10}")
+        log.vverbose(lambda: f"Loaded environment file {path}: \n{'-'*10}\n{self}\n{'-'*10}")
+
+    @staticmethod
+    def _entries(lines: list[str]) -> dict[str, tuple[str, int, int]]:
+        """Find the entries in the lines of an .env file, returns their values
+        and which lines they span (start, end exclusive). Comments and empty
+        lines are not part of any entry."""
+        entries: dict[str, tuple[str, int, int]] = {}
+        # .env file entries can be multiple lines, by adding \ before line ends.
+        # If we find such a line, use the following variable to remember which
+        # entry to append the next line to.
+        key_to_append_next_line_to = None
+        key = None
+        for line_ctr, line in enumerate(lines):
+            line = line.rstrip("\r\n")
+            if key_to_append_next_line_to is None:
+                # There was no \ at the end of the previous line -> new entry
+                if line.strip() == "":  # Ignore empty lines
+                    continue
+                if line.strip().startswith("#"):  # Ignore comments
+                    continue
+                key, val = line.split("=", 1)
+                entries[key] = (val, line_ctr, line_ctr+1)
+                if line.endswith("\\"):
+                    key_to_append_next_line_to = key
+            elif key is not None:
+                # There was a \ at the end of the previous line
+                # -> line belongs to previous key
+                val, start, _ = entries[key]
+                entries[key] = (val + "\n" + line, start, line_ctr+1)
+                if not line.endswith("\\"):
+                    key_to_append_next_line_to = None
+            else:
+                # There was a \ at the end of the previous line, but we don't
+                # have a previous key where this line belongs to
+                log.error(f"Cannot append line {line_ctr} of .env to previous line.")
+        return entries
+
+    def _parse(self, lines: list[str]):
+        self._lines = lines  # as they are on disk, including line endings
+        self.clear()
+        for key, (val, _, _) in self._entries(lines).items():
+            self[key] = val
+
+    # Changing entries invalidates what was interpolated so far
+    def __setitem__(self, key: str, val: str):
+        super().__setitem__(key, val)
+        self._interpolator = None
+
+    def __delitem__(self, key: str):
+        super().__delitem__(key)
+        self._interpolator = None
+
+    def clear(self):
+        super().clear()
+        self._interpolator = None
+
+    @property
+    def interpolator(self) -> Interpolator:
+        if getattr(self, "_interpolator", None) is None:
+            self._interpolator = Interpolator(self)
+        return self._interpolator
+
+    def tagged_images(self) -> dict[str, str]:
+        """Find the SERVICE_*_IMAGE_TAGGED entries, returns the entry names
+        (the * part) and their respective image names, interpolated"""
+        images: dict[str, str] = {}
+        for key in self.keys():
+            if key.startswith("SERVICE_") and key.endswith("_IMAGE_TAGGED"):
+                entry_name = key.removeprefix("SERVICE_").removesuffix("_IMAGE_TAGGED")
+                images[entry_name] = self.interpolator.resolve(key)
+        return images
 
     def has_changes(self):
         for key in self.keys():
@@ -58,15 +192,97 @@ class Env(dict):
                 return True
         return False
 
+    def _patched(self, lines: list[str]) -> list[str]:
+        """The lines with the entries we changed put in, everything else
+        (comments, empty lines, other entries) stays as it is"""
+        entries = self._entries(lines)
+        newline = "\r\n" if lines and lines[0].endswith("\r\n") else "\n"
+        replacements: dict[int, tuple[int, list[str]]] = {}  # start -> (end, new lines)
+        appended: list[str] = []
+        for key in set(self.keys()) | set(self.diskstate.keys()):
+            if self.get(key) == self.diskstate.get(key):
+                continue
+            new_lines = []
+            if key in self:
+                new_lines = [part + newline for part in f"{key}={self[key]}".split("\n")]
+            if key in entries:
+                _, start, end = entries[key]
+                ending = lines[end-1][len(lines[end-1].rstrip("\r\n")):]
+                if new_lines:
+                    # Keep the line ending of the last line, which may be none
+                    new_lines[-1] = new_lines[-1].rstrip("\r\n") + ending
+                replacements[start] = (end, new_lines)
+            elif new_lines:
+                appended += new_lines
+
+        patched: list[str] = []
+        idx = 0
+        while idx < len(lines):
+            if idx in replacements:
+                end, new_lines = replacements[idx]
+                patched += new_lines
+                idx = end
+            else:
+                patched.append(lines[idx])
+                idx += 1
+        if appended:
+            if patched and not patched[-1].endswith("\n"):
+                patched[-1] += newline
+            patched += appended
+        return patched
+
     def write(self, path: Path | None = None):
+        """Write the changed entries back to disk. The file as it is on disk
+        right now gets patched, such that comments and formatting stay. If
+        there is nothing to patch (e.g. a new file), all entries are written.
+        It's replaced atomically (temp file + rename), and not at all if
+        nothing changes."""
         if path is None:
             # No specific location set: write back to where we read it from
             path = self.path
-        with open(path, "w") as f:
-            f.write("\n".join([
-                f"{key}={val}" for key, val in self.items()
-            ]))
-            self.diskstate = {key:copy.copy(val) for key, val in self.items()}
+        try:
+            with open(path, "r", newline="") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+        old_content = "".join(lines)
+        if lines:
+            content = "".join(self._patched(lines))
+        else:
+            content = "".join(f"{key}={val}\n" for key, val in self.items())
+
+        if content != old_content:
+            # Keep permissions and owner, .env files may contain secrets. The
+            # temp file is created with them, before anything is written.
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            mode = 0o600 if stat is None else stat.st_mode & 0o7777
+            tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+            tmp_path.unlink(missing_ok=True)  # left over by a crashed run
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+            try:
+                with open(fd, "w", newline="") as f:
+                    f.write(content)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.chmod(tmp_path, mode)  # the umask may have taken bits away
+                if stat is not None:
+                    try:
+                        os.chown(tmp_path, stat.st_uid, stat.st_gid)
+                    except PermissionError:
+                        pass
+                os.replace(tmp_path, path)
+            except BaseException:
+                tmp_path.unlink(missing_ok=True)
+                raise
+        else:
+            log.vverbose(f"{path} is already up to date, not writing it")
+
+        if path == self.path:
+            self._parse(io.StringIO(content, newline="").readlines())
+        self.diskstate = {key:copy.copy(val) for key, val in self.items()}
 
     def __str__(self):
         return "\n".join([
@@ -28,6 +28,7 @@ UNKNOWN_FILE_FORMAT = Exit_Code(22)
 UNKOWN_DATA_STRUCTURE = Exit_Code(23)
 TYPE_ERROR = Exit_Code(24)
 VALUE_ERROR = Exit_Code(25)
+PLAN_ERROR = Exit_Code(26)
 
 
 TOOL_ERROR = Exit_Code(30)
@@ -35,5 +36,8 @@ SNAPSHOT_ERROR = Exit_Code(31)
 ENV_ERROR = Exit_Code(32)
 IMAGE_PULL_ERROR = Exit_Code(33)
 SERVICE_RESTART_ERROR = Exit_Code(34)
+RESOLVE_ERROR = Exit_Code(35)
+DEPENDENCY_ERROR = Exit_Code(36)
+SERVICE_UNHEALTHY = Exit_Code(37)
 
 SNAPSHOTS_NOK = Exit_Code(40)
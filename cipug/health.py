@@ -0,0 +1,99 @@
+import json
+import subprocess
+import time
+from pathlib import Path
+
+from .config import Config
+from .log import log
+
+
+class Health_Checker:
+    """Watches the containers of a service after it was (re)started, until
+    they are all healthy, or one of them fails. Containers with a healthcheck
+    need to report "healthy", containers without one need to keep running
+    for HEALTH_CHECK_SETTLE seconds without being restarted.
+    """
+    def __init__(self):
+        config = Config()
+        self.compose_tool = config["COMPOSE_TOOL"].split(" ")
+        self.container_tool = config["CONTAINER_TOOL"].split(" ")
+        self.timeout = config["HEALTH_CHECK_TIMEOUT"]
+        self.interval = config["HEALTH_CHECK_INTERVAL"]
+        self.settle = config["HEALTH_CHECK_SETTLE"]
+
+    def _container_ids(self, folder: Path) -> list[str]:
+        cp = subprocess.run(
+            self.compose_tool + ["ps", "-q"],
+            cwd=folder,
+            capture_output=True,
+            text=True
+        )
+        if cp.returncode != 0:
+            return []
+        return cp.stdout.split()
+
+    def _inspect(self, folder: Path, ids: list[str]) -> list[dict]:
+        cp = subprocess.run(
+            self.container_tool + ["inspect"] + ids,
+            cwd=folder,
+            capture_output=True,
+            text=True
+        )
+        if cp.returncode != 0:
+            return []
+        try:
+            return json.loads(cp.stdout)
+        except ValueError:
+            return []
+
+    def wait_until_healthy(self, folder: Path, svc_name: str) -> float | None:
+        """Returns how many seconds it took the service to become healthy,
+        or None if it didn't within the timeout"""
+        log(f"Waiting for service \"{svc_name}\" to become healthy..")
+        start = time.monotonic()
+        restart_counts: dict[str, int] = {}
+        running_since: float | None = None
+        while time.monotonic() - start <= self.timeout:
+            ids = self._container_ids(folder)
+            containers = self._inspect(folder, ids) if ids else []
+            now = time.monotonic()
+            all_running = bool(containers)
+            all_healthy = bool(containers)
+            without_healthcheck = False
+            for container in containers:
+                name = container.get("Name") or container.get("Id", "?")
+                state = container.get("State", {})
+                status = state.get("Status", "")
+                # docker calls it "Health", older podman versions "Healthcheck"
+                health = (state.get("Health") or state.get("Healthcheck") or {}).get("Status", "")
+                restarts = int(container.get("RestartCount", state.get("RestartCount", 0)) or 0)
+
+                if status == "exited" and state.get("ExitCode") == 0:
+                    continue  # one-shot containers, e.g. for migrations
+                if status in ["exited", "dead"] or health == "unhealthy":
+                    log.error(f"Container {name} of service \"{svc_name}\" is {health or status}")
+                    return None
+                if restarts > restart_counts.setdefault(name, restarts):
+                    log.error(f"Container {name} of service \"{svc_name}\" restarted")
+                    return None
+                if status != "running":
+                    all_running = False
+                if health == "":
+                    without_healthcheck = True
+                elif health != "healthy":  # still "starting"
+                    all_healthy = False
+
+            if all_running:
+                if running_since is None:
+                    running_since = now
+            else:
+                running_since = None
+            settled = running_since is not None and (
+                not without_healthcheck or now - running_since >= self.settle
+            )
+            if all_healthy and settled:
+                return now - start
+            time.sleep(self.interval)
+
+        log.error(f"Service \"{svc_name}\" did not become healthy within {self.timeout}s")
+        return None
@@ -1,23 +1,169 @@
+import json
+import os
+import re
 import sys
-from typing import NoReturn, overload
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, NoReturn, TextIO, overload
 
 from .colors import colors
 from .exit_code import Exit_Code, MULTIPLE_ERRORS
 
+# A message, or a function returning it for messages that are expensive to
+# build. The function is only called if the message is actually output.
+Message = str | Callable[[], str]
+
+_ansi_escape = re.compile(r"\033\[[0-9;]*m")
+
+# Phases of the work on a service, in the order of the timings summary
+PHASES = ["discover", "parse", "resolve", "estimate", "snapshot", "pull", "down", "up", "restart", "health"]
+
+
 class log():
     """Simple logging functionality, use:
     log("message") for normal output
     log.error("message", exit_code) for errors on stderr with optional exiting
     log.[v]verbose("message") for [very] verbose logs
+    with log.buffered(): ... to keep the output of a thread together
+    with log.span("phase", "service"): ... to time a phase, see timings_summary()
+    Messages can be passed as functions (e.g. lambdas), to only build them
+    when they are output. Output is text, colored when going to a terminal,
+    or json lines (LOG_FORMAT and LOG_COLOR).
     """
     verbosity=1 # default, gets overwritten in Config.load_from_env()
+    format = "text"  # or "json", gets overwritten in Config.load_from_env()
+    color = "auto"  # or "always"/"never", gets overwritten in Config.load_from_env()
+    stream: TextIO | None = None  # where normal output goes, stdout if None
+    _local = threading.local()  # per thread output buffer and context
+    _output_lock = threading.Lock()
+    _timings: dict[tuple[str | None, str], float] = {}  # (service, phase) -> seconds
+    _timings_lock = threading.Lock()
 
-    def __new__(cls, msg: str, verbosity: int = 1, highlight: bool = False):
+    def __new__(cls, msg: Message, verbosity: int = 1, highlight: bool = False):
         if cls.verbosity>=verbosity:
+            text = cls._text(msg)
             if highlight:
-                print(f"{colors.Yellow}{msg}{colors.Reset}")
-                return
-            print(msg)
+                text = f"{colors.Yellow}{text}{colors.Reset}"
+            cls._emit(text, "info" if verbosity <= 1 else "verbose")
+
+    @staticmethod
+    def _text(msg: Message) -> str:
+        return msg() if callable(msg) else msg
+
+    @classmethod
+    def _use_color(cls, file: TextIO) -> bool:
+        if cls.color != "auto":
+            return cls.color == "always"
+        if "NO_COLOR" in os.environ:
+            return False
+        isatty = getattr(file, "isatty", None)
+        return isatty is not None and isatty()
+
+    @classmethod
+    def _emit(cls, msg: str, level: str, file: TextIO | None = None, **fields):
+        """Format msg for the output and write it (or add it to the buffer)"""
+        file = file or cls.stream or sys.stdout
+        if cls.format == "json":
+            record = {"time": round(time.time(), 3), "level": level, "msg": _ansi_escape.sub("", msg)}
+            record.update(getattr(cls._local, "context", {}))
+            record.update(fields)
+            line = json.dumps(record, ensure_ascii=False)
+        elif cls._use_color(file):
+            line = msg
+        else:
+            line = _ansi_escape.sub("", msg)
+        buffer = getattr(cls._local, "buffer", None)
+        if buffer is not None:
+            buffer.append((line, file))
+            return
+        with cls._output_lock:
+            print(line, file=file)
+
+    @classmethod
+    def raw(cls, msg: str, file: TextIO | None = None):
+        """Output msg regardless of verbosity, e.g. for output of external tools"""
+        cls._emit(msg, "output", file)
+
+    @classmethod
+    def is_buffering(cls) -> bool:
+        return getattr(cls._local, "buffer", None) is not None
+
+    @classmethod
+    @contextmanager
+    def buffered(cls):
+        """Collect all output of the current thread and emit it as one block
+        at the end, such that work done in parallel doesn't interleave"""
+        cls._local.buffer = []
+        try:
+            yield
+        finally:
+            buffer, cls._local.buffer = cls._local.buffer, None
+            with cls._output_lock:
+                for line, file in buffer:
+                    print(line, file=file)
+                sys.stdout.flush()
+                sys.stderr.flush()
+
+    @classmethod
+    @contextmanager
+    def span(cls, phase: str, service: str | None = None) -> Iterator[None]:
+        """Time a phase of the work, optionally on a specific service. The
+        durations are summed up per service and phase. In json output, the
+        messages within get the phase and service as fields."""
+        previous = getattr(cls._local, "context", {})
+        context = {**previous, "phase": phase}
+        if service is not None:
+            context["service"] = service
+        cls._local.context = context
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            cls._local.context = previous
+            with cls._timings_lock:
+                key = (context.get("service"), phase)
+                cls._timings[key] = cls._timings.get(key, 0) + duration
+            cls.vverbose(lambda: f"{phase}{' of ' + context['service'] if 'service' in context else ''} took {duration:.2f}s")
+
+    @classmethod
+    def reset_timings(cls):
+        with cls._timings_lock:
+            cls._timings = {}
+
+    @classmethod
+    def timings_summary(cls):
+        """Output how long the phases took per service as a table (or as
+        one json line), and start over"""
+        with cls._timings_lock:
+            timings, cls._timings = cls._timings, {}
+        if not timings or cls.verbosity < 1:
+            return
+        phases = [phase for phase in PHASES if any(key[1] == phase for key in timings)]
+        phases += sorted({phase for _, phase in timings} - set(phases))
+        services = sorted({service for service, _ in timings}, key=lambda service: (service is not None, service or ""))
+        if cls.format == "json":
+            cls._emit("Time per phase", "info", timings={
+                service or "": {phase: round(seconds, 3) for (svc, phase), seconds in timings.items() if svc == service}
+                for service in services
+            })
+            return
+        rows = [["service"] + phases + ["total"]]
+        for service in services:
+            row = [service or "(all)"]
+            for phase in phases:
+                seconds = timings.get((service, phase))
+                row.append("-" if seconds is None else f"{seconds:.2f}")
+            row.append(f"{sum(seconds for (svc, _), seconds in timings.items() if svc == service):.2f}")
+            rows.append(row)
+        widths = [max(len(row[idx]) for row in rows) for idx in range(len(rows[0]))]
+        cls("Time per phase in seconds:")
+        for row in rows:
+            cls("  ".join(
+                cell.ljust(width) if idx == 0 else cell.rjust(width)
+                for idx, (cell, width) in enumerate(zip(row, widths))
+            ).rstrip())
 
     @classmethod
     @overload
@@ -31,12 +177,15 @@ class log():
 
     @classmethod
     def error(cls, msg: str, exit_code: Exit_Code | list[Exit_Code] |  None = None) -> NoReturn | None:
+        fields = {}
         if isinstance(exit_code, Exit_Code):
             msg = f"[{exit_code.code}={exit_code.name}] " + msg
+            fields["exit_code"] = exit_code.code
         elif isinstance(exit_code, list):
             msg = "[" + ",".join(f"{e.code}={e.name}" for e in exit_code) + "] " + msg
+            fields["exit_code"] = [e.code for e in exit_code]
 
-        print(f"{colors.Bold}{colors.Red}{msg}{colors.Reset}", file=sys.stderr)
+        cls._emit(f"{colors.Bold}{colors.Red}{msg}{colors.Reset}", "error", sys.stderr, **fields)
         if exit_code is not None:
             if isinstance(exit_code, list):
                 if len(set(exit_code)) == 1:
@@ -46,9 +195,11 @@ class log():
             sys.exit(exit_code.code)
 
     @classmethod
-    def verbose(cls, msg: str):
-        cls(f"{colors.Dim}{msg}{colors.Reset}", verbosity=2)
+    def verbose(cls, msg: Message):
+        if cls.verbosity >= 2:
+            cls._emit(f"{colors.Dim}{cls._text(msg)}{colors.Reset}", "verbose")
 
     @classmethod
-    def vverbose(cls, msg: str):
-        cls(f"{colors.Dim}{msg}{colors.Reset}", verbosity=3)
+    def vverbose(cls, msg: Message):
+        if cls.verbosity >= 3:
+            cls._emit(f"{colors.Dim}{cls._text(msg)}{colors.Reset}", "debug")
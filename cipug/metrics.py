@@ -0,0 +1,149 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .cache import open_cache_store
+from .config import Config
+from .env import Env
+from .log import log
+from .services import Service_Registry
+from .snapshots import Snapshot_Checker
+from .status import Update_Status
+from .updater import tagged_images
+from .utils import get_services
+
+
+def _labels(**labels: str) -> str:
+    """Format labels of a sample, escaped as the Prometheus text format wants it"""
+    def escape(val: str) -> str:
+        return val.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{key}="{escape(str(val))}"' for key, val in labels.items()) + "}"
+
+
+class Metrics_Collector:
+    """Gathers the state cipug knows about, in Prometheus' text format:
+    the age of the latest snapshots, whether the pinned images are the ones
+    their tags resolved to the last time (according to the resolver cache,
+    the registries are not asked) and how the last update of each service
+    went. Nothing is updated or resolved by this.
+    """
+    metrics = {
+        "cipug_snapshot_age_seconds": ("gauge", "Age of the latest snapshot of a service"),
+        "cipug_snapshot_max_age_seconds": ("gauge", "Configured maximum age of snapshots"),
+        "cipug_snapshot_present": ("gauge", "Whether there is any snapshot of a service"),
+        "cipug_image_up_to_date": ("gauge", "Whether the pinned image is the one its tag last resolved to"),
+        "cipug_image_resolved_timestamp_seconds": ("gauge", "When the tag of an image was last resolved"),
+        "cipug_last_run_timestamp_seconds": ("gauge", "When cipug last worked on a service"),
+        "cipug_last_run_success": ("gauge", "Whether the last run on a service went without errors"),
+        "cipug_last_run_exit_code": ("gauge", "Exit code of the last run on a service, 0 if successful"),
+        "cipug_last_update_timestamp_seconds": ("gauge", "When a service last got new images"),
+        "cipug_deferred": ("gauge", "Whether a service was put off to stay within registry rate limits"),
+        "cipug_collect_duration_seconds": ("gauge", "How long collecting these metrics took"),
+    }
+
+    def __init__(self):
+        self.config = Config()
+
+    def collect(self) -> str:
+        start = time.monotonic()
+        samples: dict[str, list[str]] = {name: [] for name in self.metrics}
+        now = time.time()
+
+        if self.config["SNAPSHOTS_DIR_SNAPPER"] or self.config["SNAPSHOTS_DIR_BTRBK"]:
+            for svc_name, snapshot_types in Snapshot_Checker().collect().items():
+                for kind, date, max_age in snapshot_types:
+                    labels = _labels(service=svc_name, kind=kind)
+                    samples["cipug_snapshot_present"].append(f"{labels} {int(date is not None)}")
+                    samples["cipug_snapshot_max_age_seconds"].append(f"{labels} {max_age*3600}")
+                    if date is not None:
+                        samples["cipug_snapshot_age_seconds"].append(f"{labels} {now - date.timestamp():.0f}")
+
+        cache = open_cache_store()
+        try:
+            for folder in get_services():
+                env_file = folder / self.config["ENV_FILE_NAME"]
+                if not env_file.is_file():
+                    continue
+                env = Env(env_file)
+                for entry_name, image_tagged in tagged_images(env).items():
+                    current = env.get(f"SERVICE_{entry_name}_IMAGE_HASHED", "")
+                    cached = cache.get(image_tagged)
+                    if cached is None:
+                        continue  # never resolved, so we can't tell
+                    # No digests as labels, each new one would be another time series
+                    labels = _labels(service=folder.stem, image=image_tagged)
+                    samples["cipug_image_up_to_date"].append(f"{labels} {int(current == cached['result'])}")
+                    samples["cipug_image_resolved_timestamp_seconds"].append(
+                        f"{labels} {float(cached['time']):.0f}"
+                    )
+        finally:
+            cache.close()
+
+        for svc_name, entry in sorted(Update_Status().read().items()):
+            labels = _labels(service=svc_name)
+            samples["cipug_deferred"].append(f"{labels} {int('deferred' in entry)}")
+            if "time" not in entry:
+                continue  # only deferred so far
+            samples["cipug_last_run_timestamp_seconds"].append(f"{labels} {entry['time']:.0f}")
+            samples["cipug_last_run_success"].append(f"{labels} {int(entry['exit_code'] == 0)}")
+            samples["cipug_last_run_exit_code"].append(f"{labels} {entry['exit_code']}")
+            if "updated" in entry:
+                samples["cipug_last_update_timestamp_seconds"].append(f"{labels} {entry['updated']:.0f}")
+
+        samples["cipug_collect_duration_seconds"].append(f" {time.monotonic() - start:.3f}")
+
+        lines: list[str] = []
+        for name, (kind, help_text) in self.metrics.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines += [name + sample for sample in samples[name]]
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics():
+    """Serve the metrics over http until interrupted. They are collected
+    every METRICS_INTERVAL seconds in the background, scrapes get the most
+    recent result."""
+    config = Config()
+    # Follow new and removed services, instead of searching for them on every collection
+    Service_Registry.shared().watch()
+    collector = Metrics_Collector()
+    lock = threading.Lock()
+    current = {"text": collector.collect()}
+
+    def refresh():
+        while True:
+            time.sleep(config["METRICS_INTERVAL"])
+            try:
+                text = collector.collect()
+            except Exception as e:
+                log.error(f"Failed to collect metrics: {e}")
+                continue
+            with lock:
+                current["text"] = text
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            log.vverbose(f"{self.address_string()} - {format % args}")
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ["/", "/metrics"]:
+                self.send_error(404)
+                return
+            with lock:
+                body = current["text"].encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((config["METRICS_ADDRESS"], config["METRICS_PORT"]), Handler)
+    threading.Thread(target=refresh, daemon=True).start()
+    log(f"Serving metrics on http://{config['METRICS_ADDRESS']}:{server.server_address[1]}/metrics")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,129 @@
+import json
+from datetime import datetime
+from pathlib import Path
+
+from .config import Config
+from .env import Env
+from .log import log
+from .updater import Pending_Update, Updater, tagged_images
+from . import exit_code
+
+PLAN_VERSION = 1
+
+
+def make_plan(updater: Updater) -> dict:
+    """Find out what an update would do, without touching any service: the
+    tagged images are resolved (through the cache) and for each service it
+    is noted which image references would change and which steps would be
+    taken. Such a plan can be applied later on by apply_plan()."""
+    config = Config()
+    pending_updates = updater.prepare_all()
+    estimate = bool(pending_updates) and config["SERVICE_PULL"] and config["ESTIMATE_PULL_SIZE"]
+    if estimate:
+        updater.estimate_downloads(pending_updates)
+    by_name = {pending.name: pending for pending in pending_updates}
+
+    services: dict[str, dict] = {}
+    for folder in updater.services:
+        name = folder.stem
+        entry: dict = {"folder": str(folder.resolve())}
+        pending = by_name.get(name)
+        if pending is not None:
+            entry["status"] = "update"
+            entry["images"] = {
+                entry_name: {
+                    "image": image,
+                    "current": pending.env.diskstate.get(f"SERVICE_{entry_name}_IMAGE_HASHED"),
+                    "new": pending.env[f"SERVICE_{entry_name}_IMAGE_HASHED"],
+                }
+                for entry_name, image in tagged_images(pending.env).items()
+                if image in pending.changes
+            }
+            entry["snapshot"] = bool(config["SERVICE_SNAPSHOT"])
+            entry["pull"] = bool(config["SERVICE_PULL"])
+            entry["restart"] = bool(config["SERVICE_STOP_START"])
+            if estimate:
+                entry["download_bytes"] = pending.download_size
+        elif updater.outcomes.get(name) is not None:
+            entry["status"] = "error"
+            entry["exit_code"] = updater.outcomes[name].code
+        elif name in updater.deferred:
+            # Not resolved to stay within rate limits, so it's unknown
+            entry["status"] = "deferred"
+        else:
+            entry["status"] = "up-to-date"
+        services[name] = entry
+
+    cost = {
+        "registry_requests": updater.resolver.registry_requests(),
+        "images_to_pull": sorted({
+            image for pending in pending_updates for image in pending.changes.values()
+        }) if config["SERVICE_PULL"] else [],
+    }
+    if estimate:
+        sizes = [updater.download_sizes[image] for image in cost["images_to_pull"]]
+        cost["download_bytes"] = None if None in sizes else sum(sizes)
+    return {
+        "version": PLAN_VERSION,
+        "created": datetime.now().astimezone().isoformat(timespec="seconds"),
+        "services": services,
+        "cost": cost,
+    }
+
+
+def _pending_from_plan(name: str, entry: dict) -> Pending_Update | exit_code.Exit_Code:
+    """Put the planned image references into the .env of a service, as long
+    as it still is the way it was when the plan was made"""
+    config = Config()
+    folder = Path(entry["folder"])
+    env_file = folder / config["ENV_FILE_NAME"]
+    if not env_file.is_file():
+        log.error(f"File {env_file} not found, cannot update service \"{name}\" as planned.")
+        return exit_code.FILE_NOT_FOUND
+    env = Env(env_file)
+    images = tagged_images(env)
+    changes: dict[str, str] = {}
+    for entry_name, planned in entry["images"].items():
+        key = f"SERVICE_{entry_name}_IMAGE_HASHED"
+        if images.get(entry_name) != planned["image"] or env.get(key) != planned["current"]:
+            log.error(
+                f"Cannot update service \"{name}\" as planned, because its "
+                f"{config['ENV_FILE_NAME']} changed since the plan was made ({entry_name})"
+            )
+            return exit_code.PLAN_ERROR
+        env[key] = planned["new"]
+        changes[planned["image"]] = planned["new"]
+        log(f"{entry_name}: {planned['image']} is now at {planned['new']} (planned)")
+    return Pending_Update(folder, env, changes)
+
+
+def apply_plan(updater: Updater, path: Path) -> list[exit_code.Exit_Code]:
+    """Apply a plan made by make_plan(), without resolving anything again.
+    Services whose .env changed in the meantime are left alone."""
+    try:
+        with open(path, "r") as f:
+            plan = json.load(f)
+        if plan.get("version") != PLAN_VERSION:
+            raise ValueError(f"unsupported version {plan.get('version')}")
+        services: dict[str, dict] = plan["services"]
+    except (OSError, ValueError, KeyError, AttributeError) as e:
+        log.error(f"Cannot read plan {path}: {e}", exit_code=exit_code.PLAN_ERROR)
+
+    log(f"Applying plan {path} (made {plan.get('created')})", highlight=True)
+    updater.start_run()
+    pending_updates: list[Pending_Update] = []
+    for name, entry in sorted(services.items()):
+        if entry.get("status") != "update":
+            continue
+        try:
+            prepared = _pending_from_plan(name, entry)
+        except (KeyError, TypeError) as e:
+            log.error(f"Cannot update service \"{name}\", its entry in the plan is invalid: {e}")
+            prepared = exit_code.PLAN_ERROR
+        if isinstance(prepared, Pending_Update):
+            pending_updates.append(prepared)
+        else:
+            updater.outcomes[name] = prepared
+    if not pending_updates and not updater.outcomes:
+        log("Nothing to do according to the plan")
+    return updater.apply_all(pending_updates)
@@ -0,0 +1,76 @@
+import threading
+import time
+
+
+def parse_rate_limit_header(value: str) -> tuple[int, float] | None:
+    """Interpret rate limit headers like "100;w=21600" (100 requests within
+    6 hours), returns the count and the window in seconds"""
+    count, _, params = value.partition(";")
+    window = 0.0
+    for param in params.split(";"):
+        key, _, val = param.strip().partition("=")
+        if key == "w":
+            try:
+                window = float(val)
+            except ValueError:
+                return None
+    try:
+        return int(count.strip()), window
+    except ValueError:
+        return None
+
+
+class Token_Bucket:
+    """Request budget of one registry. The registry tells how many requests
+    are left (and the size of the limit and its window), in between we count
+    the requests we make ourselves and assume the budget refills evenly over
+    the window.
+    """
+    def __init__(self, limit: int, window: float, remaining: int, now: float | None = None):
+        self.limit = limit
+        self.window = window
+        self.tokens = float(remaining)
+        self.updated = time.time() if now is None else now
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        """Tokens per second"""
+        return self.limit / self.window if self.window > 0 else 0
+
+    def _refill(self, now: float):
+        self.tokens = min(float(self.limit), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def sync(self, remaining: int, limit: int | None = None, window: float | None = None):
+        """Take over what the registry told"""
+        with self._lock:
+            if limit is not None:
+                self.limit = limit
+            if window:
+                self.window = window
+            self.tokens = float(remaining)
+            self.updated = time.time()
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill(time.time())
+            return self.tokens
+
+    def take(self, count: int = 1, keep: int = 0) -> bool:
+        """Use up count tokens, if there are that many (and keep more left)"""
+        with self._lock:
+            self._refill(time.time())
+            if self.tokens < count + keep:
+                return False
+            self.tokens -= count
+            return True
+
+    def time_until(self, count: float = 1) -> float:
+        """Seconds until count tokens are available"""
+        missing = count - self.available()
+        if missing <= 0:
+            return 0
+        if self.rate == 0:
+            return self.window
+        return missing / self.rate
@@ -0,0 +1,517 @@
+import hashlib
+import http.client
+import json
+import os
+import platform
+import re
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+from typing import Iterable
+
+from .log import log
+from .ratelimit import Token_Bucket, parse_rate_limit_header
+
+# What we accept as answer for a manifest request. Multi-arch images come as
+# index/list, single-arch images as plain manifest.
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+]
+
+INDEX_MEDIA_TYPES = MANIFEST_MEDIA_TYPES[:2]
+
+DOCKER_HUB = "docker.io"
+DOCKER_HUB_HOST = "registry-1.docker.io"
+# Docker Hub's dedicated repository for looking at the rate limit
+DOCKER_HUB_RATE_LIMIT_PROBE = "ratelimitpreview/test:latest"
+
+
+class Registry_Error(Exception):
+    pass
+
+
+class Rate_Limited(Registry_Error):
+    """The request was not sent, to stay within the rate limit of the registry"""
+    pass
+
+
+def registry_host(registry: str) -> str:
+    """Where to actually connect to for a registry"""
+    return DOCKER_HUB_HOST if registry == DOCKER_HUB else registry
+
+
+def local_platform() -> tuple[str, str]:
+    """The os and architecture images get pulled for on this host, named the
+    way image indexes name them"""
+    machine = platform.machine().lower()
+    architecture = {
+        "x86_64": "amd64", "amd64": "amd64",
+        "aarch64": "arm64", "arm64": "arm64",
+        "armv7l": "arm", "armv6l": "arm",
+        "i386": "386", "i686": "386",
+    }.get(machine, machine)
+    return "linux", architecture
+
+
+class Image_Reference:
+    """Split an image name like it is used in "image: ..." of a compose file
+    into registry, repository and tag/digest. Names get normalized the same way
+    skopeo and docker do it, e.g. "nextcloud" becomes
+    "docker.io/library/nextcloud:latest"."""
+    def __init__(self, name: str):
+        self.name = name
+        remainder, _, digest = name.partition("@")
+        self.digest: str | None = digest or None
+
+        # A tag is separated by the last colon, unless that colon belongs to
+        # a registry port (in which case a slash follows it)
+        self.tag: str | None = None
+        colon = remainder.rfind(":")
+        if colon > remainder.rfind("/"):
+            remainder, self.tag = remainder[:colon], remainder[colon+1:]
+        if self.tag is None and self.digest is None:
+            self.tag = "latest"
+
+        first, _, rest = remainder.partition("/")
+        if rest and ("." in first or ":" in first or first == "localhost"):
+            self.registry = first
+            self.repository = rest
+        else:
+            self.registry = DOCKER_HUB
+            self.repository = remainder
+        if self.registry == "index.docker.io":
+            self.registry = DOCKER_HUB
+        if self.registry == DOCKER_HUB and "/" not in self.repository:
+            self.repository = "library/" + self.repository
+
+    @property
+    def scope(self) -> str:
+        """Token scope needed to look up this image"""
+        return f"repository:{self.repository}:pull"
+
+    @property
+    def reference(self) -> str:
+        """Tag or digest as used in the manifest url"""
+        return self.digest or self.tag
+
+    @property
+    def repository_name(self) -> str:
+        """Fully qualified name without tag, like skopeo reports it as "Name" """
+        return f"{self.registry}/{self.repository}"
+
+    def __str__(self):
+        if self.digest:
+            return f"{self.repository_name}@{self.digest}"
+        return f"{self.repository_name}:{self.tag}"
+
+
+def _auth_file_candidates() -> list[Path]:
+    """Same lookup order for credentials as the containers tools (skopeo, podman) use"""
+    candidates = []
+    if "REGISTRY_AUTH_FILE" in os.environ:
+        candidates.append(Path(os.environ["REGISTRY_AUTH_FILE"]))
+    if "XDG_RUNTIME_DIR" in os.environ:
+        candidates.append(Path(os.environ["XDG_RUNTIME_DIR"]) / "containers" / "auth.json")
+    candidates.append(Path.home() / ".config" / "containers" / "auth.json")
+    candidates.append(Path.home() / ".docker" / "config.json")
+    return candidates
+
+
+def load_credentials() -> dict[str, str]:
+    """Read registry logins from the usual auth files, returns a mapping of
+    registry to base64 encoded "user:password". Credential helpers are not
+    supported, there's a warning if an auth file refers to them."""
+    credentials: dict[str, str] = {}
+    for candidate in reversed(_auth_file_candidates()):  # first one has priority
+        try:
+            auth_file = json.loads(candidate.read_text())
+            auths = auth_file.get("auths", {})
+        except (OSError, ValueError, AttributeError):
+            continue
+        helpers = set()
+        if isinstance(auth_file.get("credHelpers"), dict):
+            helpers.update(auth_file["credHelpers"].values())
+        if auth_file.get("credsStore"):
+            helpers.add(auth_file["credsStore"])
+        if helpers:
+            log(
+                f"{candidate} refers to credential helpers ({', '.join(sorted(map(str, helpers)))}), "
+                "which cipug doesn't support. Registries whose logins are only kept there "
+                "are accessed anonymously, with the rate limits that come with it."
+            )
+        for registry, entry in auths.items():
+            if isinstance(entry, dict) and entry.get("auth"):
+                registry = registry.removeprefix("https://").removeprefix("http://").split("/")[0]
+                if registry in ["index.docker.io", DOCKER_HUB_HOST]:
+                    registry = DOCKER_HUB
+                credentials[registry] = entry["auth"]
+    return credentials
+
+
+class Manifest_Head:
+    """What a registry told about a manifest without sending it. If the
+    manifest was not modified since the ETag we sent, there's no digest.
+    The media type is None if the registry didn't tell."""
+    def __init__(
+        self,
+        ref: Image_Reference,
+        digest: str | None,
+        etag: str | None,
+        not_modified: bool = False,
+        media_type: str | None = None
+    ):
+        self.ref = ref
+        self.digest = digest
+        self.etag = etag
+        self.not_modified = not_modified
+        self.media_type = media_type
+
+    @property
+    def is_index(self) -> bool | None:
+        """Whether the manifest is an image index (multi-arch image), None if unknown"""
+        if self.media_type is None:
+            return None
+        return self.media_type in INDEX_MEDIA_TYPES
+
+    @property
+    def result(self) -> str:
+        """Digest based reference, like skopeo would report it as Name@Digest"""
+        return f"{self.ref.repository_name}@{self.digest}"
+
+
+class Connection_Pool:
+    """Keeps idle keep-alive connections per (scheme, host), such that all
+    lookups of a run share them, no matter which thread does the lookup."""
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self._idle: dict[tuple[str, str], list[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, scheme: str, host: str, fresh: bool = False) -> http.client.HTTPConnection:
+        if not fresh:
+            with self._lock:
+                idle = self._idle.get((scheme, host))
+                if idle:
+                    return idle.pop()
+        cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return cls(host, timeout=self.timeout)
+
+    def release(self, scheme: str, host: str, connection: http.client.HTTPConnection):
+        with self._lock:
+            self._idle.setdefault((scheme, host), []).append(connection)
+
+    def close(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle = {}
+
+
+class Registry_Client:
+    """Minimal client for the OCI distribution API, just enough to find out
+    which digest a tag currently points to. It uses HEAD requests on the
+    manifest, which is cheaper than what skopeo inspect does (fetching the
+    manifest and the image config), keeps connections to registries alive and
+    caches authentication tokens until they expire.
+    """
+    # Docker Hub rejects overly long token urls, so multi-scope token
+    # requests are split in chunks of this size
+    max_scopes_per_token = 20
+
+    def __init__(self, insecure_registries: list[str] | None = None, timeout: float = 30):
+        self.insecure_registries = set(insecure_registries or [])
+        self.credentials = load_credentials()
+        self.pool = Connection_Pool(timeout)
+        # (registry, scope) -> (value for the Authorization header, expiry time)
+        self._tokens: dict[tuple[str, str], tuple[str, float]] = {}
+        # registry -> WWW-Authenticate challenge it answered with
+        self._challenges: dict[str, str] = {}
+        # registry -> request budget, as far as the registry reports its rate limit (Docker Hub does)
+        self.budgets: dict[str, Token_Bucket] = {}
+        # registry -> time until which it asked us to not send requests (429)
+        self.retry_after: dict[str, float] = {}
+        self.request_count = 0  # requests sent so far, including tokens and retries
+        self._lock = threading.Lock()
+
+    def close(self):
+        """Close the connections that are kept alive"""
+        self.pool.close()
+
+    def _request(
+        self,
+        method: str,
+        url: str,
+        headers: dict[str, str] | None = None
+    ) -> tuple[int, http.client.HTTPMessage, bytes]:
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+        for attempt in range(2):
+            connection = self.pool.acquire(parsed.scheme, parsed.netloc, fresh=attempt > 0)
+            with self._lock:
+                self.request_count += 1
+            try:
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                # The server may have closed the kept-alive connection in
+                # the meantime, retry once with a fresh one
+                connection.close()
+                if attempt:
+                    raise Registry_Error(f"{method} {url} failed: {e}") from e
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                self.pool.release(parsed.scheme, parsed.netloc, connection)
+            return response.status, response.headers, body
+        raise AssertionError("unreachable")
+
+    def _note_rate_limit(self, registry: str, status: int, headers: http.client.HTTPMessage):
+        """Remember what the registry tells about its rate limit, for example
+        "RateLimit-Remaining: 76;w=21600" (76 requests left within 6 hours)"""
+        remaining = parse_rate_limit_header(headers.get("RateLimit-Remaining", ""))
+        limit = parse_rate_limit_header(headers.get("RateLimit-Limit", ""))
+        if remaining is not None:
+            count, window = remaining
+            with self._lock:
+                budget = self.budgets.get(registry)
+                if budget is None:
+                    self.budgets[registry] = Token_Bucket(
+                        limit[0] if limit else max(count, 1),
+                        limit[1] if limit else window,
+                        count
+                    )
+                else:
+                    budget.sync(count, *(limit or (None, None)))
+        if status == 429:
+            try:
+                delay = float(headers.get("Retry-After", 60))
+            except ValueError:
+                delay = 60
+            with self._lock:
+                self.retry_after[registry] = time.time() + delay
+
+    def probe_rate_limit(self, registry: str):
+        """Find out the request budget of a registry, if it isn't known yet.
+        Only Docker Hub has a way to do that without using up a request."""
+        if registry != DOCKER_HUB or registry in self.budgets:
+            return
+        try:
+            self.head_manifest(Image_Reference(DOCKER_HUB_RATE_LIMIT_PROBE))
+        except Registry_Error as e:
+            log.vverbose(f"Could not probe the rate limit of {registry}: {e}")
+
+    def take_budget(self, registry: str, reserve: int = 0) -> bool:
+        """Account for fetching one manifest from the registry, False if we
+        should not send the request because the rate limit is used up (or only
+        the reserve is left). Only GET requests of manifests count as pulls,
+        HEAD requests don't use up the budget of Docker Hub."""
+        if self.backoff(registry) > 0:
+            return False
+        with self._lock:
+            budget = self.budgets.get(registry)
+        return budget is None or budget.take(keep=reserve)
+
+    def backoff(self, registry: str, pulls: bool = True) -> float:
+        """Seconds to wait before asking the registry again, 0 if there's no
+        reason to wait. Without pulls, only for requests that don't count
+        against the rate limit (HEAD requests)."""
+        with self._lock:
+            wait = self.retry_after.get(registry, 0) - time.time()
+            budget = self.budgets.get(registry)
+        if pulls and budget is not None:
+            wait = max(wait, budget.time_until(1))
+        return max(0, wait)
+
+    def _base_url(self, registry: str) -> str:
+        scheme = "http" if registry in self.insecure_registries else "https"
+        return f"{scheme}://{registry_host(registry)}"
+
+    def _cached_authorization(self, registry: str, scope: str) -> str | None:
+        with self._lock:
+            authorization, expiry = self._tokens.get((registry, scope), (None, 0))
+        if time.time() < expiry:
+            return authorization
+        return None
+
+    def _challenge(self, registry: str) -> str:
+        """The authentication challenge of a registry, probed if not known yet"""
+        with self._lock:
+            challenge = self._challenges.get(registry)
+        if challenge is None:
+            status, headers, _ = self._request("GET", f"{self._base_url(registry)}/v2/")
+            challenge = headers.get("WWW-Authenticate", "") if status == 401 else ""
+            with self._lock:
+                self._challenges[registry] = challenge
+        return challenge
+
+    def _fetch_token(self, registry: str, scopes: list[str], challenge: str) -> str:
+        scheme, _, params = challenge.partition(" ")
+        if scheme.lower() == "basic":
+            if registry not in self.credentials:
+                raise Registry_Error(f"{registry} requires a login")
+            return "Basic " + self.credentials[registry]
+        if scheme.lower() != "bearer":
+            raise Registry_Error(f"Unsupported authentication scheme {scheme} of {registry}")
+
+        fields = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        if "realm" not in fields:
+            raise Registry_Error(f"No token realm in authentication challenge of {registry}")
+        query = [("scope", scope) for scope in scopes]
+        if "service" in fields:
+            query.append(("service", fields["service"]))
+        headers = {}
+        if registry in self.credentials:
+            headers["Authorization"] = "Basic " + self.credentials[registry]
+        requested = time.time()
+        status, _, body = self._request(
+            "GET",
+            fields["realm"] + "?" + urllib.parse.urlencode(query),
+            headers
+        )
+        if status != 200:
+            raise Registry_Error(f"Getting a token for {', '.join(scopes)} at {registry} failed with status {status}")
+        answer = json.loads(body)
+        token = answer.get("token") or answer.get("access_token")
+        if not token:
+            raise Registry_Error(f"Token response of {registry} did not contain a token")
+
+        # Tokens are valid for 60s if the registry doesn't tell otherwise. Keep
+        # a safety margin, such that tokens don't expire while being used.
+        expiry = requested + max(0, int(answer.get("expires_in", 60)) - 10)
+        with self._lock:
+            for scope in scopes:
+                self._tokens[(registry, scope)] = ("Bearer " + token, expiry)
+        log.vverbose(f"Got token for {len(scopes)} repositories at {registry}")
+        return "Bearer " + token
+
+    def prefetch_tokens(self, names: Iterable[str]):
+        """Get the tokens for many repositories with as few token exchanges as
+        possible, by requesting multiple scopes at once per registry. Lookups
+        of these images can then go straight to the manifest."""
+        scopes_by_registry: dict[str, set[str]] = {}
+        for name in names:
+            ref = Image_Reference(name)
+            if self._cached_authorization(ref.registry, ref.scope) is None:
+                scopes_by_registry.setdefault(ref.registry, set()).add(ref.scope)
+
+        for registry, scopes in scopes_by_registry.items():
+            scopes = sorted(scopes)
+            try:
+                challenge = self._challenge(registry)
+                if not challenge.lower().startswith("bearer"):
+                    continue
+                for idx in range(0, len(scopes), self.max_scopes_per_token):
+                    self._fetch_token(registry, scopes[idx:idx+self.max_scopes_per_token], challenge)
+            except Registry_Error as e:
+                # Not fatal, the lookups will ask for their tokens individually
+                log.vverbose(f"Could not prefetch tokens for {registry}: {e}")
+
+    def _authorized_request(
+        self,
+        method: str,
+        ref: Image_Reference,
+        url: str,
+        headers: dict[str, str]
+    ) -> tuple[int, http.client.HTTPMessage, bytes]:
+        """Request with the token for the repository of ref, fetching one if
+        the registry asks for it"""
+        authorization = self._cached_authorization(ref.registry, ref.scope)
+        if authorization is not None:
+            headers["Authorization"] = authorization
+        status, response_headers, body = self._request(method, url, headers)
+        if status == 401:
+            # No token yet, or the registry didn't accept it anymore
+            challenge = response_headers.get("WWW-Authenticate", "")
+            with self._lock:
+                self._challenges[ref.registry] = challenge
+            headers["Authorization"] = self._fetch_token(ref.registry, [ref.scope], challenge)
+            status, response_headers, body = self._request(method, url, headers)
+        self._note_rate_limit(ref.registry, status, response_headers)
+        return status, response_headers, body
+
+    def head_manifest(self, ref: Image_Reference, etag: str | None = None) -> Manifest_Head:
+        """Ask the registry which manifest the reference points to. If the ETag
+        of a previous answer is passed, the registry may answer with "not
+        modified" instead, which Docker Hub doesn't count as a pull."""
+        url = f"{self._base_url(ref.registry)}/v2/{ref.repository}/manifests/{ref.reference}"
+        headers = {"Accept": ", ".join(MANIFEST_MEDIA_TYPES)}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        status, response_headers, _ = self._authorized_request("HEAD", ref, url, headers)
+        if status == 429:
+            raise Registry_Error(f"Looking up {ref} failed, {ref.registry} is rate limiting us")
+        if status == 304:
+            return Manifest_Head(ref, None, response_headers.get("ETag", etag), not_modified=True)
+        if status != 200:
+            raise Registry_Error(f"Looking up {ref} failed with status {status}")
+
+        digest = response_headers.get("Docker-Content-Digest")
+        if digest is None:
+            # Not all registries send the digest on HEAD requests, in that
+            # case we need the manifest itself to compute it
+            log.vverbose(f"{ref.registry} did not tell the digest of {ref}, fetching manifest")
+            headers.pop("If-None-Match", None)
+            if not self.take_budget(ref.registry):
+                raise Rate_Limited(f"Not fetching the manifest of {ref}, the rate limit of {ref.registry} is used up")
+            status, _, body = self._request("GET", url, headers)
+            if status != 200:
+                raise Registry_Error(f"Fetching manifest of {ref} failed with status {status}")
+            digest = "sha256:" + hashlib.sha256(body).hexdigest()
+        content_type = response_headers.get("Content-Type")
+        return Manifest_Head(
+            ref, digest, response_headers.get("ETag"),
+            media_type=content_type.split(";")[0].strip() if content_type else None
+        )
+
+    def get_manifest(self, ref: Image_Reference) -> dict:
+        """Fetch the manifest (or index) the reference points to"""
+        url = f"{self._base_url(ref.registry)}/v2/{ref.repository}/manifests/{ref.reference}"
+        headers = {"Accept": ", ".join(MANIFEST_MEDIA_TYPES)}
+        status, response_headers, body = self._authorized_request("GET", ref, url, headers)
+        if status == 429:
+            raise Registry_Error(f"Fetching manifest of {ref} failed, {ref.registry} is rate limiting us")
+        if status != 200:
+            raise Registry_Error(f"Fetching manifest of {ref} failed with status {status}")
+        try:
+            manifest = json.loads(body)
+        except ValueError as e:
+            raise Registry_Error(f"Manifest of {ref} is not valid json: {e}") from e
+        if "mediaType" not in manifest:
+            manifest["mediaType"] = response_headers.get_content_type()
+        return manifest
+
+    def _budgeted_manifest(self, ref: Image_Reference, reserve: int) -> dict:
+        if not self.take_budget(ref.registry, reserve):
+            raise Rate_Limited(f"Not fetching the manifest of {ref}, the rate limit of {ref.registry} is used up")
+        return self.get_manifest(ref)
+
+    def image_layers(
+        self,
+        ref: Image_Reference,
+        platform: tuple[str, str] | None = None,
+        reserve: int = 0
+    ) -> dict[str, int]:
+        """The layers (digest -> compressed size) of an image. For multi-arch
+        images, those of the platform (os, architecture) of this host. Each
+        manifest fetched is taken from the budget of the registry, keeping
+        reserve requests; Rate_Limited is raised if that's used up."""
+        manifest = self._budgeted_manifest(ref, reserve)
+        if manifest["mediaType"] in INDEX_MEDIA_TYPES or "manifests" in manifest:
+            os_name, architecture = platform or local_platform()
+            for child in manifest.get("manifests", []):
+                child_platform = child.get("platform", {})
+                if child_platform.get("os") == os_name and child_platform.get("architecture") == architecture:
+                    manifest = self._budgeted_manifest(
+                        Image_Reference(f"{ref.repository_name}@{child['digest']}"), reserve
+                    )
+                    break
+            else:
+                raise Registry_Error(f"{ref} has no image for {os_name}/{architecture}")
+        return {layer["digest"]: int(layer.get("size", 0)) for layer in manifest.get("layers", [])}
@@ -1,63 +1,385 @@
+import hashlib
 import json
 import time
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable
 
 from .log import log
 from .config import Config
+from .registry import Image_Reference, Rate_Limited, Registry_Client, Registry_Error, local_platform
+from .cache import Json_Cache_Store, Sqlite_Cache_Store, open_cache_store
+
+class Lookup_Deferred(Registry_Error):
+    """The lookup was not done, to stay within the rate limit of the registry"""
+    pass
+
 
 class Image_Version_Resolver():
-    """Uses skopeo to resolve container tags like ":latest" to their respective
-    hashed tag. It also caches results to not hit docker-hubs restrictive
-    rate limit so quickly."""
+    """Resolves container tags like ":latest" to their respective hashed tag,
+    either by asking the registry directly or by using skopeo. It also caches
+    results to not hit docker-hubs restrictive rate limit so quickly."""
 
     def __init__(self):
         config = Config()
         self.cache_file = config["CACHE_LOCATION"]
         self.cache_duration = config["CACHE_DURATION"]
-        self.cache = {}
+        self.concurrency = max(1, config["RESOLVE_CONCURRENCY"])
+        self.backend = config["RESOLVER_BACKEND"]
+        self.multi_scope_tokens = config["REGISTRY_MULTI_SCOPE_TOKENS"]
+        self.rate_limit_reserve = config["RATE_LIMIT_RESERVE"]
+        self.pin_platform_digest = config["PIN_PLATFORM_DIGEST"]
+        self.registry = Registry_Client(
+            insecure_registries=[
+                entry.strip() for entry in config["INSECURE_REGISTRIES"].split(",") if entry.strip()
+            ]
+        )
+        # Failed lookups of this run, such that services sharing the
+        # same image do not retry it one after another
+        self.failures: dict[str, Exception] = {}
+        # How each image was resolved the first time in this run:
+        # "hit", "revalidated" or "miss"
+        self.outcomes: dict[str, str] = {}
+        # Lookups that were put off to stay within rate limits: name -> registry
+        self.deferred: dict[str, str] = {}
+        # Layers (digest -> size) per digest reference, those never change
+        self.layers: dict[str, dict[str, int] | None] = {}
+        # Child digests per platform of image indexes, per digest reference
+        self.indexes: dict[str, dict[str, str] | None] = {}
+        self._lock = threading.Lock()
+        self.cache: Json_Cache_Store | Sqlite_Cache_Store = open_cache_store()
+        self.cache_file = self.cache.path
         log.vverbose(f"Image-Version-Resolver cache file is set to {self.cache_file}")
-        if self.cache_file.is_file():
-            # A cache file exists already
-            self.cache = json.loads(self.cache_file.read_text())
 
-    def write_cache(self):
-        self.cache_file.write_text(
-            json.dumps(self.cache, sort_keys=True, indent=4)
+    def start_round(self):
+        """Forget what was resolved so far, such that the next lookups go to
+        the cache and registries again (for long running processes)"""
+        with self._lock:
+            self.failures = {}
+            self.outcomes = {}
+            self.deferred = {}
+
+    def flush(self):
+        """Write the results of this run to the cache file"""
+        self.cache.flush()
+
+    def close(self):
+        """Release the cache and the connections to registries, the resolver
+        cannot be used afterwards"""
+        self.registry.close()
+        self.cache.close()
+
+    def record_applied(self, images: dict[str, str], service: str):
+        """Remember which resolutions (tagged image name -> digest reference)
+        were put to use by a service"""
+        for name, result in images.items():
+            self.cache.record_applied(name, result, service)
+
+    def service_fingerprint(self, folder: Path) -> dict | None:
+        """What was stored about a service the last time it was up to date"""
+        return self.cache.get_service(str(folder))
+
+    def remember_service(self, folder: Path, fingerprint: dict | None):
+        """Store the fingerprint of a service, or forget it with None"""
+        self.cache.put_service(str(folder), fingerprint)
+
+    def evict_unreferenced(self, names: set[str]):
+        """Forget about images that are not in use anymore"""
+        self.cache.evict(names)
+
+    def resolve_image_versions(self, names: Iterable[str]) -> dict[str, str | Exception]:
+        """Resolve many images in parallel. Identical names are looked up only
+        once. Failures don't abort the batch, they are returned in place of the
+        result (and raised again when resolving that name individually)."""
+        unique_names = sorted(set(names))
+        if self.backend == "native":
+            uncached = self._plan_lookups(
+                [name for name in unique_names if self._cached_result(name) is None]
+            )
+            if self.multi_scope_tokens:
+                self.registry.prefetch_tokens(uncached)
+            # The cached ones first (they are quick), then the lookups by priority
+            unique_names = [name for name in unique_names if name not in set(uncached)] + uncached
+
+        def resolve(name: str) -> str | Exception:
+            try:
+                return self.resolve_image_version(name)
+            except Exception as e:
+                log.vverbose(f"Failed to resolve {name}: {e}")
+                with self._lock:
+                    self.failures[name] = e
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return dict(zip(unique_names, pool.map(resolve, unique_names)))
+
+    def _defer(self, name: str, registry: str):
+        with self._lock:
+            self.deferred[name] = registry
+            self.failures[name] = Lookup_Deferred(
+                f"Looking up {name} was deferred, the rate limit of {registry} is used up"
+            )
+
+    def _plan_lookups(self, names: list[str]) -> list[str]:
+        """Order the lookups such that the images whose cache entries are the
+        oldest (or missing) go first. Looking up a tag is a HEAD request, which
+        doesn't count against rate limits like the one of Docker Hub. Fetching
+        a manifest does (needed for image indexes), those requests are taken
+        from the budget of the registry as they happen, keeping
+        RATE_LIMIT_RESERVE requests for pulling the new images. Lookups that
+        don't fit anymore are deferred to the next run."""
+        for registry in sorted({Image_Reference(name).registry for name in names}):
+            self.registry.probe_rate_limit(registry)
+        return sorted(names, key=lambda name: float((self.cache.get(name) or {}).get("time", 0)))
+
+    def _lookup_skopeo(self, name: str) -> str:
+        # The digest is the one of the raw manifest (or index), which tells
+        # the platforms as well, such that skopeo is asked only once
+        raw = subprocess.check_output(["skopeo", "inspect", "--raw", "docker://"+name])
+        result = f"{Image_Reference(name).repository_name}@sha256:{hashlib.sha256(raw).hexdigest()}"
+        platforms = self._platforms(json.loads(raw))
+        with self._lock:
+            self.indexes[result] = platforms
+        return result
+
+    def _layers_skopeo(self, name: str) -> dict[str, int]:
+        info = json.loads(
+            subprocess.check_output(["skopeo", "inspect", "--no-tags", "docker://"+name])
         )
+        return {layer["Digest"]: int(layer["Size"]) for layer in info.get("LayersData") or []}
+
+    def image_layers(self, names: Iterable[str]) -> dict[str, dict[str, int] | None]:
+        """Find out the layers (digest -> compressed size) of images given by
+        digest references, in parallel. None for images where that failed, or
+        where it would exceed the rate limit of the registry."""
+        def layers(name: str) -> dict[str, int] | None:
+            with self._lock:
+                if name in self.layers:
+                    return self.layers[name]
+            try:
+                if self.backend == "skopeo":
+                    result = self._layers_skopeo(name)
+                else:
+                    result = self.registry.image_layers(
+                        Image_Reference(name), reserve=self.rate_limit_reserve
+                    )
+            except Rate_Limited as e:
+                log.vverbose(str(e))
+                return None  # not remembered, the budget refills
+            except Exception as e:
+                log.vverbose(f"Could not find out the layers of {name}: {e}")
+                result = None
+            with self._lock:
+                self.layers[name] = result
+            return result
+
+        unique_names = sorted(set(names))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return dict(zip(unique_names, pool.map(layers, unique_names)))
+
+    @staticmethod
+    def _platforms(manifest: dict) -> dict[str, str]:
+        """The digests per platform listed in an image index, empty for the
+        manifest of a single-arch image"""
+        return {
+            "/".join(filter(None, [
+                child["platform"].get("os"),
+                child["platform"].get("architecture"),
+                child["platform"].get("variant"),
+            ])): child["digest"]
+            for child in manifest.get("manifests", []) if "platform" in child
+        }
+
+    def _platform_digests(self, name: str) -> dict[str, str] | None:
+        """The digests of the images per platform ("os/architecture[/variant]")
+        of a multi-arch image given by digest reference, empty for single-arch
+        images. None if that could not be found out. Raises Lookup_Deferred if
+        fetching the index would exceed the rate limit of the registry."""
+        with self._lock:
+            if name in self.indexes:
+                return self.indexes[name]
+        try:
+            if self.backend == "skopeo":
+                manifest = json.loads(
+                    subprocess.check_output(["skopeo", "inspect", "--raw", "docker://"+name])
+                )
+            else:
+                ref = Image_Reference(name)
+                if not self.registry.take_budget(ref.registry, self.rate_limit_reserve):
+                    raise Lookup_Deferred(f"the rate limit of {ref.registry} is used up")
+                manifest = self.registry.get_manifest(ref)
+        except Lookup_Deferred:
+            raise
+        except Exception as e:
+            log.vverbose(f"Could not fetch the image index {name}: {e}")
+            return None  # not remembered, it may work the next time
+        platforms = self._platforms(manifest)
+        with self._lock:
+            self.indexes[name] = platforms
+        return platforms
+
+    @staticmethod
+    def _local_digest(platforms: dict[str, str] | None) -> str | None:
+        """The digest of the image for the platform of this host"""
+        os_name, architecture = local_platform()
+        for platform, digest in (platforms or {}).items():
+            if platform.split("/")[:2] == [os_name, architecture]:
+                return digest
+        return None
+
+    def _platform_result(self, name: str, result: str, entry: dict) -> tuple[str, dict]:
+        """Decide what to pin, given that the tag points to result. For
+        multi-arch images, the previous result is kept if only the images of
+        other platforms changed. With PIN_PLATFORM_DIGEST, the image of the
+        platform of this host is pinned instead of the index. Returns the
+        result and what to remember about the index in the cache entry."""
+        repository, _, index_digest = result.rpartition("@")
+        previous = entry.get("result")
+        if "platforms" in entry and index_digest == entry.get("index_digest"):
+            # The tag still points to the index we saw the last time
+            index_info = {key: entry[key] for key in ["index_digest", "platforms"]}
+            local_digest = self._local_digest(entry["platforms"])
+            if local_digest is not None:
+                if self.pin_platform_digest:
+                    return f"{repository}@{local_digest}", index_info
+                if previous == f"{repository}@{local_digest}":
+                    return result, index_info  # PIN_PLATFORM_DIGEST was switched off
+            return previous, index_info
+
+        platforms = self._platform_digests(result)
+        if platforms is None:
+            return result, {}  # try again the next time
+        index_info = {"index_digest": index_digest, "platforms": platforms}
+        local_digest = self._local_digest(platforms)
+        if local_digest is None:
+            return result, index_info  # single-arch image
+        if self.pin_platform_digest:
+            return f"{repository}@{local_digest}", index_info
+        if previous is None or previous in [result, f"{repository}@{local_digest}"]:
+            return result, index_info
+        if "platforms" in entry:
+            # Our platform's image of the last index is the one of the previous result
+            previous_platforms = entry["platforms"]
+        else:
+            previous_platforms = self._platform_digests(previous)
+        if self._local_digest(previous_platforms) == local_digest:
+            log.verbose(
+                f"{name} points to a new image index, but the image for "
+                f"{'/'.join(local_platform())} didn't change, keeping {previous}"
+            )
+            return previous, index_info
+        return result, index_info
+
+    def _cached_result(self, name: str) -> str | None:
+        """Result from the cache, if there is a complete and young enough entry"""
+        entry = self.cache.get(name) or {}
+        if ("time" in entry) and ("result" in entry):
+            age = time.time()-float(entry["time"])
+            if age <= self.cache_duration:
+                log.vverbose(
+                    f"Resolved {name} to {entry['result']} (cached {int(age)}s ago)"
+                )
+                return entry["result"]
+            log.vverbose(f"Cache entry for {name} expired")
+        return None
 
     def resolve_image_version(self, name: str):
         # name is what gets plugged into "image: ..." in a compose file,
         # for example: "ghcr.io/paperless-ngx/paperless-ngx:latest"
+        if name in self.failures:
+            raise self.failures[name]
+        with self._lock:
+            if name in self.outcomes:
+                # Already resolved in this run, no matter how old the entry is
+                return self.cache.get(name)["result"]
+        result = self._cached_result(name)
+        if result is not None:
+            with self._lock:
+                self.outcomes.setdefault(name, "hit")
+            return result
         current_time = time.time()
-        if name in self.cache:
-            # There's a chache entry
-            if ("time" in self.cache[name]) and ("result" in self.cache[name]):
-                # That is complete
-                age = current_time-float(self.cache[name]["time"])
-                if age <= self.cache_duration:
-                    # And young enough -> use it
-                    result = self.cache[name]["result"]
-                    log.vverbose(
-                        f"Resolved {name} to {result} (cached {int(age)}s ago)"
-                    )
-                    return result
-                else:
-                    log.vverbose(f"Cache entry for {name} expired")
+        entry = self.cache.get(name) or {}
 
         # If there's no cache entry, or it is incomplete, or too old:
-        info = json.loads(
-            subprocess.check_output(["skopeo", "inspect", "--no-tags", "docker://"+name])
-        )
-        result = f'{info["Name"]}@{info["Digest"]}'
+        etag = None
+        if self.backend == "skopeo":
+            result = self._lookup_skopeo(name)
+            outcome = "miss"
+        else:
+            ref = Image_Reference(name)
+            if self.registry.backoff(ref.registry, pulls=False) > 0:
+                # The registry answered with 429 before, e.g. because of other clients
+                self._defer(name, ref.registry)
+                raise self.failures[name]
+            # An expired entry can be revalidated: if the registry tells that
+            # the manifest wasn't modified, the previous result still holds
+            head = self.registry.head_manifest(
+                ref,
+                etag=entry.get("etag") if "result" in entry else None
+            )
+            etag = head.etag
+            if head.not_modified:
+                result = entry["result"]
+                outcome = "revalidated"
+            else:
+                result = head.result
+                outcome = "miss"
+                if head.is_index is False:
+                    # Single-arch, no need to fetch the manifest to find its platforms
+                    with self._lock:
+                        self.indexes[result] = {}
+
+        index_info: dict = {}
+        try:
+            if outcome == "miss":
+                result, index_info = self._platform_result(name, result, entry)
+            elif "platforms" in entry:
+                # Still the same index, but PIN_PLATFORM_DIGEST may have been switched
+                index = f"{result.rpartition('@')[0]}@{entry['index_digest']}"
+                result, index_info = self._platform_result(name, index, entry)
+        except Lookup_Deferred:
+            self._defer(name, Image_Reference(name).registry)
+            raise self.failures[name]
 
         # Populate the cache
-        if name not in self.cache:
-            self.cache[name] = {}
-        self.cache[name]["time"] = current_time
-        self.cache[name]["result"] = result
-        self.write_cache()
+        entry = {
+            "time": current_time,
+            "result": result,
+            "digest": result.rpartition("@")[2],
+            **index_info,
+        }
+        if etag is not None:
+            entry["etag"] = etag
+        self.cache.put(name, entry)
+        with self._lock:
+            self.outcomes.setdefault(name, outcome)
 
+        if outcome == "revalidated":
+            log.vverbose(f"Resolved {name} to {result} (revalidated cache entry)")
+            return result
         log.vverbose(f"Resolved {name} to {result} (by looking up remote)")
         # The result will look something like:
         # "ghcr.io/paperless-ngx/paperless-ngx@sha256:1a603fd...."
         return result
+
+    def registry_requests(self) -> int:
+        """How many requests were sent to registries so far (for skopeo, how
+        many images were looked up)"""
+        if self.backend == "skopeo":
+            return list(self.outcomes.values()).count("miss")
+        return self.registry.request_count
+
+    def summary(self) -> str:
+        counts = {
+            outcome: list(self.outcomes.values()).count(outcome)
+            for outcome in ["hit", "revalidated", "miss"]
+        }
+        summary = (
+            f"{counts['hit']} from cache, {counts['revalidated']} revalidated, "
+            f"{counts['miss']} looked up"
+        )
+        if self.deferred:
+            summary += f", {len(self.deferred)} deferred to the next run (rate limit)"
+        return summary
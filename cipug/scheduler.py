@@ -0,0 +1,57 @@
+from .log import log
+
+DEPENDS_ON_KEY = "CIPUG_DEPENDS_ON"
+
+
+def parse_dependencies(value: str) -> set[str]:
+    """Interpret the CIPUG_DEPENDS_ON entry of a service's .env, which is a
+    comma-separated list of service (folder) names"""
+    return {name.strip() for name in value.split(",") if name.strip()}
+
+
+class Restart_Scheduler:
+    """Orders the restarts of services by their dependencies. Services are
+    grouped in waves: the first wave contains the services that don't depend
+    on any other service being updated, every following wave the services
+    whose dependencies were all handled in earlier waves. Services of one wave
+    can be restarted in parallel.
+    """
+    def __init__(self, dependencies: dict[str, set[str]]):
+        # Only dependencies among the scheduled services matter, the others
+        # are not restarted and hence keep running
+        self.dependencies = {
+            name: deps & dependencies.keys() - {name}
+            for name, deps in dependencies.items()
+        }
+        for name, deps in dependencies.items():
+            for dep in sorted(deps - dependencies.keys()):
+                log.vverbose(f"\"{name}\" depends on \"{dep}\", which is not being updated")
+
+    def waves(self) -> tuple[list[list[str]], set[str], set[str]]:
+        """Returns the waves, the services that cannot be scheduled because
+        they (indirectly) depend on themselves, and the services that cannot
+        be scheduled because they depend on such a cycle"""
+        remaining = {name: set(deps) for name, deps in self.dependencies.items()}
+        waves: list[list[str]] = []
+        while remaining:
+            wave = sorted(name for name, deps in remaining.items() if not deps)
+            if not wave:
+                break  # only cycles (and their dependents) are left
+            waves.append(wave)
+            for name in wave:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(wave)
+
+        def reachable(name: str) -> set[str]:
+            seen: set[str] = set()
+            todo = list(remaining[name])
+            while todo:
+                dep = todo.pop()
+                if dep not in seen:
+                    seen.add(dep)
+                    todo += remaining[dep]
+            return seen
+
+        cyclic = {name for name in remaining if name in reachable(name)}
+        return waves, cyclic, set(remaining) - cyclic
@@ -0,0 +1,268 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+from pathlib import Path
+from typing import Callable
+
+from .config import Config
+from .log import log
+from . import exit_code
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_event_header = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class Inotify:
+    """Minimal inotify binding using ctypes, to not need any dependencies"""
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("Could not find the C library")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path: Path, mask: int) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(path))
+        return wd
+
+    def read(self, timeout: float | None) -> list[tuple[int, int, str]]:
+        """Wait for events, returns (watch descriptor, mask, name) tuples"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events: list[tuple[int, int, str]] = []
+        offset = 0
+        while offset + _event_header.size <= len(data):
+            wd, mask, _, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Service_Registry:
+    """The services below SERVICES_ROOT: folders with a compose file and an
+    .env file, narrowed down by SERVICES_FILTER(_EXCLUDE). They are searched
+    for once per run and shared by everyone through Service_Registry.shared().
+    Long running modes call watch(), after which the registry follows changes
+    below SERVICES_ROOT with inotify, checking only the folders that changed.
+    """
+    _shared: "Service_Registry | None" = None
+    _shared_lock = threading.Lock()
+
+    # What we want to know about in SERVICES_ROOT and in each service folder
+    root_mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF
+    folder_mask = IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_MODIFY | IN_ATTRIB
+
+    def __init__(self):
+        self.config = Config()
+        self.root: Path = self.config["SERVICES_ROOT"]
+        self._lock = threading.Lock()
+        self._services: set[Path] = set()
+        self._changed: set[Path] = set()  # services that changed since the last take_changes()
+        self.listeners: list[Callable[[], None]] = []  # called after changes were noticed
+        self._inotify: Inotify | None = None
+        self._folder_by_wd: dict[int, Path] = {}
+        self._root_wd: int | None = None
+        self.scan()
+
+    @classmethod
+    def shared(cls) -> "Service_Registry":
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def reset(cls):
+        """Forget the shared registry, e.g. after the config was reloaded"""
+        with cls._shared_lock:
+            if cls._shared is not None:
+                cls._shared.close()
+            cls._shared = None
+
+    @property
+    def services(self) -> list[Path]:
+        with self._lock:
+            return sorted(self._services)
+
+    def _is_service(self, folder: Path) -> bool:
+        compose_file = folder / self.config["COMPOSE_FILE_NAME"]
+        env_file = folder / self.config["ENV_FILE_NAME"]
+        if not compose_file.is_file():
+            return False
+        if not env_file.is_file():
+            log.verbose(f"Found {compose_file} but no {env_file}, skipping this folder")
+            return False
+        if self.config["SERVICES_FILTER"] != "":
+            if folder.stem not in self.config["SERVICES_FILTER"].split(","):
+                return False
+        if self.config["SERVICES_FILTER_EXCLUDE"] != "":
+            if folder.stem in self.config["SERVICES_FILTER_EXCLUDE"].split(","):
+                return False
+        return True
+
+    def scan(self):
+        """Search SERVICES_ROOT for services, from scratch"""
+        with log.span("discover"):
+            self._scan()
+
+    def _scan(self):
+        if not self.root.is_dir():
+            log.error(
+                f"CIPUG_SERVICES_ROOT set to {self.root}"
+                ", but is not a directory!",
+                exit_code=exit_code.DIRECTORY_NOT_FOUND
+            )
+        log.vverbose(
+            f"Searching for \"*/{self.config['COMPOSE_FILE_NAME']}\" at {self.root}"
+        )
+        with os.scandir(self.root) as entries:
+            folders = [
+                self.root / entry.name for entry in entries
+                if entry.is_dir() and not entry.name.startswith(".")
+            ]
+        services = {folder for folder in folders if self._is_service(folder)}
+        if self.config["SERVICES_FILTER"] != "":
+            log.verbose(f"Filtering services to be one of {self.config['SERVICES_FILTER'].split(',')}")
+        if self.config["SERVICES_FILTER_EXCLUDE"] != "":
+            log.verbose(f"Filtering services to not include any of {self.config['SERVICES_FILTER_EXCLUDE'].split(',')}")
+        with self._lock:
+            self._changed |= services ^ self._services
+            self._services = services
+
+        if len(services)==1:
+            log.verbose("Found one service:")
+        elif len(services)>1:
+            log.verbose(f"Found {len(services)} services:")
+        else:
+            log.verbose("Did not find any services.")
+        for svc in sorted(services):
+            log.verbose(f" - {svc}")
+
+        if self._inotify is not None:
+            for folder in folders:
+                self._watch_folder(folder)
+
+    def _check_folder(self, folder: Path):
+        """Find out again whether a single folder is a service"""
+        is_service = folder.is_dir() and self._is_service(folder)
+        with self._lock:
+            was_service = folder in self._services
+            if is_service:
+                self._services.add(folder)
+            else:
+                self._services.discard(folder)
+            if is_service or was_service:
+                self._changed.add(folder)
+        if is_service != was_service:
+            log.verbose(f"{'Found new' if is_service else 'Lost'} service {folder}")
+
+    def take_changes(self) -> set[Path]:
+        """Services that appeared, disappeared or whose compose or .env file
+        changed since the last call"""
+        with self._lock:
+            changed, self._changed = self._changed, set()
+        return changed
+
+    def _watch_folder(self, folder: Path):
+        try:
+            wd = self._inotify.add_watch(folder, self.folder_mask)
+        except OSError as e:
+            log.vverbose(f"Cannot watch {folder}: {e}")
+            return
+        with self._lock:
+            self._folder_by_wd[wd] = folder
+
+    def watch(self) -> bool:
+        """Keep the registry up to date in the background, returns whether
+        that is possible (inotify is only available on Linux)"""
+        if self._inotify is not None:
+            return True
+        try:
+            self._inotify = Inotify()
+            self._root_wd = self._inotify.add_watch(self.root, self.root_mask)
+        except OSError as e:
+            log.verbose(f"Cannot watch {self.root} for changes: {e}")
+            self._inotify = None
+            return False
+        self.scan()  # again, to not miss what changed before the watches were set up
+        threading.Thread(target=self._follow, daemon=True).start()
+        return True
+
+    def _handle(self, events: list[tuple[int, int, str]]):
+        folders: set[Path] = set()
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                log.verbose("Missed changes below the services root, searching for services again")
+                before = set(self.services)
+                self.scan()
+                # Which files changed is unknown, so all services may have
+                folders = before | set(self.services)
+                continue
+            if wd == self._root_wd:
+                if name and mask & IN_ISDIR:
+                    folder = self.root / name
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self._watch_folder(folder)
+                    folders.add(folder)
+                continue
+            with self._lock:
+                folder = self._folder_by_wd.get(wd)
+                if folder is not None and mask & IN_IGNORED:
+                    del self._folder_by_wd[wd]  # the folder is gone
+            if folder is None:
+                continue
+            if name in [self.config["COMPOSE_FILE_NAME"], self.config["ENV_FILE_NAME"]] or mask & IN_IGNORED:
+                folders.add(folder)
+        for folder in folders:
+            self._check_folder(folder)
+        if folders:
+            for listener in self.listeners:
+                listener()
+
+    def _follow(self):
+        inotify = self._inotify
+        while self._inotify is inotify:
+            events = inotify.read(timeout=1)
+            if events:
+                self._handle(events)
+        inotify.close()
+
+    def close(self):
+        """Stop watching, the background thread notices within a second"""
+        self._inotify = None
@@ -1,46 +1,96 @@
 import json
 import subprocess
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from .log import log
 
-class Snapper():
+class Snapshotter(ABC):
+    """Base for the snapshot backends, which create snapshots of service
+    subvolumes before they are updated"""
+    tool_name = ""
+
+    @abstractmethod
+    def snapshot_folder(self, path: Path, message: str) -> int | Path:
+        """Create a snapshot of the subvolume at path, returns something that
+        identifies the snapshot for rolling back"""
+        ...
+
+    def snapshot_folders(
+        self,
+        paths: list[Path],
+        message: str,
+        concurrency: int = 4
+    ) -> dict[Path, int | Path | Exception]:
+        """Snapshot many subvolumes in parallel. Returns the snapshot per
+        path, or the exception in case snapshotting that path failed."""
+        def snapshot(path: Path) -> int | Path | Exception:
+            try:
+                return self.snapshot_folder(path, message)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            return dict(zip(paths, pool.map(snapshot, paths)))
+
+
+class Snapper(Snapshotter):
     """Interact with the snapper utility. Specifically, it can create snapshots
     of subvolumes specified by volume path. It does that by going through snapper's
     configs and finding out which one belongs to that path. That way, cipug does not
     need to know the respective snapper config names from the user.
     """
+    tool_name = "snapper"
+
     def __init__(self):
         self.configs = json.loads(
             subprocess.check_output(
                 ["snapper", "--jsonout", "list-configs"]
             ).decode("utf-8")
         )["configs"]
-        log.vverbose(f"Loaded snapper configs: \n{json.dumps(self.configs, indent=2)}")
-
-    def snapshot_folder(self, path: Path, message: str):
-        config_name = None
-        for each in self.configs:
-            subvol = Path(each["subvolume"])
-            if subvol.resolve() == path.resolve():
-                config_name = each["config"]
-                break
+        log.vverbose(lambda: f"Loaded snapper configs: \n{json.dumps(self.configs, indent=2)}")
+        # Resolved subvolume path -> snapper config name, to find the config
+        # of a service without resolving every config's path again
+        self.config_by_subvolume: dict[Path, str] = {
+            Path(each["subvolume"]).resolve(): each["config"]
+            for each in self.configs
+        }
 
+    def snapshot_folder(self, path: Path, message: str) -> int:
+        """Create a snapshot of the subvolume at path, returns the snapshot number"""
+        config_name = self.config_by_subvolume.get(path.resolve())
         if config_name is None:
             raise KeyError(f"No snapper config found for folder {path}")
 
-        completed_process = subprocess.run([
-	        "snapper",
-	        "-c",
-	        config_name,
-	        "create",
-	        "--description",
-	        message
-        ])
+        completed_process = subprocess.run(
+            [
+                "snapper",
+                "-c",
+                config_name,
+                "create",
+                "--print-number",
+                "--description",
+                message
+            ],
+            capture_output=True,
+            text=True
+        )
         if completed_process.returncode != 0:
+            log.raw(completed_process.stdout + completed_process.stderr)
             raise Exception(
                 f"Failed to snapshot using config {config_name}, "
                 f"returncode {completed_process.returncode}."
             )
-            # We do not handle any stdout/stderr here, because snapper
-            # wrote it there already itself when it ran
+        number = int(completed_process.stdout.split()[-1])
+        log.verbose(f"Created snapshot {number} of snapper config {config_name}")
+        return number
+
+
+def make_snapshotter() -> Snapshotter:
+    """The snapshot backend selected by SNAPSHOT_BACKEND"""
+    from .btrfs import Btrfs_Snapshotter  # btrfs.py builds upon this module
+    from .config import Config
+    if Config()["SNAPSHOT_BACKEND"] == "btrfs":
+        return Btrfs_Snapshotter()
+    return Snapper()
@@ -1,3 +1,6 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
@@ -6,51 +9,116 @@ from .config import Config
 from .utils import get_services
 from .colors import colors
 
+# <subvolume name>.<timestamp>, optionally with a _N suffix if there are
+# several snapshots within one minute
+btrbk_name = re.compile(r"^.+\.(\d{8}T\d{4})(?:_\d+)?$")
+
 class Snapshot_Checker:
     def __init__(self):
         self.config = Config()
         self.services: list[Path] = get_services()
 
+    def _snapshots_dir(self, svc: Path, subdir: str) -> Path | None:
+        dir = svc / subdir
+        if not dir.is_dir():
+            log.error(f"{dir} is not a folder")
+            return None
+        return dir
+
     def _last_snapshot_date_snapper(self, svc: Path) -> datetime | None:
         subdir = self.config["SNAPSHOTS_DIR_SNAPPER"]
         if not subdir:
             return None
-        dir = svc / subdir
-        if not dir.is_dir:
-            log.error(f"{dir} is not a folder")
-
-        try:
-            latest = sorted(
-                dir.glob("*/info.xml"),
-                key=lambda p: p.stat().st_ctime,
-                reverse=True
-            )[0]
-        except IndexError:
-            # Empty list -> no snapshots
+        dir = self._snapshots_dir(svc, subdir)
+        if dir is None:
             return None
 
-        return datetime.fromtimestamp(latest.stat().st_ctime)
+        # Snapper numbers its snapshots consecutively, so the highest number
+        # is the most recent one. Only if that one is incomplete (no info.xml,
+        # e.g. while it's being created) the next lower one is looked at.
+        with os.scandir(dir) as entries:
+            numbers = [int(entry.name) for entry in entries if entry.name.isdigit()]
+        for number in sorted(numbers, reverse=True):
+            try:
+                return datetime.fromtimestamp(os.stat(dir / str(number) / "info.xml").st_ctime)
+            except FileNotFoundError:
+                continue
+        # No snapshots
+        return None
 
     def _last_snapshot_date_btrbk(self, svc: Path) -> datetime | None:
         subdir = self.config["SNAPSHOTS_DIR_BTRBK"]
         if not subdir:
             return None
-        dir = svc / subdir
-        if not dir.is_dir:
-            log.error(f"{dir} is not a folder")
-
-        try:
-            latest = sorted(
-                dir.glob("*.*T*"),
-                reverse=True
-            )[0]
-        except IndexError:
-            # Empty list -> no snapshots
+        dir = self._snapshots_dir(svc, subdir)
+        if dir is None:
             return None
 
-        datestr: str = latest.name.split(".", -1)[1]
+        # The timestamps have a fixed width, so the lexically largest is the
+        # most recent one and nothing needs to be parsed or sorted
+        latest: str | None = None
+        with os.scandir(dir) as entries:
+            for entry in entries:
+                match = btrbk_name.match(entry.name)
+                if match and (latest is None or match.group(1) > latest):
+                    latest = match.group(1)
+        if latest is None:
+            # No snapshots
+            return None
         # For example: 20250626T0100
-        return datetime.strptime(datestr, "%Y%m%dT%H%M")
+        return datetime.strptime(latest, "%Y%m%dT%H%M")
+
+    def _snapshot_types(self, folder: Path) -> list[tuple[str, datetime | None, float]]:
+        """The last snapshot of each configured kind as (kind, last snap, max age)"""
+        snapshot_types: list[tuple[str, datetime | None, float]] = []
+        if self.config['SNAPSHOTS_DIR_SNAPPER']:
+            snapshot_types.append((
+                "snapper",
+                self._last_snapshot_date_snapper(folder),
+                self.config["SNAPSHOTS_MAX_AGE_SNAPPER"]
+            ))
+        if self.config['SNAPSHOTS_DIR_BTRBK']:
+            snapshot_types.append((
+                "btrbk",
+                self._last_snapshot_date_btrbk(folder),
+                self.config["SNAPSHOTS_MAX_AGE_BTRBK"]
+            ))
+        return snapshot_types
+
+    def collect(self) -> dict[str, list[tuple[str, datetime | None, float]]]:
+        """Look up the last snapshots of all services in parallel, returns
+        them per service name in the order of the services"""
+        with ThreadPoolExecutor(max_workers=max(1, self.config["SNAPSHOTS_CHECK_CONCURRENCY"])) as pool:
+            results = list(pool.map(self._snapshot_types, self.services))
+        return {
+            folder.stem: snapshot_types  # Only the folder name itself, not the whole path
+            for folder, snapshot_types in zip(self.services, results)
+        }
+
+    def check_json(self) -> tuple[bool, dict]:
+        """Same as check(), but without logging. Instead the result is returned
+        in a form that can be dumped as json, e.g. for monitoring. Snapshots
+        are ok if they exist and are not older than their maximum age."""
+        now = datetime.now()
+        snapshots_ok = True
+        services: dict[str, dict] = {}
+        for svc_name, snapshot_types in self.collect().items():
+            services[svc_name] = {}
+            for kind, date, max_age in snapshot_types:
+                age_h = None if date is None else (now.timestamp() - date.timestamp())/3600
+                ok = age_h is not None and age_h <= max_age
+                snapshots_ok = snapshots_ok and ok
+                services[svc_name][kind] = {
+                    "date": None if date is None else date.isoformat(timespec="seconds"),
+                    "age_hours": age_h,
+                    "max_age_hours": max_age,
+                    "ok": ok,
+                }
+        return snapshots_ok, {
+            "ok": snapshots_ok,
+            "time": now.isoformat(timespec="seconds"),
+            "services": services,
+        }
 
     def check(self) -> bool:
         log("Configured relative snapshot locations:")
@@ -60,36 +128,16 @@ class Snapshot_Checker:
         ]:
             log(f" - {name}: {dir or None} (max. age: {max_age:.2f}h)")
         log("Checking for most recent snapshots of services:", highlight=True)
-        snapshots_ok = True
-        now = datetime.now()
-        for folder in self.services:
-            svc_name: str = folder.stem  # Only the folder name itself, not the whole path
+        snapshots_ok, result = self.check_json()
+        for svc_name, snapshot_types in result["services"].items():
             log(f" - service \"{svc_name}\":")
-            kind: str  # Which kind of snapshots
-            date: datetime | None
-            max_age: float  # in hours
-            snapshot_types: list[tuple[str, datetime | None, float]] = []  # (kind, last snap, max age)
-            if self.config['SNAPSHOTS_DIR_SNAPPER']:
-                snapshot_types.append((
-                    "snapper",
-                    self._last_snapshot_date_snapper(folder),
-                    self.config["SNAPSHOTS_MAX_AGE_SNAPPER"]
-                ))
-            if self.config['SNAPSHOTS_DIR_BTRBK']:
-                snapshot_types.append((
-                    "btrbk",
-                    self._last_snapshot_date_btrbk(folder),
-                    self.config["SNAPSHOTS_MAX_AGE_BTRBK"]
-                ))
-
-            for kind, date, max_age in snapshot_types:
-                if isinstance(date, datetime):
-                    age_h = (now.timestamp() - date.timestamp())/3600
+            for kind, snapshot in snapshot_types.items():
+                color = colors.Green if snapshot["ok"] else colors.Red
+                if snapshot["date"] is not None:
                     log(
-                        f"     {kind}: {date.isoformat(timespec='seconds')} (age: "
-                        f"{colors.Green if age_h <= max_age else colors.Red}{age_h:.2f}h{colors.Reset})"
-                )
+                        f"     {kind}: {snapshot['date']} (age: "
+                        f"{color}{snapshot['age_hours']:.2f}h{colors.Reset})"
+                    )
                 else:
-                    snapshots_ok = False
-                    log(f"     {kind}: {colors.Red}None{colors.Reset}")
+                    log(f"     {kind}: {color}None{colors.Reset}")
         return snapshots_ok
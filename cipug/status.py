@@ -0,0 +1,59 @@
+import json
+import os
+import time
+from pathlib import Path
+
+from .config import Config
+from .exit_code import Exit_Code
+from .log import log
+
+class Update_Status:
+    """Remembers the outcome of the most recent update run of each service, in
+    cipug_status.json next to the resolver cache, such that e.g. the metrics
+    exporter can report it. Each service entry looks like:
+
+        {"time": <when it was last worked on>, "exit_code": 0 or the error,
+         "error": name of the error or null, "updated": <when it last got new images>,
+         "deferred": <when it was put off to stay within rate limits, until it is worked on again>}
+    """
+    def __init__(self):
+        self.path: Path = Config()["CACHE_LOCATION"].with_name("cipug_status.json")
+
+    def read(self) -> dict[str, dict]:
+        try:
+            status = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return {}
+        return status if isinstance(status, dict) else {}
+
+    def record(
+        self,
+        outcomes: dict[str, Exit_Code | None],
+        updated: set[str],
+        deferred: set[str] | None = None
+    ):
+        """Store the outcome per service of this run, services of earlier
+        runs that were not worked on this time are kept. Deferred services
+        keep the outcome of their last run."""
+        now = time.time()
+        status = self.read()
+        for name, outcome in outcomes.items():
+            entry = status.get(name, {})
+            entry.update({
+                "time": now,
+                "exit_code": 0 if outcome is None else outcome.code,
+                "error": None if outcome is None else outcome.name,
+            })
+            entry.pop("deferred", None)
+            if name in updated:
+                entry["updated"] = now
+            status[name] = entry
+        for name in deferred or set():
+            status.setdefault(name, {})["deferred"] = now
+
+        tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        try:
+            tmp_path.write_text(json.dumps(status, sort_keys=True, indent=4))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.verbose(f"Could not write {self.path}: {e}")
@@ -1,107 +1,187 @@
 from pathlib import Path
 from datetime import datetime
+import os
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
 
 from .colors import colors
 from .config import Config
 from .log import log
 from .env import Env
-from .resolver import Image_Version_Resolver
-from .snapper import Snapper
-from .utils import get_services
+from .resolver import Image_Version_Resolver, Lookup_Deferred
+from .health import Health_Checker
+from .capabilities import Capabilities
+from .snapper import Snapshotter
+from .utils import format_size, get_services, run_tool
+from .scheduler import DEPENDS_ON_KEY, Restart_Scheduler, parse_dependencies
+from .status import Update_Status
 from . import exit_code
 
+def tagged_images(env: Env) -> dict[str, str]:
+    """Find the SERVICE_*_IMAGE_TAGGED entries of an .env, returns the entry
+    names (the * part) and their respective image names"""
+    images = env.tagged_images()
+    for entry_name, image in images.items():
+        image_tagged = env[f"SERVICE_{entry_name}_IMAGE_TAGGED"]
+        if image != image_tagged:
+            log.verbose(f"Interpolated image name: {image_tagged} → {image}")
+    return images
+
+
+class Pending_Update:
+    """A service with new image references, as found by resolving its tagged
+    images, that still needs to be applied"""
+    def __init__(self, folder: Path, env: Env, changes: dict[str, str]):
+        self.folder = folder
+        self.env = env
+        self.changes = changes  # tagged image name -> new hashed reference
+        self.snapshot: int | Path | None = None  # snapshot taken before updating
+        self.download_size: int | None = None  # estimated bytes pulling downloads
+        # Services that need to be updated before this one
+        self.depends_on = parse_dependencies(env.get(DEPENDS_ON_KEY, ""))
+
+    @property
+    def name(self) -> str:
+        return self.folder.stem  # Only the folder name itself, not the whole path
+
+
 class Updater():
     def __init__(
         self,
         resolver: Image_Version_Resolver,
-        snapper: Snapper
+        snapper: Snapshotter | None,
+        capabilities: Capabilities | None = None
     ):
         self.config = Config()
+        self.capabilities = capabilities or Capabilities()
         self.resolver = resolver
         self.snapper = snapper
         self.services = get_services()
+        self.concurrency = max(1, self.config["UPDATE_CONCURRENCY"])
+        self.health_checker: Health_Checker | None = None
+        if self.config["HEALTH_CHECK"] and self.config["SERVICE_STOP_START"]:
+            self.health_checker = Health_Checker()
+        self.time_to_healthy: dict[str, float] = {}  # seconds per service
+        self.outcomes: dict[str, exit_code.Exit_Code | None] = {}  # per service of this run
+        # Services put off to the next run to stay within rate limits, they have no outcome
+        self.deferred: set[str] = set()
+        self.download_sizes: dict[str, int | None] = {}  # estimated bytes per new image
+        self._lock = threading.Lock()
 
-    def _update_image_hashes(self, env: Env):
-        for key in list(env.keys()): # Dict size will change, hence copy env.keys into a list
-            if key.startswith("SERVICE_") and key.endswith("_IMAGE_TAGGED"):
-                entry_name = key.removeprefix("SERVICE_").removesuffix("_IMAGE_TAGGED")
-                image_tagged = env[key]
-
-                # Check for environment variables in the tagged image (${VAR} format)
-                import re
-                def replace_env_vars(s: str, vars: dict[str, str]):
-                    def replace_var(match: re.Match) -> str:
-                        var_name: str = match.group(1)
-                        fallback: str = match.group(0)
-                        return vars.get(var_name, fallback)
-
-                    pattern = r'\${([A-Za-z0-9_]+)}'
-                    return re.sub(pattern, replace_var, s)
-
-                # Apply environment variable substitution
-                interpolated_image = replace_env_vars(image_tagged, env)
-                if interpolated_image != image_tagged:
-                    log.verbose(f"Interpolated image name: {image_tagged} → {interpolated_image}")
-                    image_tagged = interpolated_image
+    def _update_image_hashes(self, env: Env) -> dict[str, str] | None:
+        """Resolve the tagged images and update the hashed references in env.
+        Returns which images changed (tagged name -> new hashed reference), or
+        None if resolving failed."""
+        changes: dict[str, str] = {}
+        images = tagged_images(env)
+        # All images of the service in one batch, mostly answered by the cache
+        results = self.resolver.resolve_image_versions(images.values())
+        for entry_name, image_tagged in images.items():
+            log.verbose(
+                f"Found tagged image entry for \"{entry_name}\": "
+                f"{image_tagged}"
+            )
 
+            current_hash = env.get(
+                "_".join(["SERVICE", entry_name, "IMAGE", "HASHED"]),
+                None
+            )
+            if current_hash is None:
                 log.verbose(
-                    f"Found tagged image entry for \"{entry_name}\": "
-                    f"{image_tagged}"
+                    f"There's no hashed image reference for \"{entry_name}\""
+                    f" in {self.config['ENV_FILE_NAME']} currently"
                 )
+            else:
+                log.verbose(
+                    "The current hashed image reference for "
+                    f"\"{entry_name}\" is: {current_hash}")
+
+            new_hash = results[image_tagged]
+            if isinstance(new_hash, Lookup_Deferred):
+                raise new_hash
+            if isinstance(new_hash, Exception):
+                log.error(f"Failed to resolve {image_tagged} for \"{entry_name}\": {new_hash}")
+                return None
 
-                current_hash = env.get(
-                    "_".join(["SERVICE", entry_name, "IMAGE", "HASHED"]),
-                    None
+            if new_hash == current_hash:
+                log(f"{entry_name}: {image_tagged} stays at {current_hash}")
+            else:
+                env[
+                    "_".join(["SERVICE", entry_name, "IMAGE", "HASHED"])
+                ] = new_hash
+                changes[image_tagged] = new_hash
+                log(
+                    f"{colors.Green}{entry_name}: {image_tagged} is "
+                    f"now at {new_hash}{colors.Reset}"
                 )
-                if current_hash is None:
-                    log.verbose(
-                        f"There's no hashed image reference for \"{entry_name}\""
-                        f" in {self.config['ENV_FILE_NAME']} currently"
-                    )
-                else:
-                    log.verbose(
-                        "The current hashed image reference for "
-                        f"\"{entry_name}\" is: {current_hash}")
-
-                new_hash = self.resolver.resolve_image_version(image_tagged)
-
-                if new_hash == current_hash:
-                    log(f"{entry_name}: {image_tagged} stays at {current_hash}")
-                else:
-                    env[
-                        "_".join(["SERVICE", entry_name, "IMAGE", "HASHED"])
-                    ] = new_hash
-                    log(
-                        f"{colors.Green}{entry_name}: {image_tagged} is "
-                        f"now at {new_hash}{colors.Reset}"
-                    )
+        return changes
+
+    def _env_stat(self, folder: Path) -> list[int] | None:
+        try:
+            stat = os.stat(folder / self.config["ENV_FILE_NAME"])
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+    def _fingerprinted_images(self, folder: Path) -> dict[str, str] | None:
+        """If the .env of a service is unchanged since the service was last
+        found up to date, returns its tagged images and what they were pinned
+        to then, without reading the .env"""
+        if self.config["FULL_CHECK"]:
+            return None
+        fingerprint = self.resolver.service_fingerprint(folder)
+        if fingerprint is None or fingerprint.get("env") != self._env_stat(folder):
+            return None
+        return fingerprint.get("images")
+
+    def _still_up_to_date(self, images: dict[str, str]) -> bool:
+        """Whether all tagged images still resolve to what they are pinned to"""
+        for image, pinned in images.items():
+            try:
+                if self.resolver.resolve_image_version(image) != pinned:
+                    return False
+            except Exception:
+                return False  # let the full check report it
+        return True
+
+    def _remember_up_to_date(self, folder: Path, env: Env | None):
+        """Store the fingerprint of a service that is up to date, such that
+        the next runs can skip reading its .env (None forgets it)"""
+        if env is None:
+            self.resolver.remember_service(folder, None)
+            return
+        self.resolver.remember_service(folder, {
+            "time": time.time(),
+            "env": self._env_stat(folder),
+            "images": {
+                image: env.get(f"SERVICE_{entry_name}_IMAGE_HASHED")
+                for entry_name, image in tagged_images(env).items()
+            },
+        })
 
     def _check_permission_compose_tool(self, folder: Path, svc_name: str) -> bool:
-        log(f"Ensuring permission for \"{self.config['COMPOSE_TOOL']}\"..")
-        cp = subprocess.run(
-            self.config["COMPOSE_TOOL"].split(" ") + ["ps"],
-            cwd=folder,
-            capture_output=True
-        )
-        ret = cp.returncode
-        if ret != 0:
-            print(cp.stdout.decode(), cp.stderr.decode())
+        log.verbose(f"Ensuring permission for \"{self.config['COMPOSE_TOOL']}\"..")
+        if not self.capabilities.compose_usable(folder):
             log.error(
                 f"Cannot update service \"{svc_name}\", because "
-                f"cannot use \"{self.config['COMPOSE_TOOL']}\" (returncode {ret})"
+                f"cannot use \"{self.config['COMPOSE_TOOL']}\""
             )
             return False
         return True
 
-    def _cater_for_snapshot(self, folder: Path, svc_name: str) -> bool:
+    def _cater_for_snapshot(self, pending: Pending_Update) -> bool:
+        folder, svc_name = pending.folder, pending.name
         if self.config["SERVICE_SNAPSHOT"]:
-            log(f"Taking a snapshot of {folder} using snapper..")
+            log(f"Taking a snapshot of {folder} using {self.snapper.tool_name}..")
             try:
-                self.snapper.snapshot_folder(
-                    folder,
-                    message=f"Update container images {str(datetime.today())}"
-                )
+                with log.span("snapshot", svc_name):
+                    pending.snapshot = self.snapper.snapshot_folder(
+                        folder,
+                        message=f"Update container images {str(datetime.today())}"
+                    )
             except Exception as e:
                 log.error(
                     f"Cannot update service \"{svc_name}\", because "
@@ -125,10 +205,11 @@ class Updater():
     def _cater_for_image_pull(self, folder: Path, svc_name: str) -> bool:
         if self.config["SERVICE_PULL"]:
             log(f"pulling images for service \"{svc_name}\"..")
-            ret = subprocess.run(
-                self.config["COMPOSE_TOOL"].split(" ") + ["pull"],
-                cwd=folder
-            ).returncode
+            with log.span("pull", svc_name):
+                ret = run_tool(
+                    self.config["COMPOSE_TOOL"].split(" ") + ["pull"],
+                    cwd=folder
+                ).returncode
             if ret != 0:
                 log.error(
                     f"Cannot update service \"{svc_name}\", because "
@@ -141,10 +222,11 @@ class Updater():
         if self.config["SERVICE_STOP_START"]:
             if self.config["STOP_START_METHOD"] == "compose":
                 log(f"stopping service \"{svc_name}\"..")
-                ret = subprocess.run(
-                    self.config["COMPOSE_TOOL"].split(" ") + ["down"],
-                    cwd=folder
-                ).returncode
+                with log.span("down", svc_name):
+                    ret = run_tool(
+                        self.config["COMPOSE_TOOL"].split(" ") + ["down"],
+                        cwd=folder
+                    ).returncode
                 if ret != 0:
                     log.error(
                         f"Failed to stop service \"{svc_name}\" (returncode {ret})"
@@ -152,10 +234,11 @@ class Updater():
                     return False
 
                 log(f"Starting \"{svc_name}\" service..")
-                ret = subprocess.run(
-                    self.config["COMPOSE_TOOL"].split(" ") + ["up", "-d"],
-                    cwd=folder
-                ).returncode
+                with log.span("up", svc_name):
+                    ret = run_tool(
+                        self.config["COMPOSE_TOOL"].split(" ") + ["up", "-d"],
+                        cwd=folder
+                    ).returncode
                 if ret != 0:
                     log.error(
                         f"Failed to start service \"{svc_name}\" (returncode {ret})"
@@ -170,7 +253,8 @@ class Updater():
                 if "-user" in self.config["STOP_START_METHOD"]:
                     cmdlist.append("--user")
                 cmdlist += ["restart", systemd_service]
-                ret = subprocess.run(cmdlist, cwd=folder).returncode
+                with log.span("restart", svc_name):
+                    ret = run_tool(cmdlist, cwd=folder).returncode
                 if ret != 0:
                     log.error(
                         f"Failed to restart service \"{svc_name}\" (returncode {ret})"
@@ -184,48 +268,423 @@ class Updater():
         return True
 
 
-    def update_service(self, folder: Path) -> exit_code.Exit_Code | None:
+    def _cater_for_health_check(self, folder: Path, svc_name: str) -> bool:
+        if self.health_checker is None:
+            return True
+        with log.span("health", svc_name):
+            duration = self.health_checker.wait_until_healthy(folder, svc_name)
+        if duration is None:
+            return False
+        log(f"Service \"{svc_name}\" is healthy after {duration:.1f}s")
+        with self._lock:
+            self.time_to_healthy[svc_name] = duration
+        return True
+
+    def _roll_back(self, pending: Pending_Update, previous: dict[str, str | None]):
+        """Put back the image references the service ran with before and restart it"""
+        svc_name = pending.name
+        if any(val is None for val in previous.values()):
+            log.error(
+                f"Cannot roll back service \"{svc_name}\", because it had no "
+                "previous image references. Leaving it as it is."
+            )
+            return
+        log(f"Rolling back service \"{svc_name}\" to its previous images..", highlight=True)
+        for key, val in previous.items():
+            log(f"{key}: back to {val}")
+            pending.env[key] = val
+        if not self._cater_for_updating_env_file(pending.env, svc_name):
+            return
+        if not self._cater_for_restart(pending.folder, svc_name):
+            return
+        if self.health_checker is not None and self.health_checker.wait_until_healthy(pending.folder, svc_name) is None:
+            log.error(f"Service \"{svc_name}\" is not healthy with its previous images either")
+            return
+        log(f"Rolled back service \"{svc_name}\"")
+
+    def prepare_service(self, folder: Path, env: Env | None = None) -> Pending_Update | exit_code.Exit_Code | None:
+        """Find out whether the service needs an update, without touching it.
+        Its .env is read unless it was already (env). Returns what needs to
+        be done, an error, or None if nothing changed."""
         svc_name = folder.stem  # Only the folder name itself, not the whole path
         log(f"Working on service \"{svc_name}\"", highlight=True)
 
+        images = self._fingerprinted_images(folder)
+        if images is not None and self._still_up_to_date(images):
+            log(f"No changes for \"{svc_name}\" (unchanged since the last run), done.")
+            return None
+
         env_file = folder / self.config["ENV_FILE_NAME"]
-        if not env_file.is_file():
-            log.error(f"File {env_file} not found, cannot update service.")
-            return exit_code.FILE_NOT_FOUND
-        env = Env(env_file)
+        if env is None:
+            if not env_file.is_file():
+                log.error(f"File {env_file} not found, cannot update service.")
+                return exit_code.FILE_NOT_FOUND
+            with log.span("parse", svc_name):
+                env = Env(env_file)
 
         log.vverbose(
             f"Searching {self.config['ENV_FILE_NAME']} for SERVICE_*_IMAGE_TAGGED "
             "entries that should get resolved to SERVICE_*_IMAGE_HASHED entries."
         )
 
-        self._update_image_hashes(env)
+        try:
+            with log.span("resolve", svc_name):
+                changes = self._update_image_hashes(env)
+        except Lookup_Deferred as e:
+            log(f"Deferring service \"{svc_name}\" to the next run: {e}")
+            self.deferred.add(svc_name)
+            return None
+        if changes is None:
+            log.error(f"Cannot update service \"{svc_name}\", because resolving images failed")
+            self._remember_up_to_date(folder, None)
+            return exit_code.RESOLVE_ERROR
 
         if env.has_changes():
             log(f"Changes pending for \"{svc_name}\"")
+            self._remember_up_to_date(folder, None)
         else:
             log(f"No changes for \"{svc_name}\", done.")
-            return
+            self._remember_up_to_date(folder, env)
+            return None
+        return Pending_Update(folder, env, changes)
 
+    def apply_update(
+        self,
+        pending: Pending_Update,
+        pulled: bool = False,
+        snapshotted: bool = False
+    ) -> exit_code.Exit_Code | None:
+        """Snapshot the service, write the new image references and restart it.
+        Pulling and snapshotting are skipped if they were done beforehand."""
+        folder, svc_name = pending.folder, pending.name
+        # What was pinned before, to be able to roll back
+        previous = {
+            key: pending.env.diskstate.get(key)
+            for key in pending.env.keys()
+            if pending.env[key] != pending.env.diskstate.get(key)
+        }
         if not self._check_permission_compose_tool(folder, svc_name):
             return exit_code.TOOL_ERROR
 
-        if not self._cater_for_snapshot(folder, svc_name):
+        if not snapshotted and not self._cater_for_snapshot(pending):
             return exit_code.SNAPSHOT_ERROR
 
-        if not self._cater_for_updating_env_file(env, svc_name):
+        if not self._cater_for_updating_env_file(pending.env, svc_name):
             return exit_code.ENV_ERROR
 
-        if not self._cater_for_image_pull(folder, svc_name):
+        if not pulled and not self._cater_for_image_pull(folder, svc_name):
             return exit_code.IMAGE_PULL_ERROR
 
         if not self._cater_for_restart(folder, svc_name):
             return exit_code.SERVICE_RESTART_ERROR
 
-    def update_all_services(self) -> list[exit_code.Exit_Code]:
-        errors: list[exit_code.Exit_Code] = []
-        for svc in self.services:
-            e = self.update_service(svc)
-            if e is not None:
-                errors.append(e)
-        return errors
+        if not self._cater_for_health_check(folder, svc_name):
+            self._roll_back(pending, previous)
+            return exit_code.SERVICE_UNHEALTHY
+
+        self.resolver.record_applied(pending.changes, svc_name)
+        self._remember_up_to_date(folder, pending.env)
+        return None
+
+    def update_service(self, folder: Path) -> exit_code.Exit_Code | None:
+        pending = self.prepare_service(folder)
+        if not isinstance(pending, Pending_Update):
+            return pending
+        return self.apply_update(pending)
+
+    def _pull_image(self, image: str) -> bool:
+        cp = subprocess.run(
+            self.config["CONTAINER_TOOL"].split(" ") + ["pull", image],
+            capture_output=True,
+            text=True
+        )
+        if cp.returncode != 0:
+            log.error(f"Failed to pull {image} (returncode {cp.returncode}):\n{cp.stdout}{cp.stderr}")
+            return False
+        log(f"Pulled {image}")
+        return True
+
+    def _present_locally(self, image: str) -> bool:
+        try:
+            cp = subprocess.run(
+                self.config["CONTAINER_TOOL"].split(" ") + ["image", "inspect", image],
+                capture_output=True
+            )
+        except OSError:
+            return False
+        return cp.returncode == 0
+
+    def estimate_downloads(self, pending_updates: list[Pending_Update]):
+        """Estimate how many bytes pulling the new images downloads: the sizes
+        of their layers that the previously pinned images don't have, as far
+        as those are present locally. The container tool only knows the
+        uncompressed layers, hence the registry is asked for the layers of
+        the previous images, too."""
+        new_images = {image for pending in pending_updates for image in pending.changes.values()}
+        previous: set[str] = set()
+        for pending in pending_updates:
+            for entry_name, image in tagged_images(pending.env).items():
+                old = pending.env.diskstate.get(f"SERVICE_{entry_name}_IMAGE_HASHED")
+                if image in pending.changes and old:
+                    previous.add(old)
+        present = {image for image in previous if self._present_locally(image)}
+        log(f"Estimating the download size of {len(new_images)} new images..")
+        with log.span("estimate"):
+            layers = self.resolver.image_layers(new_images | present)
+        known: set[str] = set()
+        for image in present:
+            known.update((layers[image] or {}).keys())
+
+        def download_size(images: set[str]) -> int | None:
+            missing: dict[str, int] = {}
+            for image in images:
+                if layers[image] is None:
+                    return None
+                missing.update({digest: size for digest, size in layers[image].items() if digest not in known})
+            return sum(missing.values())
+
+        for image in new_images:
+            self.download_sizes[image] = download_size({image})
+        for pending in pending_updates:
+            pending.download_size = download_size(set(pending.changes.values()))
+        total = download_size(new_images)
+        if total is not None:
+            log(f"Pulling will download about {format_size(total)}")
+
+    def _pull_images(self, pending_updates: list[Pending_Update]) -> dict[str, bool]:
+        """Pull the new images of all pending updates in parallel, returns
+        whether pulling succeeded per image. If their sizes were estimated,
+        the biggest pulls start first."""
+        images = sorted(
+            {image for pending in pending_updates for image in pending.changes.values()},
+            key=lambda image: (-(self.download_sizes.get(image) or 0), image)
+        )
+        log(f"Pulling {len(images)} new images of {len(pending_updates)} services..", highlight=True)
+        with log.span("pull"), ThreadPoolExecutor(max_workers=max(1, self.config["PULL_CONCURRENCY"])) as pool:
+            return dict(zip(images, pool.map(self._pull_image, images)))
+
+    def _snapshot_all(self, pending_updates: list[Pending_Update]) -> dict[str, int | Path | Exception]:
+        """Snapshot all services in parallel, before any of them is restarted.
+        Returns the snapshot per service (or why it failed)."""
+        log(
+            f"Taking snapshots of {len(pending_updates)} services using {self.snapper.tool_name}..",
+            highlight=True
+        )
+        with log.span("snapshot"):
+            results = self.snapper.snapshot_folders(
+                [pending.folder for pending in pending_updates],
+                message=f"Update container images {str(datetime.today())}",
+                concurrency=self.config["SNAPSHOT_CONCURRENCY"]
+            )
+        snapshots: dict[str, int | Path | Exception] = {}
+        for pending in pending_updates:
+            result = results[pending.folder]
+            snapshots[pending.name] = result
+            if isinstance(result, Exception):
+                log.error(f"Snapshotting service \"{pending.name}\" failed: {result}")
+            else:
+                pending.snapshot = result
+        return snapshots
+
+    def _for_each(self, func: Callable[[Any], exit_code.Exit_Code | None], items: list) -> list[exit_code.Exit_Code | None]:
+        """Call func for every item, in parallel if configured. Output is kept
+        together per item then."""
+        if self.concurrency > 1 and len(items) > 1:
+            def buffered(item) -> exit_code.Exit_Code | None:
+                with log.buffered():
+                    return func(item)
+
+            log(f"Working on up to {self.concurrency} services in parallel..")
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                return list(pool.map(buffered, items))
+        return [func(item) for item in items]
+
+    def _apply_in_waves(
+        self,
+        pending_updates: list[Pending_Update],
+        pulled: dict[str, bool],
+        snapshots: dict[str, int | Path | Exception]
+    ) -> list[exit_code.Exit_Code | None]:
+        """Apply the pending updates ordered by the dependencies the services
+        declare: a service is only restarted after all services it depends on
+        were updated successfully."""
+        by_name = {pending.name: pending for pending in pending_updates}
+        scheduler = Restart_Scheduler({
+            pending.name: pending.depends_on for pending in pending_updates
+        })
+        waves, cyclic, blocked = scheduler.waves()
+        results: list[exit_code.Exit_Code | None] = []
+        for name in sorted(cyclic | blocked):
+            if name in cyclic:
+                log.error(
+                    f"Cannot update service \"{name}\", because its dependencies "
+                    f"({DEPENDS_ON_KEY}) form a cycle"
+                )
+            else:
+                log.error(
+                    f"Skipping service \"{name}\", because a service it depends on "
+                    f"({DEPENDS_ON_KEY}) is in a cycle"
+                )
+            results.append(exit_code.DEPENDENCY_ERROR)
+            self.outcomes[name] = exit_code.DEPENDENCY_ERROR
+
+        failed_services: set[str] = set()
+        # Services whose new images were all pulled up front (staged mode)
+        pulled_services = {
+            pending.name for pending in pending_updates
+            if pending.changes and all(image in pulled for image in pending.changes.values())
+        }
+
+        def apply(pending: Pending_Update) -> exit_code.Exit_Code | None:
+            failed_deps = pending.depends_on & failed_services
+            if failed_deps:
+                log.error(
+                    f"Cannot update service \"{pending.name}\", because updating "
+                    f"{', '.join(sorted(failed_deps))} failed. Leaving it as it is."
+                )
+                return exit_code.DEPENDENCY_ERROR
+            failed_images = [image for image in pending.changes.values() if not pulled.get(image, True)]
+            if failed_images:
+                log.error(
+                    f"Cannot update service \"{pending.name}\", because "
+                    f"pulling {', '.join(failed_images)} failed. Leaving it as it is."
+                )
+                return exit_code.IMAGE_PULL_ERROR
+            if isinstance(snapshots.get(pending.name), Exception):
+                log.error(
+                    f"Cannot update service \"{pending.name}\", because "
+                    f"snapshotting failed: {snapshots[pending.name]}"
+                )
+                return exit_code.SNAPSHOT_ERROR
+            log(f"Applying update of service \"{pending.name}\"", highlight=True)
+            return self.apply_update(
+                pending,
+                pulled=pending.name in pulled_services,
+                snapshotted=pending.name in snapshots
+            )
+
+        for idx, wave in enumerate(waves):
+            if len(waves) > 1:
+                log(f"Restart wave {idx+1} of {len(waves)}: {', '.join(wave)}")
+            wave_results = self._for_each(apply, [by_name[name] for name in wave])
+            for name, result in zip(wave, wave_results):
+                self.outcomes[name] = result
+                if result is not None:
+                    failed_services.add(name)
+            results += wave_results
+        return results
+
+    def _resolve_all_images(self, folders: list[Path]) -> dict[Path, Env]:
+        """Resolve the tagged images of all services up front, such that the
+        registry lookups happen in parallel before any service is touched.
+        Failures are reported later on by the services that use the image.
+        Returns the .env files that were read for this, per service folder."""
+        images: set[str] = set()
+        envs: dict[Path, Env] = {}
+        for folder in folders:
+            known = self._fingerprinted_images(folder)
+            if known is not None:
+                images.update(known.keys())
+                continue
+            env_file = folder / self.config["ENV_FILE_NAME"]
+            if env_file.is_file():
+                with log.span("parse", folder.stem):
+                    envs[folder] = Env(env_file)
+                images.update(tagged_images(envs[folder]).values())
+        if (
+            folders is self.services
+            and self.config["SERVICES_FILTER"] == ""
+            and self.config["SERVICES_FILTER_EXCLUDE"] == ""
+        ):
+            # We know about all services, hence anything else in the cache is stale
+            self.resolver.evict_unreferenced(images)
+        log(f"Resolving {len(images)} tagged images of {len(folders)} services..")
+        with log.span("resolve"):
+            results = self.resolver.resolve_image_versions(images)
+        failed = [
+            name for name, result in results.items()
+            if isinstance(result, Exception) and not isinstance(result, Lookup_Deferred)
+        ]
+        if failed:
+            log(f"Failed to resolve {len(failed)} of them: {', '.join(failed)}")
+        return envs
+
+    def start_run(self):
+        """Forget the outcomes of the previous run (for long running processes)"""
+        self.outcomes = {}
+        self.deferred = set()
+        self.time_to_healthy = {}
+        self.download_sizes = {}
+
+    def prepare_all(self, folders: list[Path] | None = None) -> list[Pending_Update]:
+        """Find out what changes for each service, without touching any of
+        them. The services that don't need an update (or failed) get their
+        outcome recorded right away."""
+        if folders is None:
+            folders = self.services
+        self.start_run()
+        envs = self._resolve_all_images(folders)
+        pending_updates: list[Pending_Update] = []
+        for folder in folders:
+            prepared = self.prepare_service(folder, envs.get(folder))
+            if isinstance(prepared, Pending_Update):
+                pending_updates.append(prepared)
+            elif folder.stem not in self.deferred:
+                self.outcomes[folder.stem] = prepared
+        return pending_updates
+
+    def apply_all(self, pending_updates: list[Pending_Update]) -> list[exit_code.Exit_Code]:
+        """Apply the pending updates. In staged mode, all new images get
+        pulled first, such that services are only down for the restart
+        itself, and a failed pull leaves its service untouched. Also all
+        snapshots are taken at once then, before the first restart. Returns
+        the errors of this run, including those of preparing."""
+        pulled: dict[str, bool] = {}
+        snapshots: dict[str, int | Path | Exception] = {}
+        if pending_updates and self.config["SERVICE_PULL"] and self.config["ESTIMATE_PULL_SIZE"]:
+            self.estimate_downloads(pending_updates)
+        if pending_updates and self.config["UPDATE_STAGED"]:
+            if self.config["SERVICE_PULL"]:
+                pulled = self._pull_images(pending_updates)
+            if self.config["SERVICE_SNAPSHOT"]:
+                snapshots = self._snapshot_all([
+                    pending for pending in pending_updates
+                    if all(pulled.get(image, True) for image in pending.changes.values())
+                ])
+
+        self._apply_in_waves(pending_updates, pulled, snapshots)
+        Update_Status().record(
+            self.outcomes,
+            updated={
+                pending.name for pending in pending_updates
+                if pending.name in self.outcomes and self.outcomes[pending.name] is None
+            },
+            deferred=self.deferred
+        )
+
+        snapshotted = [pending for pending in pending_updates if pending.snapshot is not None]
+        if snapshotted:
+            log("Snapshots taken before updating (for rolling back):")
+            for pending in snapshotted:
+                log(f" - {pending.name}: {pending.snapshot}")
+
+        if self.download_sizes:
+            log("Estimated downloads (biggest first):")
+            for pending in sorted(pending_updates, key=lambda pending: -(pending.download_size or 0)):
+                size = "unknown" if pending.download_size is None else format_size(pending.download_size)
+                log(f" - {pending.name}: {size}")
+
+        if self.time_to_healthy:
+            log("Time until services were healthy (slowest first):")
+            for name, duration in sorted(self.time_to_healthy.items(), key=lambda item: -item[1]):
+                log(f" - {name}: {duration:.1f}s")
+
+        if self.deferred:
+            log(f"Deferred to the next run (registry rate limits): {', '.join(sorted(self.deferred))}")
+        return [e for e in self.outcomes.values() if e is not None]
+
+    def update_all_services(self, folders: list[Path] | None = None) -> list[exit_code.Exit_Code]:
+        """Update all services: first it is found out what changes for each
+        service, then the updates are applied. Optionally only the given
+        services are updated."""
+        return self.apply_all(self.prepare_all(folders))
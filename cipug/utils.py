@@ -1,71 +1,55 @@
 import subprocess
 from pathlib import Path
-import glob
-import os
+import sys
 
 from .log import log
 from .config import Config
+from .capabilities import Capabilities
+from .services import Service_Registry
 from . import exit_code
 
 
-def get_services() -> list[Path]:
-    config = Config()
-    if not config["SERVICES_ROOT"].is_dir():
-        log.error(
-            f"CIPUG_SERVICES_ROOT set to {config['SERVICES_ROOT']}"
-            ", but is not a directory!",
-            exit_code=exit_code.DIRECTORY_NOT_FOUND
-        )
-
-    pattern = os.path.join("*", config["COMPOSE_FILE_NAME"])
-    log.vverbose(
-        f"Searching for pattern \"{pattern}\" at {config['SERVICES_ROOT']}"
-    )
-
-    services: list[Path] = []  # list of folders with a compose and env file
-    for result in glob.glob(
-        pattern,
-        root_dir=config["SERVICES_ROOT"]
-    ):
-        compose_file = config["SERVICES_ROOT"] / result
-        env_file = compose_file.parent / config["ENV_FILE_NAME"]
-        if not env_file.is_file():
-            log.verbose(
-                f"Found {compose_file} but no {env_file}, skipping this folder"
-            )
-            continue
-        services.append(compose_file.parent)
-
-    if config["SERVICES_FILTER"] != "":
-        filter = config["SERVICES_FILTER"].split(",")
-        log.verbose(f"Filtering services to be one of {filter}")
-        services = [
-            entry for entry in services if entry.stem in filter
-        ]
-
-    if config["SERVICES_FILTER_EXCLUDE"] != "":
-        filter = config["SERVICES_FILTER_EXCLUDE"].split(",")
-        log.verbose(f"Filtering services to not include any of {filter}")
-        services = [
-            entry for entry in services if entry.stem not in filter
-        ]
-
-    if len(services)==1:
-        log.verbose("Found one service:")
-    elif len(services)>1:
-        log.verbose(f"Found {len(services)} services:")
+def run_tool(cmd: list[str], cwd: Path | None = None) -> subprocess.CompletedProcess:
+    """Run an external tool. Its output normally goes straight to the terminal,
+    but while the log is buffered (when updating services in parallel), it is
+    captured and added to the log to stay together with the other messages.
+    The same for json logs, where it becomes records like any other message."""
+    if not log.is_buffering() and log.format != "json":
+        return subprocess.run(cmd, cwd=cwd)
+    cp = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True)
+    if cp.stdout:
+        log.raw(cp.stdout.rstrip("\n"))
+    if cp.stderr:
+        log.raw(cp.stderr.rstrip("\n"), file=sys.stderr)
+    return cp
+
+
+def format_size(num_bytes: int) -> str:
+    """Human readable size, like "12.3 MB" """
+    size = float(num_bytes)
+    for unit in ["B", "kB", "MB", "GB"]:
+        if size < 1000:
+            break
+        size /= 1000
     else:
-        log.verbose("Did not find any services.")
-    for svc in services:
-        log.verbose(f" - {svc}")
-    return services
+        unit = "TB"
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
 
 
+def get_services() -> list[Path]:
+    """The service folders, as found by the shared service registry"""
+    return Service_Registry.shared().services
+
 
-def check_dependencies():
+def check_dependencies(capabilities: Capabilities | None = None) -> Capabilities:
     """Check if the required utilities can be run"""
     config = Config()
-    tools = ["skopeo"]
+    if capabilities is None:
+        capabilities = Capabilities()
+    tools = []
+
+    if config["RESOLVER_BACKEND"] == "skopeo":
+        tools.append("skopeo")
 
     if config["SERVICE_STOP_START"]:
         tools.append(config["COMPOSE_TOOL"].split(" ")[0])
@@ -76,26 +60,29 @@ def check_dependencies():
         )
 
     if config["SERVICE_SNAPSHOT"]:
-        tools.append("snapper")
+        if config["SNAPSHOT_BACKEND"] == "btrfs":
+            tools.append(config["BTRFS_TOOL"].split(" ")[0])
+        else:
+            tools.append("snapper")
     else:
         log.vverbose(
-            "Skipping looking for snapper, as snapshotting of "
+            "Skipping looking for a snapshot tool, as snapshotting of "
             "services is disabled"
         )
 
-    for tool in tools:
-        try:
-            out = subprocess.check_output([tool, "--version"]).decode("utf-8").strip()
-            log.vverbose(f"Found tool: {out}")
-        except FileNotFoundError:
-            log.error(f"Could not find tool \"{tool}\", cannot proceed.", exit_code=exit_code.SYSTEM_ERROR)
+    for tool in capabilities.probe(tools).values():
+        if tool.path is None:
+            log.error(f"Could not find tool \"{tool.name}\", cannot proceed.", exit_code=exit_code.SYSTEM_ERROR)
+        if not tool.ok:
+            log.error(f"Could not run tool \"{tool.name}\", cannot proceed.", exit_code=exit_code.SYSTEM_ERROR)
+    return capabilities
 
 
 def prune_images():
     config = Config()
     if config["PRUNE_IMAGES"]:
         log("Pruning images..")
-        ret = subprocess.run(
+        ret = run_tool(
             config["CONTAINER_TOOL"].split(" ") + ["image", "prune", "-f"]
         ).returncode
         if ret != 0:
@@ -1,7 +1,16 @@
+import hashlib
+import json
 import os
 import subprocess
 import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from typing import Callable
+
+from cipug.config import Config
 
 def clean_env() -> dict:
     # Remove any existing cipug specific environment variables to not mess with the tests
@@ -31,3 +40,190 @@ def call_cipug(
         capture_output=True,
         text=True
     )
+
+
+def set_config(monkeypatch, settings: dict[str, object]):
+    """Replace all cipug settings in the environment of this process by the
+    given ones (names without the CIPUG_ prefix) and reload the config"""
+    for key in list(Config.settings_schema):
+        monkeypatch.delenv("CIPUG_" + key, raising=False)
+    for key, val in settings.items():
+        monkeypatch.setenv("CIPUG_" + key, str(val))
+    Config.reload()
+
+
+def wait_for(condition: Callable[[], bool], timeout: float = 15):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+class Fake_Registry:
+    """Stand-in for a container registry implementing the parts of the OCI
+    distribution API that cipug uses, including bearer token authentication.
+    Manifests are served from the `manifests` dict, keyed by (repository, tag)."""
+    def __init__(self):
+        self.manifests: dict[tuple[str, str], bytes] = {}
+        self.requests: list[tuple[str, str]] = []  # (method, path)
+        self.connections: set[int] = set()  # client ports seen
+        # Manifest GET requests left before answering them with 429, None for
+        # no limit. Like on Docker Hub, HEAD requests don't count.
+        self.rate_limit_remaining: int | None = None
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # enables keep-alive
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, headers: dict, body: bytes = b""):
+                self.send_response(status)
+                for key, val in headers.items():
+                    self.send_header(key, val)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _handle(self):
+                registry.requests.append((self.command, self.path))
+                registry.connections.add(self.client_address[1])
+                url = urllib.parse.urlsplit(self.path)
+                if url.path == "/token":
+                    scopes = urllib.parse.parse_qs(url.query).get("scope", [])
+                    token = "tok:" + ",".join(sorted(scopes))
+                    self._reply(200, {}, json.dumps({"token": token, "expires_in": 300}).encode())
+                    return
+                repository, _, reference = url.path.removeprefix("/v2/").partition("/manifests/")
+                if f"repository:{repository}:pull" not in self.headers.get("Authorization", ""):
+                    self._reply(401, {"WWW-Authenticate": (
+                        f'Bearer realm="http://{registry.address}/token",'
+                        f'service="fake",scope="repository:{repository}:pull"'
+                    )})
+                    return
+                rate_limit_headers = {}
+                if registry.rate_limit_remaining is not None:
+                    if self.command == "GET":
+                        if registry.rate_limit_remaining <= 0:
+                            self._reply(429, {"Retry-After": "3600", "RateLimit-Remaining": "0;w=21600"})
+                            return
+                        registry.rate_limit_remaining -= 1
+                    rate_limit_headers["RateLimit-Limit"] = "100;w=21600"
+                    rate_limit_headers["RateLimit-Remaining"] = f"{registry.rate_limit_remaining};w=21600"
+                body = registry.manifests.get((repository, reference))
+                if body is None and reference.startswith("sha256:"):
+                    body = next((
+                        content for (repo, _), content in registry.manifests.items()
+                        if repo == repository and "sha256:" + hashlib.sha256(content).hexdigest() == reference
+                    ), None)
+                if body is None:
+                    self._reply(404, {})
+                    return
+                digest = "sha256:" + hashlib.sha256(body).hexdigest()
+                if self.headers.get("If-None-Match") == f'"{digest}"':
+                    self._reply(304, {"ETag": f'"{digest}"'})
+                    return
+                self._reply(200, {
+                    "Content-Type": json.loads(body).get("mediaType", ""),
+                    "Docker-Content-Digest": digest,
+                    "ETag": f'"{digest}"',
+                    **rate_limit_headers,
+                }, body)
+
+            do_GET = _handle
+            do_HEAD = _handle
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.address = f"127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def push(self, repository: str, tag: str, content: str, layers: dict[str, int] | None = None) -> str:
+        """Put a (dummy) manifest into the registry, returns its digest.
+        Layers are given as digest -> size."""
+        body = json.dumps({
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.oci.image.manifest.v1+json",
+            "annotations": {"content": content},
+            "layers": [
+                {"mediaType": "application/vnd.oci.image.layer.v1.tar+gzip", "digest": digest, "size": size}
+                for digest, size in (layers or {}).items()
+            ],
+        }).encode()
+        self.manifests[(repository, tag)] = body
+        return "sha256:" + hashlib.sha256(body).hexdigest()
+
+    def push_index(self, repository: str, tag: str, children: dict[str, str]) -> str:
+        """Put an image index into the registry, pointing to the manifests
+        (digests) per platform ("os/architecture"), returns its digest"""
+        body = json.dumps({
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.oci.image.index.v1+json",
+            "manifests": [
+                {
+                    "mediaType": "application/vnd.oci.image.manifest.v1+json",
+                    "digest": digest,
+                    "size": 0,
+                    "platform": {"os": platform.split("/")[0], "architecture": platform.split("/")[1]},
+                }
+                for platform, digest in children.items()
+            ],
+        }).encode()
+        self.manifests[(repository, tag)] = body
+        return "sha256:" + hashlib.sha256(body).hexdigest()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_fake_tool(folder: Path, name: str, script: str = "") -> tuple[Path, Path]:
+    """Create an executable that stands in for an external tool like a compose
+    tool. Every call gets appended as "<folder name of cwd> <arguments>" to a
+    log file. The optional script (python code) runs afterwards and has access
+    to `args` and `cwd`. Returns the paths of the tool and the log file."""
+    tool = folder / name
+    log_file = folder / f"{name}.log"
+    tool.write_text(
+        f"#!{sys.executable}\n"
+        "import os, sys\n"
+        "from pathlib import Path\n"
+        "args = sys.argv[1:]\n"
+        "cwd = Path.cwd()\n"
+        "if args == ['--version']:\n"
+        f"    print('{name} fake')\n"
+        "    sys.exit(0)\n"
+        f"with open({str(log_file)!r}, 'a') as f:\n"
+        "    f.write(cwd.name + ' ' + ' '.join(args) + '\\n')\n"
+        + script
+    )
+    tool.chmod(0o755)
+    return tool, log_file
+
+
+def make_services(root: Path, envs: dict[str, str]) -> dict[str, object]:
+    """Create service folders with compose and .env files below root, plus a
+    fresh resolver cache for all tagged images, such that cipug can run
+    without network access. Returns the environment variables for cipug."""
+    services_root = root / "services"
+    images: dict[str, dict] = {}
+    for name, env in envs.items():
+        (services_root / name).mkdir(parents=True)
+        (services_root / name / "compose.yml").write_text("services: {}\n")
+        (services_root / name / ".env").write_text(env)
+        for line in env.splitlines():
+            key, _, val = line.partition("=")
+            if key.endswith("_IMAGE_TAGGED"):
+                images[val] = {
+                    "time": time.time(),
+                    "result": f"{val.split(':')[0]}@sha256:{'0'*63}1",
+                }
+    cache = root / "cache.json"
+    cache.write_text(json.dumps({"images": images}))
+    return {
+        "CIPUG_SERVICES_ROOT": services_root,
+        "CIPUG_CACHE_LOCATION": cache,
+        "CIPUG_SERVICE_SNAPSHOT": "false",
+        "CIPUG_PRUNE_IMAGES": "false",
+    }
@@ -0,0 +1,66 @@
+import tempfile
+from pathlib import Path
+
+from tests.helper import call_cipug, make_fake_tool, make_services
+
+OLD = "example.org/app@sha256:" + "0"*64
+
+# Instead of a snapshot, just create an empty folder
+BTRFS_SCRIPT = """
+if args[:3] == ['subvolume', 'snapshot', '-r']:
+    Path(args[4]).mkdir()
+"""
+
+
+def test_btrfs_snapshots_are_found_by_checker():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        btrfs_tool, btrfs_log = make_fake_tool(root, "btrfs", BTRFS_SCRIPT)
+        compose_tool, _ = make_fake_tool(root, "compose")
+        env = make_services(root, {
+            "app": f"SERVICE_APP_IMAGE_TAGGED=example.org/app:1\nSERVICE_APP_IMAGE_HASHED={OLD}\n",
+        })
+        env.update({
+            "CIPUG_COMPOSE_TOOL": compose_tool,
+            "CIPUG_SERVICE_SNAPSHOT": "true",
+            "CIPUG_SNAPSHOT_BACKEND": "btrfs",
+            "CIPUG_BTRFS_TOOL": btrfs_tool,
+            "CIPUG_SNAPSHOTS_DIR_BTRBK": ".btrbk",
+        })
+        cp = call_cipug(env=env, args=["--check-snapshots"])
+        assert cp.returncode != 0  # no snapshots yet
+
+        for _ in range(2):
+            (root / "services" / "app" / ".env").write_text(
+                f"SERVICE_APP_IMAGE_TAGGED=example.org/app:1\nSERVICE_APP_IMAGE_HASHED={OLD}\n"
+            )
+            cp = call_cipug(env=env, args=["--update"])
+            assert cp.returncode == 0, cp.stdout + cp.stderr
+
+        snapshots = sorted(p.name for p in (root / "services" / "app" / ".btrbk").iterdir())
+        assert len(snapshots) == 2
+        # The second one gets a _1 suffix, if both runs were within the same minute
+        assert all(name.startswith("app.") for name in snapshots)
+        assert str(root / "services" / "app") in btrfs_log.read_text()
+
+        cp = call_cipug(env=env, args=["--check-snapshots"])
+        assert cp.returncode == 0, cp.stdout + cp.stderr
+
+
+def test_btrfs_backend_needs_snapshot_dir():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        btrfs_tool, _ = make_fake_tool(root, "btrfs", BTRFS_SCRIPT)
+        env = make_services(root, {
+            "app": f"SERVICE_APP_IMAGE_TAGGED=example.org/app:1\nSERVICE_APP_IMAGE_HASHED={OLD}\n",
+        })
+        env.update({
+            "CIPUG_SERVICE_SNAPSHOT": "true",
+            "CIPUG_SERVICE_STOP_START": "false",
+            "CIPUG_SNAPSHOT_BACKEND": "btrfs",
+            "CIPUG_BTRFS_TOOL": btrfs_tool,
+        })
+        cp = call_cipug(env=env, args=["--update"])
+        assert cp.returncode != 0
+        assert "SNAPSHOTS_DIR_BTRBK" in cp.stdout + cp.stderr
+        assert OLD in (root / "services" / "app" / ".env").read_text()
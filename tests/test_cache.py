@@ -0,0 +1,72 @@
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from cipug.cache import Json_Cache_Store, Sqlite_Cache_Store
+
+
+def test_corrupt_cache_file_is_recovered():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = Path(tmpdirname) / "cache.json"
+        path.write_text('{"half-written": {"time": 1')
+        store = Json_Cache_Store(path)
+        assert store.images == {}
+        store.put("nginx:latest", {"time": 1, "result": "a@sha256:1"})
+        store.flush()
+        assert json.loads(path.read_text())["images"]["nginx:latest"]["result"] == "a@sha256:1"
+
+
+def test_legacy_cache_format_is_read():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = Path(tmpdirname) / "cache.json"
+        path.write_text(json.dumps({"nginx:latest": {"time": 1, "result": "a@sha256:1"}}))
+        assert Json_Cache_Store(path).get("nginx:latest")["result"] == "a@sha256:1"
+
+
+def test_concurrent_stores_merge():
+    # Two runs that loaded the cache at the same time must not drop each other's results
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = Path(tmpdirname) / "cache.json"
+        first = Json_Cache_Store(path)
+        second = Json_Cache_Store(path)
+        first.put("a:1", {"time": 10, "result": "a@sha256:1"})
+        second.put("b:1", {"time": 10, "result": "b@sha256:1"})
+        second.put("a:1", {"time": 5, "result": "a@sha256:old"})
+        first.flush()
+        second.flush()
+        images = Json_Cache_Store(path).images
+        assert images["a:1"]["result"] == "a@sha256:1"  # the newer one wins
+        assert images["b:1"]["result"] == "b@sha256:1"
+
+
+def test_eviction():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = Path(tmpdirname) / "cache.json"
+        store = Json_Cache_Store(path)
+        store.put("a:1", {"time": 1, "result": "a@sha256:1"})
+        store.put("b:1", {"time": 1, "result": "b@sha256:1"})
+        store.flush()
+        store = Json_Cache_Store(path)
+        store.evict({"b:1"})
+        store.flush()
+        assert list(Json_Cache_Store(path).images) == ["b:1"]
+
+
+def test_sqlite_store_keeps_history():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = Path(tmpdirname) / "cache.sqlite"
+        now = time.time()
+        store = Sqlite_Cache_Store(path)
+        store.put("a:1", {"time": now-20, "result": "a@sha256:1"})
+        store.put("a:1", {"time": now-10, "result": "a@sha256:1"})  # unchanged -> no new history
+        store.record_applied("a:1", "a@sha256:1", "svc")
+        store.put("a:1", {"time": now+10, "result": "a@sha256:2"})
+        store.put("a:1", {"time": now, "result": "a@sha256:3"})  # older -> rejected, no history
+
+        store = Sqlite_Cache_Store(path)
+        assert store.get("a:1") == {"time": now+10, "result": "a@sha256:2"}
+        assert [row[1] for row in store.history(name="a:1")] == ["a@sha256:1", "a@sha256:1", "a@sha256:2"]
+        assert [row[1] for row in store.history(service="svc")] == ["a@sha256:1"]
+        store.evict(set())
+        assert store.get("a:1") is None
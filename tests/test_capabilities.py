@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from tests.helper import call_cipug, make_fake_tool, make_services, set_config
+from cipug.capabilities import Capabilities
+from cipug.config import Config
+
+
+@pytest.fixture
+def tools_folder(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = Path(tmp)
+        (folder / "service").mkdir()
+        monkeypatch.setenv("PATH", str(folder))
+        set_config(monkeypatch, {
+            "SERVICES_ROOT": folder,
+            "CACHE_LOCATION": folder / "cache.json",
+            "COMPOSE_TOOL": "compose",
+        })
+        yield folder
+    Config.reload()
+
+
+def test_versions_are_cached_per_tool_state(tools_folder: Path):
+    tool, _ = make_fake_tool(tools_folder, "compose")
+    probe = Capabilities().probe(["compose"])["compose"]
+    assert probe.ok and probe.version == "compose fake"
+
+    # The version is taken from the cache, as long as the tool stays the same
+    cache_file = tools_folder / "cipug_capabilities.json"
+    cache = json.loads(cache_file.read_text())
+    assert list(cache.values()) == ["compose fake"]
+    cache_file.write_text(json.dumps({key: "compose cached" for key in cache}))
+    assert Capabilities().probe(["compose"])["compose"].version == "compose cached"
+
+    # Updating the tool makes it being asked again
+    stat = tool.stat()
+    os.utime(tool, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert Capabilities().probe(["compose"])["compose"].version == "compose fake"
+
+
+def test_missing_compose_tool(tools_folder: Path):
+    capabilities = Capabilities()
+    probe = capabilities.probe(["compose"])["compose"]
+    assert probe.path is None and not probe.ok
+    assert not capabilities.compose_usable(tools_folder / "service")
+    assert not (tools_folder / "cipug_capabilities.json").exists()
+
+
+def test_compose_permission_is_checked_per_service(tools_folder: Path):
+    (tools_folder / "other").mkdir()
+    _, compose_log = make_fake_tool(tools_folder, "compose", "sys.exit(1 if cwd.name == 'service' else 0)\n")
+    capabilities = Capabilities()
+    assert not capabilities.compose_usable(tools_folder / "service")
+    assert capabilities.compose_usable(tools_folder / "other")
+    # Successful checks are remembered, failed ones are not
+    assert capabilities.compose_usable(tools_folder / "other")
+    assert not capabilities.compose_usable(tools_folder / "service")
+    assert compose_log.read_text() == "service ps\nother ps\nservice ps\n"
+
+
+def test_failed_permission_check_affects_its_service_only():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        compose_tool, compose_log = make_fake_tool(
+            root, "compose", "sys.exit(1 if (cwd.name, args) == ('a', ['ps']) else 0)\n"
+        )
+        env = make_services(root, {
+            name: f"SERVICE_APP_IMAGE_TAGGED=example.org/{name}:1\n" for name in ["a", "b", "c"]
+        })
+        env["CIPUG_COMPOSE_TOOL"] = compose_tool
+        cp = call_cipug(env=env, args=["--update"])
+        assert cp.returncode == 30, cp.stdout + cp.stderr
+        calls = compose_log.read_text().splitlines()
+        assert "a up -d" not in calls
+        assert "b up -d" in calls and "c up -d" in calls
@@ -0,0 +1,122 @@
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+
+from tests.helper import Fake_Registry, clean_env, make_fake_tool, make_services, wait_for
+
+OLD = "@sha256:" + "0"*64
+
+
+def test_daemon_updates_changed_services_and_reloads():
+    registry = Fake_Registry()
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        compose_tool, compose_log = make_fake_tool(root, "compose")
+        image = f"{registry.address}/org/app"
+        digest = registry.push("org/app", "1", "v1")
+        registry.push("org/other", "1", "v1")
+        env = make_services(root, {
+            "a": f"SERVICE_APP_IMAGE_TAGGED={image}:1\nSERVICE_APP_IMAGE_HASHED={image}@{digest}\n",
+            "b": f"SERVICE_APP_IMAGE_TAGGED={registry.address}/org/other:1\n"
+                 f"SERVICE_APP_IMAGE_HASHED={registry.address}/org/other{OLD}\n",
+        })
+        (root / "cache.json").unlink()
+        env.update({
+            "CIPUG_COMPOSE_TOOL": compose_tool,
+            "CIPUG_CONTAINER_TOOL": compose_tool,
+            "CIPUG_INSECURE_REGISTRIES": registry.address,
+            "CIPUG_CACHE_DURATION": 0,
+            "CIPUG_DAEMON_MIN_INTERVAL": 0.5,
+        })
+        env_complete = clean_env()
+        env_complete.update({key: str(val) for key, val in env.items()})
+        daemon = subprocess.Popen(
+            [sys.executable, "-m", "cipug", "--daemon"],
+            cwd=Path(__file__).resolve().parent.parent,
+            env=env_complete,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True
+        )
+        services = root / "services"
+        try:
+            # "b" is outdated from the start, "a" is up to date
+            def restarted() -> set[str]:
+                if not compose_log.exists():
+                    return set()
+                return {line.split()[0] for line in compose_log.read_text().splitlines() if "up" in line.split()}
+            wait_for(lambda: restarted() == {"b"})
+            assert OLD not in (services / "b" / ".env").read_text()
+
+            # A new version of "a" gets picked up with one of the next polls
+            new_digest = registry.push("org/app", "1", "v2")
+            wait_for(lambda: restarted() == {"a", "b"})
+            assert new_digest in (services / "a" / ".env").read_text()
+
+            # New services are noticed right away
+            (services / "c").mkdir()
+            (services / "c" / "compose.yml").write_text("services: {}\n")
+            (services / "c" / ".env").write_text(
+                f"SERVICE_APP_IMAGE_TAGGED={image}:1\nSERVICE_APP_IMAGE_HASHED={image}{OLD}\n"
+            )
+            wait_for(lambda: "c" in restarted())
+            assert new_digest in (services / "c" / ".env").read_text()
+
+            daemon.send_signal(signal.SIGHUP)
+            time.sleep(1)
+        finally:
+            daemon.send_signal(signal.SIGTERM)
+            output, _ = daemon.communicate(timeout=15)
+            registry.close()
+        assert daemon.returncode == 0, output
+        assert "Reloading config" in output
+
+
+def test_reloading_does_not_leak():
+    if not Path("/proc/self/fd").is_dir():
+        pytest.skip("/proc is not available")
+    registry = Fake_Registry()
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        compose_tool, _ = make_fake_tool(root, "compose")
+        image = f"{registry.address}/org/app"
+        digest = registry.push("org/app", "1", "v1")
+        env = make_services(root, {
+            "a": f"SERVICE_APP_IMAGE_TAGGED={image}:1\nSERVICE_APP_IMAGE_HASHED={image}@{digest}\n",
+        })
+        env.update({
+            "CIPUG_COMPOSE_TOOL": compose_tool,
+            "CIPUG_CONTAINER_TOOL": compose_tool,
+            "CIPUG_INSECURE_REGISTRIES": registry.address,
+            "CIPUG_CACHE_BACKEND": "sqlite",
+            "CIPUG_CACHE_DB_LOCATION": root / "cache.sqlite",
+            "CIPUG_CACHE_DURATION": 0,
+            "CIPUG_DAEMON_MIN_INTERVAL": 0.2,
+        })
+        env_complete = clean_env()
+        env_complete.update({key: str(val) for key, val in env.items()})
+        daemon = subprocess.Popen(
+            [sys.executable, "-m", "cipug", "--daemon"],
+            cwd=Path(__file__).resolve().parent.parent,
+            env=env_complete,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        open_files = Path(f"/proc/{daemon.pid}/fd")
+        try:
+            time.sleep(1.5)
+            before = len(list(open_files.iterdir()))
+            for _ in range(5):
+                daemon.send_signal(signal.SIGHUP)
+                time.sleep(0.6)
+            after = len(list(open_files.iterdir()))
+        finally:
+            daemon.send_signal(signal.SIGTERM)
+            daemon.wait(timeout=15)
+            registry.close()
+        assert after <= before
@@ -0,0 +1,101 @@
+import os
+import tempfile
+from pathlib import Path
+
+from cipug.env import Env
+
+CONTENT = (
+    "# Images\n"
+    "SERVICE_APP_IMAGE_TAGGED=example.org/app:1\n"
+    "SERVICE_APP_IMAGE_HASHED=example.org/app@sha256:1\n"
+    "\n"
+    "  # indented comment\n"
+    "MULTI=first\\\n"
+    "second\n"
+    "LAST=no newline at the end"
+)
+
+
+def test_only_changed_lines_are_rewritten():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / ".env"
+        path.write_text(CONTENT)
+        os.chmod(path, 0o600)
+        env = Env(path)
+        assert env["MULTI"] == "first\\\nsecond"
+        env["SERVICE_APP_IMAGE_HASHED"] = "example.org/app@sha256:2"
+        env.write()
+        assert path.read_text() == CONTENT.replace("sha256:1", "sha256:2")
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        assert not env.has_changes()
+        assert [p.name for p in Path(tmp).iterdir()] == [".env"]  # no temp files left
+
+
+def test_identical_content_is_not_written():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / ".env"
+        path.write_text(CONTENT)
+        before = os.stat(path)
+        env = Env(path)
+        env["SERVICE_APP_IMAGE_HASHED"] = "example.org/app@sha256:2"
+        env["SERVICE_APP_IMAGE_HASHED"] = "example.org/app@sha256:1"
+        env.write()
+        after = os.stat(path)
+        assert (before.st_ino, before.st_mtime_ns) == (after.st_ino, after.st_mtime_ns)
+
+
+def test_line_endings_and_new_entries():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / ".env"
+        path.write_bytes(b"A=1\r\n# comment\r\nB=2")
+        env = Env(path)
+        env["A"] = "3"
+        env["C"] = "4"
+        del env["B"]
+        env.write()
+        assert path.read_bytes() == b"A=3\r\n# comment\r\nC=4\r\n"
+
+
+def test_concurrent_edits_are_kept():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / ".env"
+        path.write_text("A=1\nB=2\n")
+        env = Env(path)
+        env["A"] = "3"
+        # Someone edits the file while cipug works on it
+        path.write_text("A=1\n# new comment\nB=5\n")
+        env.write()
+        assert path.read_text() == "A=3\n# new comment\nB=5\n"
+        assert env["B"] == "5"
+
+
+def test_new_file_gets_all_entries():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / ".env"
+        path.write_text(CONTENT)
+        env = Env(path)
+        env["SERVICE_APP_IMAGE_HASHED"] = "example.org/app@sha256:2"
+        copy_path = Path(tmp) / "copy.env"
+        env.write(copy_path)
+        assert Env(copy_path) == env
+        assert os.stat(copy_path).st_mode & 0o777 == 0o600
+        # The original is left alone
+        assert path.read_text() == CONTENT
+
+
+def test_temp_file_is_never_readable_by_others(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / ".env"
+        path.write_text(CONTENT)
+        os.chmod(path, 0o600)
+        env = Env(path)
+        env["SERVICE_APP_IMAGE_HASHED"] = "example.org/app@sha256:2"
+        modes: list[int] = []
+        fsync = os.fsync
+
+        def checked_fsync(fd: int):
+            modes.append(os.fstat(fd).st_mode & 0o777)
+            fsync(fd)
+        monkeypatch.setattr(os, "fsync", checked_fsync)
+        env.write()
+        assert modes == [0o600]
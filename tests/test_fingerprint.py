@@ -0,0 +1,45 @@
+import json
+import tempfile
+from pathlib import Path
+
+from tests.helper import call_cipug, make_fake_tool, make_services
+
+NEW = "example.org/app@sha256:" + "0"*63 + "1"
+NEWER = "example.org/app@sha256:" + "0"*63 + "2"
+SKIPPED = "unchanged since the last run"
+
+
+def test_unchanged_services_are_skipped():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        compose_tool, _ = make_fake_tool(root, "compose")
+        env = make_services(root, {
+            "app": f"SERVICE_APP_IMAGE_TAGGED=example.org/app:1\nSERVICE_APP_IMAGE_HASHED={NEW}\n",
+        })
+        env["CIPUG_COMPOSE_TOOL"] = compose_tool
+        env_file = root / "services" / "app" / ".env"
+
+        cp = call_cipug(env=env, args=["--update"])
+        assert cp.returncode == 0 and SKIPPED not in cp.stdout
+        cp = call_cipug(env=env, args=["--update"])
+        assert cp.returncode == 0 and SKIPPED in cp.stdout
+        cp = call_cipug(env={**env, "CIPUG_FULL_CHECK": "true"}, args=["--update"])
+        assert cp.returncode == 0 and SKIPPED not in cp.stdout
+
+        # Editing the .env invalidates the fingerprint
+        env_file.write_text(env_file.read_text() + "OTHER=1\n")
+        cp = call_cipug(env=env, args=["--update"])
+        assert SKIPPED not in cp.stdout
+        cp = call_cipug(env=env, args=["--update"])
+        assert SKIPPED in cp.stdout
+
+        # So does a new digest of the tag
+        cache_file = root / "cache.json"
+        cache = json.loads(cache_file.read_text())
+        cache["images"]["example.org/app:1"]["result"] = NEWER
+        cache_file.write_text(json.dumps(cache))
+        cp = call_cipug(env=env, args=["--update"])
+        assert cp.returncode == 0 and SKIPPED not in cp.stdout
+        assert NEWER in env_file.read_text()
+        cp = call_cipug(env=env, args=["--update"])
+        assert SKIPPED in cp.stdout
@@ -0,0 +1,62 @@
+import tempfile
+from pathlib import Path
+
+from tests.helper import call_cipug, make_fake_tool, make_services
+
+OLD = "example.org/app@sha256:" + "0"*64
+
+# Containers crash with the new image (the one make_services puts into the cache)
+CONTAINER_TOOL_SCRIPT = """
+import json
+if args[:1] == ['inspect']:
+    crashing = 'sha256:' + '0'*63 + '1' in (cwd / '.env').read_text()
+    print(json.dumps([{
+        'Name': 'app-1',
+        'RestartCount': 0,
+        'State': {'Status': 'exited' if crashing else 'running', 'ExitCode': 1 if crashing else 0},
+    }]))
+"""
+COMPOSE_TOOL_SCRIPT = """
+if args == ['ps', '-q']:
+    print('abc123')
+"""
+
+
+def run_health_checked_update(root: Path, container_tool_script: str = CONTAINER_TOOL_SCRIPT) -> tuple:
+    compose_tool, compose_log = make_fake_tool(root, "compose", COMPOSE_TOOL_SCRIPT)
+    container_tool, _ = make_fake_tool(root, "container", container_tool_script)
+    env = make_services(root, {
+        "app": f"SERVICE_APP_IMAGE_TAGGED=example.org/app:1\nSERVICE_APP_IMAGE_HASHED={OLD}\n",
+    })
+    env.update({
+        "CIPUG_COMPOSE_TOOL": compose_tool,
+        "CIPUG_CONTAINER_TOOL": container_tool,
+        "CIPUG_HEALTH_CHECK": "true",
+        "CIPUG_HEALTH_CHECK_INTERVAL": 0.05,
+        "CIPUG_HEALTH_CHECK_SETTLE": 0.1,
+        "CIPUG_HEALTH_CHECK_TIMEOUT": 5,
+    })
+    return call_cipug(env=env, args=["--update"]), compose_log
+
+
+def test_unhealthy_service_is_rolled_back():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        root = Path(tmpdirname)
+        cp, compose_log = run_health_checked_update(root)
+        assert cp.returncode == 37, cp.stdout + cp.stderr  # SERVICE_UNHEALTHY
+        assert f"SERVICE_APP_IMAGE_HASHED={OLD}" in (root / "services" / "app" / ".env").read_text()
+        calls = compose_log.read_text().splitlines()
+        assert calls.count("app up -d") == 2
+        assert "Rolled back service \"app\"" in cp.stdout
+
+
+def test_time_to_healthy_is_reported():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        root = Path(tmpdirname)
+        cp, _ = run_health_checked_update(
+            root,
+            CONTAINER_TOOL_SCRIPT.replace("crashing = ", "crashing = False and ")
+        )
+        assert cp.returncode == 0, cp.stdout + cp.stderr
+        assert "Time until services were healthy" in cp.stdout
+        assert f"SERVICE_APP_IMAGE_HASHED={OLD}" not in (root / "services" / "app" / ".env").read_text()
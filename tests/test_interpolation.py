@@ -0,0 +1,54 @@
+import tempfile
+from pathlib import Path
+
+from cipug.env import Env, Interpolator
+
+
+def test_nested_references_and_defaults():
+    interpolator = Interpolator({
+        "REGISTRY": "example.org",
+        "REPO": "${REGISTRY}/${NAME:-app}",
+        "TAG": "${VERSION-1.0}",
+        "EMPTY": "",
+        "IMAGE": "${REPO}:${TAG}",
+        "OTHER": "${REPO}:${EMPTY:-latest}-${EMPTY-x}",
+        "UNKNOWN": "${MISSING}/app",
+    })
+    assert interpolator.resolve("IMAGE") == "example.org/app:1.0"
+    assert interpolator.resolve("OTHER") == "example.org/app:latest-"
+    assert interpolator.resolve("UNKNOWN") == "${MISSING}/app"
+
+
+def test_references_within_defaults():
+    interpolator = Interpolator({
+        "B": "x",
+        "EMPTY": "",
+        "IMG": "${A:-${B}}/app",
+        "DEEP": "${A-${EMPTY:-${C:-${B}y}}}/${B}",
+        "UNKNOWN": "${A:-${MISSING}}",
+        "BROKEN": "${A:-${B}/app",
+    })
+    assert interpolator.resolve("IMG") == "x/app"
+    assert interpolator.resolve("DEEP") == "xy/x"
+    assert interpolator.resolve("UNKNOWN") == "${MISSING}"
+    assert interpolator.resolve("BROKEN") == "${A:-${B}/app"
+
+
+def test_cycles_are_kept_as_they_are():
+    interpolator = Interpolator({"A": "x${B}", "B": "y${A}", "C": "${C}"})
+    assert interpolator.resolve("A") == "xy${A}"
+    assert interpolator.resolve("C") == "${C}"
+
+
+def test_tagged_images_follow_changes():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / ".env"
+        path.write_text(
+            "VERSION=1\n"
+            "SERVICE_APP_IMAGE_TAGGED=example.org/app:${VERSION}\n"
+            "SERVICE_DB_IMAGE_TAGGED=example.org/db:latest\n"
+        )
+        env = Env(path)
+        assert env.tagged_images() == {"APP": "example.org/app:1", "DB": "example.org/db:latest"}
+        env["VERSION"] = "2"
+        assert env.tagged_images()["APP"] == "example.org/app:2"
@@ -0,0 +1,91 @@
+import json
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from tests.helper import call_cipug, make_fake_tool, make_services
+from cipug.colors import colors
+from cipug.log import log
+
+
+@pytest.fixture
+def logger(monkeypatch):
+    monkeypatch.setattr(log, "verbosity", 1)
+    monkeypatch.setattr(log, "format", "text")
+    monkeypatch.setattr(log, "color", "auto")
+    log.reset_timings()
+    yield log
+    log.reset_timings()
+
+
+def test_messages_are_built_lazily(logger, capsys):
+    def expensive() -> str:
+        raise AssertionError("must not be called")
+    logger.vverbose(expensive)
+    logger(lambda: "shown", verbosity=1)
+    assert capsys.readouterr().out == "shown\n"
+
+
+def test_colors_only_when_wanted(logger, capsys, monkeypatch):
+    logger("text", highlight=True)
+    assert capsys.readouterr().out == "text\n"  # not a terminal
+    monkeypatch.setattr(log, "color", "always")
+    logger("text", highlight=True)
+    assert capsys.readouterr().out == f"{colors.Yellow}text{colors.Reset}\n"
+
+
+def test_json_lines(logger, capsys, monkeypatch):
+    monkeypatch.setattr(log, "format", "json")
+    with logger.span("pull", "app"):
+        logger(f"{colors.Green}pulled{colors.Reset}")
+    logger.error("failed")
+    out, err = capsys.readouterr()
+    record = json.loads(out)
+    assert (record["level"], record["msg"], record["service"], record["phase"]) == ("info", "pulled", "app", "pull")
+    assert json.loads(err)["level"] == "error"
+
+    logger.timings_summary()
+    timings = json.loads(capsys.readouterr().out)["timings"]
+    assert list(timings) == ["app"] and list(timings["app"]) == ["pull"]
+
+
+def test_timings_table(logger, capsys):
+    with logger.span("resolve"):
+        pass
+    for service in ["b", "a"]:
+        with logger.span("up", service):
+            pass
+        with logger.span("down", service):
+            pass
+    logger.timings_summary()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[1].split() == ["service", "resolve", "down", "up", "total"]
+    assert [line.split()[0] for line in lines[2:]] == ["(all)", "a", "b"]
+    logger.timings_summary()  # started over
+    assert capsys.readouterr().out == ""
+
+
+def test_tool_output_is_json_too():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        chatty = "print('Container app  Started')\nprint('progress', file=sys.stderr)\n"
+        compose_tool, compose_log = make_fake_tool(root, "compose", chatty)
+        container_tool, _ = make_fake_tool(root, "docker", chatty)
+        env = make_services(root, {
+            "app": f"SERVICE_APP_IMAGE_TAGGED=example.org/app:1\nSERVICE_APP_IMAGE_HASHED=example.org/app@sha256:{'0'*64}\n",
+        })
+        env.update({
+            "CIPUG_COMPOSE_TOOL": compose_tool,
+            "CIPUG_CONTAINER_TOOL": container_tool,
+            "CIPUG_PRUNE_IMAGES": "true",
+            "CIPUG_LOG_FORMAT": "json",
+            "CIPUG_VERBOSITY": 3,
+        })
+        cp = call_cipug(env=env, args=["--update"])
+        assert cp.returncode == 0, cp.stdout + cp.stderr
+        assert "app up -d" in compose_log.read_text()
+        records = [json.loads(line) for line in cp.stdout.splitlines()]
+        assert ("output", "Container app  Started") in [(record["level"], record["msg"]) for record in records]
+        for line in cp.stderr.splitlines():
+            json.loads(line)
@@ -0,0 +1,81 @@
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+from tests.helper import call_cipug, clean_env, make_fake_tool, make_services
+
+OLD = "example.org/{}@sha256:" + "0"*64
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def scrape(port: int, timeout: float = 10) -> str:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                return response.read().decode()
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def test_serve_metrics():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        compose_tool, _ = make_fake_tool(root, "compose", "sys.exit(1 if args[:1] == ['up'] and cwd.name == 'b' else 0)")
+        env = make_services(root, {
+            name: f"SERVICE_APP_IMAGE_TAGGED=example.org/{name}:1\nSERVICE_APP_IMAGE_HASHED={OLD.format(name)}\n"
+            for name in ["a", "b"]
+        })
+        env.update({"CIPUG_COMPOSE_TOOL": compose_tool, "CIPUG_SNAPSHOTS_DIR_BTRBK": ".btrbk"})
+        (root / "services" / "a" / ".btrbk").mkdir()
+        (root / "services" / "b" / ".btrbk").mkdir()
+        (root / "services" / "a" / ".btrbk" / f"a.{time.strftime('%Y%m%dT%H%M')}").mkdir()
+        cp = call_cipug(env=env, args=["--update"])
+        assert cp.returncode != 0  # "b" failed to start
+        # "b" was put back to the old image by hand
+        (root / "services" / "b" / ".env").write_text(
+            f"SERVICE_APP_IMAGE_TAGGED=example.org/b:1\nSERVICE_APP_IMAGE_HASHED={OLD.format('b')}\n"
+        )
+
+        port = free_port()
+        env_complete = clean_env()
+        env_complete.update({key: str(val) for key, val in env.items()})
+        env_complete["CIPUG_METRICS_PORT"] = str(port)
+        server = subprocess.Popen(
+            [sys.executable, "-m", "cipug", "--serve-metrics"],
+            cwd=Path(__file__).resolve().parent.parent,
+            env=env_complete,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        try:
+            metrics = scrape(port)
+        finally:
+            server.terminate()
+            server.wait()
+
+        samples = {
+            line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+            for line in metrics.splitlines() if not line.startswith("#")
+        }
+        assert samples['cipug_snapshot_present{service="a",kind="btrbk"}'] == 1
+        assert samples['cipug_snapshot_present{service="b",kind="btrbk"}'] == 0
+        assert samples['cipug_snapshot_age_seconds{service="a",kind="btrbk"}'] < 120
+        assert samples['cipug_image_up_to_date{service="a",image="example.org/a:1"}'] == 1
+        assert samples['cipug_image_up_to_date{service="b",image="example.org/b:1"}'] == 0
+        assert samples['cipug_last_run_success{service="a"}'] == 1
+        assert samples['cipug_last_run_success{service="b"}'] == 0
+        assert samples['cipug_last_run_exit_code{service="b"}'] == 34
+        assert 'cipug_last_update_timestamp_seconds{service="a"}' in samples
+        assert 'cipug_last_update_timestamp_seconds{service="b"}' not in samples
@@ -0,0 +1,58 @@
+import re
+import tempfile
+from pathlib import Path
+
+from tests.helper import call_cipug, make_fake_tool, make_services
+
+OLD = "@sha256:" + "0"*64
+
+# Keeps track of how many services are worked on at the same time and lets
+# pulling of service "c" and starting of service "d" fail
+COMPOSE_TOOL_SCRIPT = """
+import time
+running = cwd.parent.parent / 'running'
+running.mkdir(exist_ok=True)
+marker = running / cwd.name
+marker.touch()
+count = len(list(running.iterdir()))
+with open(running.parent / 'max_running', 'a') as f:
+    f.write(f'{count}\\n')
+time.sleep(0.2)
+marker.unlink()
+if (cwd.name, args[:1]) in [('c', ['pull']), ('d', ['up'])]:
+    sys.exit(1)
+"""
+
+
+def test_parallel_updates():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        root = Path(tmpdirname)
+        compose_tool, compose_log = make_fake_tool(root, "compose", COMPOSE_TOOL_SCRIPT)
+        env = make_services(root, {
+            name: f"SERVICE_APP_IMAGE_TAGGED=example.org/{name}:1\nSERVICE_APP_IMAGE_HASHED=example.org/{name}{OLD}\n"
+            for name in "abcde"
+        })
+        env.update({
+            "CIPUG_COMPOSE_TOOL": compose_tool,
+            "CIPUG_UPDATE_CONCURRENCY": 2,
+        })
+        cp = call_cipug(env=env, args=["--update"])
+
+        # Different errors are reported as one exit code
+        assert cp.returncode == 255, cp.stdout + cp.stderr
+        assert "33=IMAGE_PULL_ERROR" in cp.stderr
+        assert "34=SERVICE_RESTART_ERROR" in cp.stderr
+        calls = compose_log.read_text().splitlines()
+        assert "c up -d" not in calls
+        for name in "abde":
+            assert f"{name} up -d" in calls
+
+        # Never more than 2 services at once, but more than one
+        counts = [int(line) for line in (root / "max_running").read_text().split()]
+        assert max(counts) == 2
+
+        # The output of each service is kept together
+        _, _, applying = cp.stdout.partition("Working on up to 2 services in parallel")
+        services_per_line = re.findall(r'(?:service|Starting) "(\w)"', applying)
+        blocks = [name for idx, name in enumerate(services_per_line) if idx == 0 or services_per_line[idx-1] != name]
+        assert sorted(blocks) == list("abcde")
@@ -0,0 +1,121 @@
+import json
+import tempfile
+from pathlib import Path
+
+from tests.helper import Fake_Registry, call_cipug, make_fake_tool, make_services
+
+OLD = "example.org/app@sha256:" + "0"*64
+NEW = "example.org/app@sha256:" + "0"*63 + "1"
+
+
+def test_plan_and_apply_it():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        compose_tool, compose_log = make_fake_tool(root, "compose")
+        env = make_services(root, {
+            "app": f"SERVICE_APP_IMAGE_TAGGED=example.org/app:1\nSERVICE_APP_IMAGE_HASHED={OLD}\n",
+            "other": f"SERVICE_APP_IMAGE_TAGGED=example.org/app:1\nSERVICE_APP_IMAGE_HASHED={NEW}\n",
+            "stale": f"SERVICE_APP_IMAGE_TAGGED=example.org/app:1\nSERVICE_APP_IMAGE_HASHED={OLD}\n",
+        })
+        env["CIPUG_COMPOSE_TOOL"] = compose_tool
+        services = root / "services"
+
+        cp = call_cipug(env={**env, "CIPUG_VERBOSITY": 3}, args=["--plan"])
+        assert cp.returncode == 0, cp.stderr
+        plan = json.loads(cp.stdout)  # nothing but the plan on stdout
+        assert "Loaded cipug config" in cp.stderr
+        assert plan["services"]["other"]["status"] == "up-to-date"
+        assert plan["services"]["app"]["status"] == "update"
+        assert plan["services"]["app"]["images"] == {
+            "APP": {"image": "example.org/app:1", "current": OLD, "new": NEW}
+        }
+        assert plan["cost"] == {"registry_requests": 0, "images_to_pull": [NEW]}
+        assert OLD in (services / "app" / ".env").read_text()
+        assert not compose_log.exists()
+
+        # Changed after planning, hence not touched
+        stale_env = services / "stale" / ".env"
+        stale_env.write_text(stale_env.read_text().replace(":1", ":2"))
+        # The cache must not be needed anymore
+        (root / "cache.json").write_text(json.dumps({"images": {}}))
+        plan_file = root / "plan.json"
+        plan_file.write_text(cp.stdout)
+        cp = call_cipug(env=env, args=["--apply-plan", str(plan_file)])
+        assert cp.returncode == 26, cp.stdout + cp.stderr
+        assert NEW in (services / "app" / ".env").read_text()
+        assert OLD in stale_env.read_text()
+        assert compose_log.read_text().splitlines() == ["app ps", "app pull", "app down", "app up -d"]
+
+
+def test_invalid_plan():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        compose_tool, _ = make_fake_tool(root, "compose")
+        env = make_services(root, {"app": "SERVICE_APP_IMAGE_TAGGED=example.org/app:1\n"})
+        env["CIPUG_COMPOSE_TOOL"] = compose_tool
+        plan_file = root / "plan.json"
+        plan_file.write_text("not json")
+        cp = call_cipug(env=env, args=["--apply-plan", str(plan_file)])
+        assert cp.returncode == 26
+
+
+def test_plan_estimates_download_size():
+    registry = Fake_Registry()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            old = registry.push("org/app", "old", "v1", layers={"sha256:base": 1000, "sha256:app1": 10})
+            new = registry.push("org/app", "1", "v2", layers={"sha256:base": 1000, "sha256:app2": 20})
+            image = f"{registry.address}/org/app"
+            # The container tool has the old image
+            container_tool, _ = make_fake_tool(
+                root, "container", f"sys.exit(0 if args[-1] == '{image}@{old}' else 1)\n"
+            )
+            env = make_services(root, {
+                "app": f"SERVICE_APP_IMAGE_TAGGED={image}:1\nSERVICE_APP_IMAGE_HASHED={image}@{old}\n",
+            })
+            env["CIPUG_INSECURE_REGISTRIES"] = registry.address
+            env["CIPUG_CONTAINER_TOOL"] = container_tool
+            env["CIPUG_ESTIMATE_PULL_SIZE"] = "true"
+            cache = json.loads((root / "cache.json").read_text())
+            cache["images"][f"{image}:1"]["result"] = f"{image}@{new}"
+            (root / "cache.json").write_text(json.dumps(cache))
+
+            cp = call_cipug(env=env, args=["--plan"])
+            assert cp.returncode == 0, cp.stderr
+            plan = json.loads(cp.stdout)
+            assert plan["services"]["app"]["download_bytes"] == 20
+            assert plan["cost"]["download_bytes"] == 20
+            assert plan["cost"]["registry_requests"] > 0
+    finally:
+        registry.close()
+
+
+def test_deferred_services_are_not_up_to_date():
+    registry = Fake_Registry()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            env = make_services(root, {
+                name: f"SERVICE_APP_IMAGE_TAGGED={registry.address}/org/{name}:1\n"
+                      f"SERVICE_APP_IMAGE_HASHED={registry.address}/org/{name}@sha256:{'0'*64}\n"
+                for name in ["a", "b"]
+            })
+            (root / "cache.json").unlink()
+            for name in ["a", "b"]:
+                child = registry.push(f"org/{name}", "child", "v1")
+                registry.push_index(f"org/{name}", "1", {"plan9/mips": child})
+            registry.rate_limit_remaining = 1
+            env.update({
+                "CIPUG_INSECURE_REGISTRIES": registry.address,
+                "CIPUG_RESOLVE_CONCURRENCY": 1,
+                "CIPUG_RATE_LIMIT_RESERVE": 0,
+            })
+            cp = call_cipug(env=env, args=["--plan"])
+            assert cp.returncode == 0, cp.stderr
+            plan = json.loads(cp.stdout)
+            assert {name: entry["status"] for name, entry in plan["services"].items()} == {
+                "a": "update", "b": "deferred"
+            }
+    finally:
+        registry.close()
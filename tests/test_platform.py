@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from tests.helper import Fake_Registry, make_fake_tool, set_config
+from cipug.config import Config
+from cipug.registry import local_platform
+from cipug.resolver import Image_Version_Resolver
+
+PLATFORM = "/".join(local_platform())
+
+
+@pytest.fixture
+def multi_arch(monkeypatch):
+    registry = Fake_Registry()
+    with tempfile.TemporaryDirectory() as tmp:
+        set_config(monkeypatch, {
+            "SERVICES_ROOT": tmp,
+            "CACHE_LOCATION": str(Path(tmp) / "cache.json"),
+            "CACHE_DURATION": "0",
+            "INSECURE_REGISTRIES": registry.address,
+        })
+        yield registry, monkeypatch
+    registry.close()
+    Config.reload()
+
+
+def push(registry: Fake_Registry, local: str, other: str) -> tuple[str, str]:
+    """Push a multi-arch image, returns the digests of the index and of the local image"""
+    local_digest = registry.push("org/app", f"local-{local}", local)
+    other_digest = registry.push("org/app", f"other-{other}", other)
+    children = {PLATFORM: local_digest, "linux/other": other_digest}
+    registry.push_index("org/app", f"index-{local}-{other}", children)  # keeps it available by digest
+    index = registry.push_index("org/app", "latest", children)
+    return index, local_digest
+
+
+def resolve(name: str) -> str:
+    resolver = Image_Version_Resolver()
+    result = resolver.resolve_image_version(name)
+    resolver.flush()
+    return result
+
+
+def test_index_changes_for_other_platforms_only(multi_arch):
+    registry, _ = multi_arch
+    name = f"{registry.address}/org/app:latest"
+    index, _ = push(registry, "v1", "v1")
+    assert resolve(name).endswith(index)
+
+    # Only the image of another platform changed, the pin stays
+    push(registry, "v1", "v2")
+    assert resolve(name).endswith(index)
+    assert resolve(name).endswith(index)
+
+    # Our platform changed
+    new_index, _ = push(registry, "v2", "v2")
+    assert resolve(name).endswith(new_index)
+
+
+def test_pin_platform_digest(multi_arch):
+    registry, monkeypatch = multi_arch
+    monkeypatch.setenv("CIPUG_PIN_PLATFORM_DIGEST", "true")
+    Config.reload()
+    name = f"{registry.address}/org/app:latest"
+    _, local_digest = push(registry, "v1", "v1")
+    assert resolve(name) == f"{registry.address}/org/app@{local_digest}"
+    push(registry, "v1", "v2")
+    assert resolve(name) == f"{registry.address}/org/app@{local_digest}"
+
+    # Switching back pins the index again
+    monkeypatch.setenv("CIPUG_PIN_PLATFORM_DIGEST", "false")
+    Config.reload()
+    index, _ = push(registry, "v1", "v2")
+    assert resolve(name).endswith(index)
+
+
+def test_single_arch_manifests_are_not_fetched(multi_arch):
+    registry, _ = multi_arch
+    digest = registry.push("org/single", "latest", "v1")
+    assert resolve(f"{registry.address}/org/single:latest").endswith(digest)
+    assert [method for method, path in registry.requests if "/manifests/" in path] == ["HEAD", "HEAD"]
+
+
+def test_skopeo_is_asked_once_per_lookup(monkeypatch, tmp_path: Path):
+    manifests = tmp_path / "manifests"
+    manifests.mkdir()
+    # Serves the raw manifest stored for the tag
+    _, skopeo_log = make_fake_tool(
+        tmp_path, "skopeo",
+        f"sys.stdout.buffer.write(Path({str(manifests)!r}, args[-1].rpartition(':')[2]).read_bytes())\n"
+    )
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    set_config(monkeypatch, {
+        "SERVICES_ROOT": tmp_path,
+        "CACHE_LOCATION": str(tmp_path / "cache.json"),
+        "CACHE_DURATION": "0",
+        "RESOLVER_BACKEND": "skopeo",
+    })
+
+    def push_index(children: dict[str, str]) -> str:
+        body = json.dumps({"manifests": [
+            {"digest": digest, "platform": {"os": platform.split("/")[0], "architecture": platform.split("/")[1]}}
+            for platform, digest in children.items()
+        ]}).encode()
+        (manifests / "latest").write_bytes(body)
+        return "sha256:" + hashlib.sha256(body).hexdigest()
+
+    try:
+        index = push_index({PLATFORM: "sha256:" + "1"*64, "linux/other": "sha256:" + "2"*64})
+        assert resolve("example.org/org/app:latest") == f"example.org/org/app@{index}"
+        # Only the image of another platform changed, what the previous index
+        # pointed to is known from the cache
+        push_index({PLATFORM: "sha256:" + "1"*64, "linux/other": "sha256:" + "3"*64})
+        assert resolve("example.org/org/app:latest") == f"example.org/org/app@{index}"
+    finally:
+        Config.reload()
+    calls = [line.split(" ", 1)[1] for line in skopeo_log.read_text().splitlines()]
+    assert calls == ["inspect --raw docker://example.org/org/app:latest"] * 2
@@ -0,0 +1,119 @@
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+
+from tests.helper import Fake_Registry, call_cipug, make_fake_tool, make_services, set_config
+from cipug.config import Config
+from cipug.registry import Image_Reference
+from cipug.ratelimit import Token_Bucket, parse_rate_limit_header
+from cipug.resolver import Image_Version_Resolver, Lookup_Deferred
+
+
+def test_parse_rate_limit_header():
+    assert parse_rate_limit_header("100;w=21600") == (100, 21600)
+    assert parse_rate_limit_header("76") == (76, 0)
+    assert parse_rate_limit_header("") is None
+
+
+def test_token_bucket_refills_over_window():
+    bucket = Token_Bucket(limit=100, window=100, remaining=0, now=time.time() - 10)
+    # One token per second, 10s passed
+    assert 9.9 < bucket.available() < 10.5
+    assert bucket.take(5)
+    assert not bucket.take(100)
+    assert bucket.time_until(1) == 0
+
+
+@pytest.fixture
+def resolver_env(monkeypatch):
+    registry = Fake_Registry()
+    with tempfile.TemporaryDirectory() as tmp:
+        set_config(monkeypatch, {
+            "SERVICES_ROOT": tmp,
+            "CACHE_LOCATION": str(Path(tmp) / "cache.json"),
+            "CACHE_DURATION": "0",
+            "INSECURE_REGISTRIES": registry.address,
+            "RATE_LIMIT_RESERVE": "1",
+            "RESOLVE_CONCURRENCY": "1",
+        })
+        yield registry, Path(tmp)
+    registry.close()
+    Config.reload()
+
+
+def test_oldest_cache_entries_are_looked_up_first(resolver_env):
+    registry, root = resolver_env
+    names = [f"{registry.address}/org/app{idx}:1" for idx in range(5)]
+    for idx in range(5):
+        # Image indexes, to find out their platforms the manifest is fetched
+        child = registry.push(f"org/app{idx}", "child", "v1")
+        registry.push_index(f"org/app{idx}", "1", {"plan9/mips": child})
+    stale = {"result": "stale@sha256:" + "0"*64}
+    (root / "cache.json").write_text(json.dumps({"images": {
+        names[1]: {"time": 100, **stale},
+        names[2]: {"time": 200, **stale},
+        names[4]: {"time": 300, **stale},
+    }}))
+    registry.rate_limit_remaining = 3
+    resolver = Image_Version_Resolver()
+    resolver.registry.head_manifest(Image_Reference(names[0]))  # now the budget is known: 3 left
+
+    results = resolver.resolve_image_versions(names[1:])
+    # The lookups (HEAD requests) are free, but fetching the indexes isn't:
+    # 3 left, minus the reserve of 1, for the two oldest ones
+    assert isinstance(results[names[3]], str)  # not cached at all
+    assert isinstance(results[names[1]], str)
+    assert isinstance(results[names[2]], Lookup_Deferred)
+    assert isinstance(results[names[4]], Lookup_Deferred)
+    assert "2 deferred" in resolver.summary()
+    with pytest.raises(Lookup_Deferred):
+        resolver.resolve_image_version(names[2])
+
+
+def test_lookups_of_single_arch_images_are_not_deferred(resolver_env):
+    registry, _ = resolver_env
+    names = [f"{registry.address}/org/app{idx}:1" for idx in range(3)]
+    for idx in range(3):
+        registry.push(f"org/app{idx}", "1", "v1")
+    registry.rate_limit_remaining = 0
+    resolver = Image_Version_Resolver()
+    results = resolver.resolve_image_versions(names)
+    assert all(isinstance(result, str) for result in results.values())
+    assert not resolver.deferred
+    assert all(method == "HEAD" for method, path in registry.requests if "/manifests/" in path)
+
+
+def test_deferred_services_are_not_successes():
+    registry = Fake_Registry()
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        compose_tool, compose_log = make_fake_tool(root, "compose")
+        env = make_services(root, {
+            name: f"SERVICE_APP_IMAGE_TAGGED={registry.address}/org/{name}:1\n"
+                  f"SERVICE_APP_IMAGE_HASHED={registry.address}/org/{name}@sha256:{'0'*64}\n"
+            for name in ["a", "b"]
+        })
+        (root / "cache.json").unlink()
+        for name in ["a", "b"]:
+            child = registry.push(f"org/{name}", "child", "v1")
+            registry.push_index(f"org/{name}", "1", {"plan9/mips": child})
+        registry.rate_limit_remaining = 1
+        env.update({
+            "CIPUG_COMPOSE_TOOL": compose_tool,
+            "CIPUG_INSECURE_REGISTRIES": registry.address,
+            "CIPUG_RESOLVE_CONCURRENCY": 1,
+            "CIPUG_RATE_LIMIT_RESERVE": 0,
+        })
+        cp = call_cipug(env=env, args=["--update"])
+        registry.close()
+        assert cp.returncode == 0, cp.stdout + cp.stderr
+        assert "Deferred to the next run (registry rate limits): b" in cp.stdout
+        assert {line.split()[0] for line in compose_log.read_text().splitlines()} == {"a"}
+        status = json.loads((root / "cipug_status.json").read_text())
+        assert status["a"]["exit_code"] == 0
+        # No outcome for "b", as it wasn't worked on
+        assert "deferred" not in status["a"]
+        assert set(status["b"]) == {"deferred"}
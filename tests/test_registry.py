@@ -0,0 +1,162 @@
+import json
+
+import pytest
+
+from tests.helper import Fake_Registry
+from cipug.registry import Image_Reference, Rate_Limited, Registry_Client, Registry_Error, load_credentials
+
+
+@pytest.mark.parametrize("name,registry,repository,reference", [
+    ("nextcloud", "docker.io", "library/nextcloud", "latest"),
+    ("nextcloud:28", "docker.io", "library/nextcloud", "28"),
+    ("docker.io/nextcloud:28", "docker.io", "library/nextcloud", "28"),
+    ("index.docker.io/library/nextcloud", "docker.io", "library/nextcloud", "latest"),
+    ("paperlessngx/paperless-ngx:2", "docker.io", "paperlessngx/paperless-ngx", "2"),
+    ("ghcr.io/paperless-ngx/paperless-ngx:latest", "ghcr.io", "paperless-ngx/paperless-ngx", "latest"),
+    ("localhost:5000/app", "localhost:5000", "app", "latest"),
+    ("localhost/app:1", "localhost", "app", "1"),
+    ("quay.io/org/app@sha256:abc", "quay.io", "org/app", "sha256:abc"),
+])
+def test_image_reference_normalization(name: str, registry: str, repository: str, reference: str):
+    ref = Image_Reference(name)
+    assert ref.registry == registry
+    assert ref.repository == repository
+    assert ref.reference == reference
+
+
+@pytest.fixture
+def fake_registry():
+    registry = Fake_Registry()
+    yield registry
+    registry.close()
+
+
+def test_resolve_with_token_auth(fake_registry: Fake_Registry):
+    digest = fake_registry.push("org/app", "latest", "v1")
+    client = Registry_Client(insecure_registries=[fake_registry.address])
+    head = client.head_manifest(Image_Reference(f"{fake_registry.address}/org/app"))
+    assert head.result == f"{fake_registry.address}/org/app@{digest}"
+    # Only HEAD requests for the manifest, never a GET
+    assert ("GET", "/v2/org/app/manifests/latest") not in fake_registry.requests
+
+
+def test_connections_are_kept_alive(fake_registry: Fake_Registry):
+    for idx in range(5):
+        fake_registry.push(f"org/app{idx}", "latest", "v1")
+    client = Registry_Client(insecure_registries=[fake_registry.address])
+    for idx in range(5):
+        client.head_manifest(Image_Reference(f"{fake_registry.address}/org/app{idx}"))
+    assert len(fake_registry.connections) == 1
+
+
+def test_unknown_tag(fake_registry: Fake_Registry):
+    client = Registry_Client(insecure_registries=[fake_registry.address])
+    with pytest.raises(Registry_Error):
+        client.head_manifest(Image_Reference(f"{fake_registry.address}/org/missing:1"))
+
+
+def test_tokens_are_cached(fake_registry: Fake_Registry):
+    fake_registry.push("org/app", "1", "v1")
+    fake_registry.push("org/app", "2", "v2")
+    client = Registry_Client(insecure_registries=[fake_registry.address])
+    client.head_manifest(Image_Reference(f"{fake_registry.address}/org/app:1"))
+    client.head_manifest(Image_Reference(f"{fake_registry.address}/org/app:2"))
+    token_requests = [path for _, path in fake_registry.requests if path.startswith("/token")]
+    assert len(token_requests) == 1
+    # The second lookup did not need to be rejected first
+    assert len(fake_registry.requests) == 4
+
+
+def test_multi_scope_token_prefetch(fake_registry: Fake_Registry):
+    names = []
+    for idx in range(3):
+        fake_registry.push(f"org/app{idx}", "latest", "v1")
+        names.append(f"{fake_registry.address}/org/app{idx}")
+    client = Registry_Client(insecure_registries=[fake_registry.address])
+    client.prefetch_tokens(names)
+    for name in names:
+        client.head_manifest(Image_Reference(name))
+    token_requests = [path for _, path in fake_registry.requests if path.startswith("/token")]
+    assert len(token_requests) == 1
+    assert ("HEAD", "/v2/org/app0/manifests/latest") in fake_registry.requests
+
+
+def test_conditional_revalidation(fake_registry: Fake_Registry):
+    fake_registry.push("org/app", "latest", "v1")
+    client = Registry_Client(insecure_registries=[fake_registry.address])
+    ref = Image_Reference(f"{fake_registry.address}/org/app")
+    head = client.head_manifest(ref)
+    assert not head.not_modified
+
+    revalidated = client.head_manifest(ref, etag=head.etag)
+    assert revalidated.not_modified
+    assert revalidated.digest is None
+
+    digest = fake_registry.push("org/app", "latest", "v2")
+    changed = client.head_manifest(ref, etag=head.etag)
+    assert not changed.not_modified
+    assert changed.digest == digest
+
+
+def test_rate_limit_backoff(fake_registry: Fake_Registry):
+    fake_registry.push("org/app", "latest", "v1")
+    fake_registry.rate_limit_remaining = 2
+    client = Registry_Client(insecure_registries=[fake_registry.address])
+    ref = Image_Reference(f"{fake_registry.address}/org/app")
+    client.get_manifest(ref)
+    assert int(client.budgets[fake_registry.address].available()) == 1
+    assert client.backoff(fake_registry.address) == 0
+    # HEAD requests don't count
+    client.head_manifest(ref)
+    assert int(client.budgets[fake_registry.address].available()) == 1
+    assert client.take_budget(fake_registry.address)
+    client.get_manifest(ref)
+    # Used up, so wait until the budget refilled by one request (100 per 6h)
+    assert 200 < client.backoff(fake_registry.address) <= 216
+    assert client.backoff(fake_registry.address, pulls=False) == 0
+    assert not client.take_budget(fake_registry.address)
+    with pytest.raises(Registry_Error, match="rate limiting"):
+        client.get_manifest(ref)
+    assert client.head_manifest(ref).digest is not None
+
+
+def test_image_layers(fake_registry: Fake_Registry):
+    amd64 = fake_registry.push("org/app", "amd64", "v1", layers={"sha256:base": 100, "sha256:app": 20})
+    arm64 = fake_registry.push("org/app", "arm64", "v1", layers={"sha256:base-arm": 90})
+    index = fake_registry.push_index("org/app", "latest", {"linux/amd64": amd64, "linux/arm64": arm64})
+    client = Registry_Client(insecure_registries=[fake_registry.address])
+    ref = Image_Reference(f"{fake_registry.address}/org/app@{index}")
+    assert client.image_layers(ref, platform=("linux", "amd64")) == {"sha256:base": 100, "sha256:app": 20}
+    assert client.image_layers(ref, platform=("linux", "arm64")) == {"sha256:base-arm": 90}
+    with pytest.raises(Registry_Error):
+        client.image_layers(ref, platform=("linux", "s390x"))
+
+
+def test_image_layers_take_one_request_per_manifest(fake_registry: Fake_Registry):
+    amd64 = fake_registry.push("org/app", "amd64", "v1", layers={"sha256:base": 100})
+    index = fake_registry.push_index("org/app", "latest", {"linux/amd64": amd64})
+    fake_registry.rate_limit_remaining = 3
+    client = Registry_Client(insecure_registries=[fake_registry.address])
+    ref = Image_Reference(f"{fake_registry.address}/org/app@{index}")
+    client.head_manifest(ref)  # now the budget is known
+    # The index and the manifest of the platform, keeping one request
+    assert client.image_layers(ref, platform=("linux", "amd64"), reserve=1) == {"sha256:base": 100}
+    assert int(client.budgets[fake_registry.address].available()) == 1
+    request_count = len(fake_registry.requests)
+    with pytest.raises(Rate_Limited):
+        client.image_layers(ref, platform=("linux", "amd64"), reserve=1)
+    assert len(fake_registry.requests) == request_count
+
+
+def test_credential_helpers_are_warned_about(monkeypatch, tmp_path, capsys):
+    auth_file = tmp_path / "config.json"
+    auth_file.write_text(json.dumps({
+        "auths": {"https://index.docker.io/v1/": {"auth": "dXNlcjpwdw=="}, "ghcr.io": {}},
+        "credHelpers": {"ghcr.io": "gh"},
+        "credsStore": "desktop",
+    }))
+    monkeypatch.setenv("REGISTRY_AUTH_FILE", str(auth_file))
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    assert load_credentials() == {"docker.io": "dXNlcjpwdw=="}
+    assert "credential helpers (desktop, gh)" in capsys.readouterr().out
@@ -0,0 +1,54 @@
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from tests.helper import Fake_Registry, set_config
+from cipug.config import Config
+from cipug.registry import Registry_Error
+from cipug.resolver import Image_Version_Resolver
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = Fake_Registry()
+    with tempfile.TemporaryDirectory() as tmp:
+        set_config(monkeypatch, {
+            "SERVICES_ROOT": tmp,
+            "CACHE_LOCATION": str(Path(tmp) / "cache.json"),
+            "INSECURE_REGISTRIES": registry.address,
+            "RESOLVE_CONCURRENCY": "4",
+        })
+        yield registry
+    registry.close()
+    Config.reload()
+
+
+def test_results_map_back_to_their_names(registry: Fake_Registry):
+    digests = {
+        f"{registry.address}/org/app{idx}:1": registry.push(f"org/app{idx}", "1", f"v{idx}")
+        for idx in range(8)
+    }
+    resolver = Image_Version_Resolver()
+    results = resolver.resolve_image_versions(list(reversed(digests)) * 2)
+    assert results == {
+        name: f"{name.rpartition(':')[0]}@{digest}" for name, digest in digests.items()
+    }
+    assert set(resolver.outcomes.values()) == {"miss"}
+
+
+def test_failure_does_not_affect_other_images(registry: Fake_Registry):
+    good = [f"{registry.address}/org/app{idx}:1" for idx in range(4)]
+    for idx in range(4):
+        registry.push(f"org/app{idx}", "1", "v1")
+    missing = f"{registry.address}/org/missing:1"
+    resolver = Image_Version_Resolver()
+    results = resolver.resolve_image_versions(good + [missing])
+    assert isinstance(results[missing], Registry_Error)
+    assert all(isinstance(results[name], str) for name in good)
+    assert set(resolver.failures) == {missing}
+    # The failure is raised again for that name, without asking the registry
+    request_count = len(registry.requests)
+    with pytest.raises(Registry_Error):
+        resolver.resolve_image_version(missing)
+    assert len(registry.requests) == request_count
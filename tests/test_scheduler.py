@@ -0,0 +1,69 @@
+import tempfile
+from pathlib import Path
+
+from tests.helper import call_cipug, make_fake_tool, make_services
+from cipug.scheduler import Restart_Scheduler
+
+
+def test_waves():
+    waves, cyclic, blocked = Restart_Scheduler({
+        "proxy": {"app", "other"},
+        "app": {"db", "not-updated"},
+        "db": set(),
+        "other": set(),
+    }).waves()
+    assert waves == [["db", "other"], ["app"], ["proxy"]]
+    assert cyclic == blocked == set()
+
+
+def test_cycles():
+    waves, cyclic, blocked = Restart_Scheduler({
+        "a": {"b"},
+        "b": {"a"},
+        "c": {"a"},
+        "e": {"c", "d"},
+        "d": set(),
+    }).waves()
+    assert waves == [["d"]]
+    assert cyclic == {"a", "b"}
+    assert blocked == {"c", "e"}
+
+
+def test_restart_order():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        root = Path(tmpdirname)
+        compose_tool, compose_log = make_fake_tool(root, "compose")
+        env = make_services(root, {
+            "db": "SERVICE_DB_IMAGE_TAGGED=example.org/db:1\n",
+            "app": "SERVICE_APP_IMAGE_TAGGED=example.org/app:1\nCIPUG_DEPENDS_ON=db\n",
+            "proxy": "SERVICE_PROXY_IMAGE_TAGGED=example.org/proxy:1\nCIPUG_DEPENDS_ON=app, db\n",
+            "other": "SERVICE_OTHER_IMAGE_TAGGED=example.org/other:1\n",
+        })
+        env["CIPUG_COMPOSE_TOOL"] = compose_tool
+        env["CIPUG_UPDATE_CONCURRENCY"] = 4
+        cp = call_cipug(env=env, args=["--update"])
+        assert cp.returncode == 0, cp.stdout + cp.stderr
+
+        calls = compose_log.read_text().splitlines()
+        assert calls.index("db up -d") < calls.index("app down")
+        assert calls.index("app up -d") < calls.index("proxy down")
+        assert "other up -d" in calls
+
+
+def test_failed_dependency_skips_dependents():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        root = Path(tmpdirname)
+        compose_tool, compose_log = make_fake_tool(
+            root,
+            "compose",
+            "if cwd.name == 'db' and args == ['up', '-d']:\n    sys.exit(1)\n"
+        )
+        env = make_services(root, {
+            "db": "SERVICE_DB_IMAGE_TAGGED=example.org/db:1\n",
+            "app": "SERVICE_APP_IMAGE_TAGGED=example.org/app:1\nCIPUG_DEPENDS_ON=db\n",
+        })
+        env["CIPUG_COMPOSE_TOOL"] = compose_tool
+        cp = call_cipug(env=env, args=["--update"])
+        assert cp.returncode != 0
+        assert not any(call.startswith("app ") for call in compose_log.read_text().splitlines())
+        assert "HASHED" not in (root / "services" / "app" / ".env").read_text()
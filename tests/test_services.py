@@ -0,0 +1,78 @@
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from tests.helper import set_config, wait_for
+from cipug.config import Config
+from cipug.services import IN_Q_OVERFLOW, Service_Registry
+
+
+def make_service(root: Path, name: str):
+    (root / name).mkdir()
+    (root / name / "compose.yml").write_text("services: {}\n")
+    (root / name / ".env").write_text("A=1\n")
+
+
+@pytest.fixture
+def services_root(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmp:
+        set_config(monkeypatch, {
+            "SERVICES_ROOT": tmp,
+            "SERVICES_FILTER_EXCLUDE": "excluded",
+        })
+        yield Path(tmp)
+    Service_Registry.reset()
+    Config.reload()
+
+
+def test_scan(services_root: Path):
+    make_service(services_root, "a")
+    make_service(services_root, "excluded")
+    (services_root / "no_env").mkdir()
+    (services_root / "no_env" / "compose.yml").write_text("services: {}\n")
+    registry = Service_Registry.shared()
+    assert registry.services == [services_root / "a"]
+    assert Service_Registry.shared() is registry
+
+
+def test_watch_follows_changes(services_root: Path):
+    make_service(services_root, "a")
+    registry = Service_Registry()
+    if not registry.watch():
+        pytest.skip("inotify is not available")
+    try:
+        registry.take_changes()
+        make_service(services_root, "b")
+        make_service(services_root, "excluded")
+        wait_for(lambda: registry.services == [services_root / "a", services_root / "b"])
+        wait_for(lambda: services_root / "b" in registry.take_changes())
+
+        (services_root / "a" / ".env").write_text("A=2\n")
+        wait_for(lambda: registry.take_changes() == {services_root / "a"})
+
+        (services_root / "a" / ".env").unlink()
+        wait_for(lambda: registry.services == [services_root / "b"])
+        (services_root / "b" / ".env").unlink()
+        (services_root / "b" / "compose.yml").unlink()
+        (services_root / "b").rmdir()
+        wait_for(lambda: registry.services == [])
+    finally:
+        registry.close()
+
+
+def test_overflow_notifies_listeners(services_root: Path):
+    make_service(services_root, "a")
+    make_service(services_root, "b")
+    registry = Service_Registry()
+    registry.take_changes()
+    notified = []
+    registry.listeners.append(lambda: notified.append(True))
+    # Changes were missed: a new service, and one that isn't one anymore
+    make_service(services_root, "c")
+    (services_root / "b" / ".env").unlink()
+    registry._handle([(-1, IN_Q_OVERFLOW, "")])
+    assert registry.services == [services_root / "a", services_root / "c"]
+    assert notified == [True]
+    # Its files may have changed as well
+    assert registry.take_changes() == {services_root / name for name in "abc"}
@@ -0,0 +1,81 @@
+import os
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from tests.helper import call_cipug, make_fake_tool, make_services
+from cipug.snapper import Snapshotter
+
+OLD = "example.org/{}@sha256:" + "0"*64
+
+# Every service folder has its own snapper config, named like the folder.
+# Snapshots of service "b" fail.
+SNAPPER_SCRIPT = """
+import json
+services = Path(os.environ['FAKE_SERVICES_ROOT'])
+if args == ['--jsonout', 'list-configs']:
+    print(json.dumps({'configs': [
+        {'config': folder.name, 'subvolume': str(folder)} for folder in sorted(services.iterdir())
+    ]}))
+elif 'create' in args:
+    if args[1] == 'b':
+        sys.exit(1)
+    print(10 + ord(args[1]) - ord('a'))
+"""
+
+
+def run_snapshotted_update(root: Path, staged: bool):
+    bin_dir = root / "bin"
+    bin_dir.mkdir()
+    _, snapper_log = make_fake_tool(bin_dir, "snapper", SNAPPER_SCRIPT)
+    compose_tool, compose_log = make_fake_tool(root, "compose")
+    container_tool, _ = make_fake_tool(root, "container")
+    env = make_services(root, {
+        name: f"SERVICE_{name.upper()}_IMAGE_TAGGED=example.org/{name}:1\n"
+              f"SERVICE_{name.upper()}_IMAGE_HASHED={OLD.format(name)}\n"
+        for name in ["a", "b", "c"]
+    })
+    env.update({
+        "PATH": f"{bin_dir}{os.pathsep}{os.environ['PATH']}",
+        "FAKE_SERVICES_ROOT": env["CIPUG_SERVICES_ROOT"],
+        "CIPUG_COMPOSE_TOOL": compose_tool,
+        "CIPUG_CONTAINER_TOOL": container_tool,
+        "CIPUG_SERVICE_SNAPSHOT": "true",
+        "CIPUG_UPDATE_STAGED": str(staged).lower(),
+    })
+    return call_cipug(env=env, args=["--update"]), snapper_log, compose_log
+
+
+def test_snapshot_numbers_are_reported():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        cp, snapper_log, _ = run_snapshotted_update(root, staged=False)
+        assert cp.returncode != 0  # snapshotting "b" failed
+        assert " - a: 10" in cp.stdout
+        assert " - c: 12" in cp.stdout
+        assert OLD.format("b") in (root / "services" / "b" / ".env").read_text()
+        assert "--print-number" in snapper_log.read_text()
+
+
+def test_staged_mode_snapshots_before_restarting():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        cp, snapper_log, compose_log = run_snapshotted_update(root, staged=True)
+        assert cp.returncode != 0
+        assert " - a: 10" in cp.stdout
+        assert " - c: 12" in cp.stdout
+        # all snapshots were taken before the first restart
+        snapshot_calls = [line for line in snapper_log.read_text().splitlines() if "create" in line]
+        assert len(snapshot_calls) == 3
+        restarted = {line.split()[0] for line in compose_log.read_text().splitlines() if "up" in line.split()}
+        assert restarted == {"a", "c"}
+        assert OLD.format("b") in (root / "services" / "b" / ".env").read_text()
+
+
+def test_incomplete_backend_cannot_be_created():
+    class Incomplete_Snapshotter(Snapshotter):
+        tool_name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete_Snapshotter()
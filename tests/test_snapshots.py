@@ -0,0 +1,58 @@
+import json
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from tests.helper import call_cipug, make_services
+
+
+def test_check_snapshots_json():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        env = make_services(root, {"fresh": "", "old": "", "none": ""})
+        env.update({
+            "CIPUG_SNAPSHOTS_DIR_SNAPPER": ".snapshots",
+            "CIPUG_SNAPSHOTS_DIR_BTRBK": ".btrbk",
+        })
+        services = root / "services"
+        now = datetime.now()
+        for name, btrbk_dates in [("fresh", [now - timedelta(hours=50), now]), ("old", [now - timedelta(hours=50)])]:
+            for number in [1, 2, 9, 10]:
+                (services / name / ".snapshots" / str(number)).mkdir(parents=True)
+            for number in [1, 2, 9]:
+                (services / name / ".snapshots" / str(number) / "info.xml").write_text("")
+            # 10 is still being created, so it doesn't count
+            (services / name / ".btrbk").mkdir()
+            for date in btrbk_dates:
+                (services / name / ".btrbk" / f"{name}.{date.strftime('%Y%m%dT%H%M')}").mkdir()
+                (services / name / ".btrbk" / f"{name}.{date.strftime('%Y%m%dT%H%M')}_1").mkdir()
+            (services / name / ".btrbk" / "unrelated").mkdir()
+        (services / "none" / ".snapshots").mkdir()
+        (services / "none" / ".btrbk").mkdir()
+
+        cp = call_cipug(env=env, args=["--check-snapshots-json"])
+        assert cp.returncode != 0
+        result = json.loads(cp.stdout)
+        assert result["ok"] is False
+        fresh, old, none = (result["services"][name] for name in ["fresh", "old", "none"])
+        assert fresh["snapper"]["ok"] and fresh["btrbk"]["ok"]
+        assert fresh["btrbk"]["date"] == now.replace(second=0, microsecond=0).isoformat()
+        assert old["snapper"]["ok"] and not old["btrbk"]["ok"]
+        assert old["btrbk"]["age_hours"] > 36
+        assert none["snapper"]["date"] is None and not none["snapper"]["ok"]
+
+        (services / "none").rename(root / "none")
+        # A snapshot that is too old fails the human readable check just the same
+        cp = call_cipug(env=env, args=["--check-snapshots"])
+        assert cp.returncode == 40, cp.stdout + cp.stderr
+        (services / "old" / ".btrbk" / f"old.{now.strftime('%Y%m%dT%H%M')}").mkdir()
+        cp = call_cipug(env=env, args=["--check-snapshots-json"])
+        assert cp.returncode == 0, cp.stdout + cp.stderr
+        assert json.loads(cp.stdout)["ok"] is True
+        # Logs don't get in the way of the json
+        cp = call_cipug(env={**env, "CIPUG_VERBOSITY": 3}, args=["--check-snapshots-json"])
+        assert cp.returncode == 0, cp.stdout + cp.stderr
+        assert json.loads(cp.stdout)["ok"] is True
+        assert "Loaded cipug config" in cp.stderr
+        cp = call_cipug(env=env, args=["--check-snapshots"])
+        assert cp.returncode == 0, cp.stdout + cp.stderr
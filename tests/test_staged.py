@@ -0,0 +1,83 @@
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from tests.helper import call_cipug
+
+OLD = "example.org/{name}@sha256:" + "0"*64
+NEW = "example.org/{name}@sha256:" + "0"*63 + "1"
+
+
+def make_tool(folder: Path, name: str, fail_on: str = "") -> Path:
+    """An executable that logs its calls as "<cwd name> <arguments>" and
+    fails if its arguments contain fail_on"""
+    tool = folder / name
+    tool.write_text(
+        f"#!{sys.executable}\n"
+        "import sys, os\n"
+        f"with open({str(folder / (name + '.log'))!r}, 'a') as f:\n"
+        "    f.write(os.path.basename(os.getcwd()) + ' ' + ' '.join(sys.argv[1:]) + '\\n')\n"
+        f"if {fail_on!r} and {fail_on!r} in ' '.join(sys.argv[1:]):\n"
+        "    sys.exit(1)\n"
+        "if sys.argv[1:] == ['--jsonout', 'list-configs']:\n"
+        "    print('{\"configs\": []}')\n"
+    )
+    tool.chmod(0o755)
+    return tool
+
+
+def run_staged(root: Path, fail_on: str = ""):
+    services = root / "services"
+    images = {}
+    for name in ["a", "b"]:
+        (services / name).mkdir(parents=True)
+        (services / name / "compose.yml").write_text("services: {}\n")
+        (services / name / ".env").write_text(
+            f"SERVICE_APP_IMAGE_TAGGED=example.org/{name}:1\n"
+            f"SERVICE_APP_IMAGE_HASHED={OLD.format(name=name)}\n"
+        )
+        images[f"example.org/{name}:1"] = {"time": time.time(), "result": NEW.format(name=name)}
+    (root / "cache.json").write_text(json.dumps({"images": images}))
+    bin_dir = root / "bin"
+    bin_dir.mkdir()
+    make_tool(bin_dir, "snapper")
+    return call_cipug(env={
+        "PATH": f"{bin_dir}{os.pathsep}{os.environ['PATH']}",
+        "CIPUG_SERVICES_ROOT": services,
+        "CIPUG_CACHE_LOCATION": root / "cache.json",
+        "CIPUG_COMPOSE_TOOL": make_tool(root, "compose"),
+        "CIPUG_CONTAINER_TOOL": make_tool(root, "container", fail_on),
+        "CIPUG_UPDATE_STAGED": "true",
+        "CIPUG_SERVICE_SNAPSHOT": "false",
+        "CIPUG_PRUNE_IMAGES": "false",
+    }, args=["--update"])
+
+
+def test_staged_pulls_all_images_before_restarting():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        cp = run_staged(root)
+        assert cp.returncode == 0, cp.stdout + cp.stderr
+        pulls = sorted(call.split(" ", 1)[1] for call in (root / "container.log").read_text().splitlines())
+        assert pulls == [f"pull {NEW.format(name='a')}", f"pull {NEW.format(name='b')}"]
+        compose_calls = (root / "compose.log").read_text().splitlines()
+        # Images were pulled up front, compose doesn't pull again
+        assert not any(call.endswith(" pull") for call in compose_calls)
+        for name in ["a", "b"]:
+            assert f"{name} up -d" in compose_calls
+            assert NEW.format(name=name) in (root / "services" / name / ".env").read_text()
+
+
+def test_failed_pull_leaves_service_untouched():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        cp = run_staged(root, fail_on=NEW.format(name="b"))
+        assert cp.returncode == 33, cp.stdout + cp.stderr  # IMAGE_PULL_ERROR
+        compose_calls = (root / "compose.log").read_text().splitlines()
+        assert "a up -d" in compose_calls
+        assert not any(call.startswith("b ") for call in compose_calls)
+        assert NEW.format(name="a") in (root / "services" / "a" / ".env").read_text()
+        assert OLD.format(name="b") in (root / "services" / "b" / ".env").read_text()
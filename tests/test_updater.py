@@ -0,0 +1,36 @@
+import tempfile
+from pathlib import Path
+
+from tests.helper import make_services, set_config
+from cipug import updater as updater_module
+from cipug.config import Config
+from cipug.resolver import Image_Version_Resolver
+from cipug.services import Service_Registry
+from cipug.updater import Updater
+
+OLD = "@sha256:" + "0"*64
+
+
+def test_env_files_are_read_once(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        env = make_services(root, {
+            name: f"SERVICE_APP_IMAGE_TAGGED=example.org/{name}:1\nSERVICE_APP_IMAGE_HASHED=example.org/{name}{OLD}\n"
+            for name in ["a", "b"]
+        })
+        set_config(monkeypatch, {key.removeprefix("CIPUG_"): val for key, val in env.items()})
+        read: list[str] = []
+
+        class Counting_Env(updater_module.Env):
+            def __init__(self, path: Path):
+                read.append(path.parent.name)
+                super().__init__(path)
+        monkeypatch.setattr(updater_module, "Env", Counting_Env)
+        try:
+            updater = Updater(resolver=Image_Version_Resolver(), snapper=None)
+            pending_updates = updater.prepare_all()
+        finally:
+            Service_Registry.reset()
+            Config.reload()
+        assert sorted(pending.name for pending in pending_updates) == ["a", "b"]
+        assert sorted(read) == ["a", "b"]